@@ -1,6 +1,6 @@
 import os
 
-from setuptools import find_packages, setup
+from setuptools import Extension, find_packages, setup
 
 
 def _get_local_file(file_name):
@@ -17,6 +17,8 @@ setup(
     name='tfccs',
     version='0.1.0',  # don't forget to update pbsvtools/__init__.py too
     packages=find_packages(),
+    # Optional, tfccs.fextract_reader falls back to np.loadtxt if it fails to build
+    ext_modules=[Extension('tfccs._fextract_tokenizer', ['tfccs/_fextract_tokenizer.c'], optional=True)],
     license='BSD',
     author='yli',
     author_email='yli@pacificbiosciences.com',
@@ -26,10 +28,13 @@ setup(
     entry_points={'console_scripts': [
         'fextract2numpy=tfccs.fextract2numpy:main',
         'fextract2stat=tfccs.fextract2stat:main',
+        'fextract2statnumpy=tfccs.fextract2statnumpy:main',
+        'fextract2index=tfccs.fextract_index:main',
         'multinomial=tfccs.train:multinomial_main',
         'cnn=tfccs.train:cnn_main',
         'evalmodel=tfccs.evalmodel:main',
         'merge-base-map-prob=tfccs.merge_base_map_prob:main',
+        'merge-stats=tfccs.merge_stats:main',
         'qvpipe=tfccs.qvpipe:main',
     ]},
     install_requires=[],
@@ -202,3 +202,38 @@ Test4: run a small data with Sequence Context: PrevBases and NextBases
   "NextBase1G",
   "NextBase1T",
   "NextBase1GAP"
+
+Test5: run with multiple processes, output must be the same as a single process
+  $ IN=$DATADIR/fextract2numpy/input.fextract.csv
+  $ fextract2numpy ${IN} ${CRAMTMP}/test5_out --stat-json ${STAT_JSON} --num-train-rows 5 --nproc 2 1>&2 >/dev/null && echo $?
+  0
+  $ cmp ${CRAMTMP}/test5_out.fextract.csv ${OUT_PREFIX}.fextract.csv && echo $?
+  0
+  $ python -c "from tfccs.utils import load_fextract_npz; import numpy as np; print(np.array_equal(load_fextract_npz(\"${CRAMTMP}/test5_out.npz\")[0], load_fextract_npz(\"${OUT_PREFIX}.npz\")[0]))"
+  True
+
+Test6: filter rows by predicates on fextract columns
+  $ fextract2numpy ${IN} ${CRAMTMP}/test6_out --filter 'CCSHPLength<=2' --filter 'CCSToGenomeCigar!=I' 1>&2 >/dev/null && echo $?
+  0
+  $ python -c "import csv; rs = list(csv.DictReader(open(\"${CRAMTMP}/test6_out.fextract.csv\"))); print(len(rs), all(float(r['CCSHPLength']) <= 2 for r in rs))"
+  3 True
+
+Test7: record offsets of kept rows in a row index instead of copying rows
+  $ fextract2numpy ${IN} ${CRAMTMP}/test7_out --stat-json ${STAT_JSON} --num-train-rows 5 --raw-rows index 1>&2 >/dev/null && echo $?
+  0
+  $ ls ${CRAMTMP}/test7_out.fextract.csv 2>/dev/null || echo $?
+  2
+  $ python -c "from tfccs.fextract_index import iter_lines; print(''.join(iter_lines(\"${CRAMTMP}/test7_out.rows.idx\")) == open(\"${OUT_PREFIX}.fextract.csv\").read())"
+  True
+
+Test8: write a memory-mappable directory of .npy files instead of .npz
+  $ fextract2numpy ${IN} ${CRAMTMP}/test8_out --stat-json ${STAT_JSON} --num-train-rows 5 --output-format npydir 1>&2 >/dev/null && echo $?
+  0
+  $ ls ${CRAMTMP}/test8_out.npydir
+  arrowqv.npy
+  arrowqvbin8.npy
+  ccs2genome_cigars.npy
+  fextractinput.npy
+  manifest.json
+  $ python -c "from tfccs.utils import load_fextract_npz; import numpy as np; print(all(np.array_equal(a, b) for a, b in zip(load_fextract_npz(\"${CRAMTMP}/test8_out.npydir\"), load_fextract_npz(\"${OUT_PREFIX}.npz\"))))"
+  True
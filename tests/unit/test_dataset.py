@@ -0,0 +1,177 @@
+import os
+import os.path as op
+import numpy as np
+import pytest
+from tfccs.dataset import (NpzStreamWriter, ArraySpool, NpyDirWriter, load_npy_dir, open_dataset_writer,
+                           load_sharded_dataset, read_manifest, ChunkedDatasetWriter, ChunkedDataset,
+                           FeatureQuantizer, dequantize_features, COUNTS_KEY)
+from tfccs.utils import load_fextract_npz, load_fextract_counts
+
+ROOT_DIR = op.dirname(op.dirname(__file__))
+OUT_DIR = op.join(ROOT_DIR, 'out', 'test_dataset')
+
+
+def make_dataset(nrow, ncol=5):
+    rng = np.random.RandomState(0)
+    cigars = np.eye(4, dtype=np.float32)[rng.randint(0, 4, nrow)]
+    arrowqv = rng.randint(0, 93, nrow).astype(np.float32)
+    return {'fextractinput': rng.uniform(-4, 4, (nrow, ncol)).astype(np.float32),
+            'arrowqv': arrowqv,
+            'arrowqvbin8': np.eye(8, dtype=np.float32)[np.minimum(arrowqv // 10, 7).astype(int)],
+            'ccs2genome_cigars': cigars}
+
+
+def test_npz_stream_writer():
+    if not op.exists(OUT_DIR):
+        os.makedirs(OUT_DIR)
+    d = make_dataset(100)
+    out_npz = op.join(OUT_DIR, 'stream.npz')
+    with NpzStreamWriter(out_npz) as writer:
+        for start, end in [(0, 30), (30, 30), (30, 99), (99, 100)]:
+            writer.write(**{key: a[start:end] for key, a in d.items()})
+    assert not any([f.endswith('.spool') for f in os.listdir(OUT_DIR)])
+    out = np.load(out_npz)
+    assert list(out.keys()) == list(d.keys())
+    for key, a in d.items():
+        assert out[key].dtype == a.dtype
+        assert np.array_equal(out[key], a)
+
+
+def test_array_spool():
+    if not op.exists(OUT_DIR):
+        os.makedirs(OUT_DIR)
+    d = make_dataset(100)
+    spool = ArraySpool(op.join(OUT_DIR, 'spill'), keys=list(d.keys()))
+    for start, end in [(0, 30), (30, 99), (99, 100)]:
+        spool.write(**{key: a[start:end] for key, a in d.items()})
+    blocks = [block for block in spool.read_blocks(40)]
+    assert [len(block['arrowqv']) for block in blocks] == [40, 40, 20]
+    for key, a in d.items():
+        assert np.array_equal(np.concatenate([block[key] for block in blocks]), a)
+    spool.remove()
+    assert not any([f.endswith('.spool') for f in os.listdir(OUT_DIR)])
+
+
+def test_npy_dir_writer():
+    if not op.exists(OUT_DIR):
+        os.makedirs(OUT_DIR)
+    d = make_dataset(100)
+    out_dir = op.join(OUT_DIR, 'stream.npydir')
+    with NpyDirWriter(out_dir) as writer:
+        for start, end in [(0, 30), (30, 30), (30, 99), (99, 100)]:
+            writer.write(**{key: a[start:end] for key, a in d.items()})
+    assert sorted(os.listdir(out_dir)) == sorted([key + '.npy' for key in d.keys()] + ['manifest.json'])
+    out = load_npy_dir(out_dir)
+    for key, a in d.items():
+        assert isinstance(out[key], np.memmap)
+        assert np.array_equal(out[key], a)
+        assert np.array_equal(np.load(op.join(out_dir, key + '.npy')), a)
+
+    # npz and npydir datasets load the same
+    for dataset_format in ['npz', 'npydir']:
+        with open_dataset_writer(op.join(OUT_DIR, 'dataset'), dataset_format) as writer:
+            writer.write(**d)
+    for a1, a2 in zip(load_fextract_npz(op.join(OUT_DIR, 'dataset.npz')),
+                      load_fextract_npz(op.join(OUT_DIR, 'dataset.npydir'))):
+        assert np.array_equal(a1, a2)
+
+
+def test_sharded_dataset_writer():
+    if not op.exists(OUT_DIR):
+        os.makedirs(OUT_DIR)
+    d = make_dataset(100)
+    for dataset_format in ['npz', 'npydir']:
+        prefix = op.join(OUT_DIR, 'sharded.' + dataset_format)
+        with open_dataset_writer(prefix, dataset_format, shard_rows=40, labels=list('=IXD'),
+                                 metadata={'OrderedFeatures': ['F1']}) as writer:
+            for start, end in [(0, 30), (30, 30), (30, 99), (99, 100)]:
+                writer.write(**{key: a[start:end] for key, a in d.items()})
+        manifest = read_manifest(prefix + '.shards')
+        assert manifest['OrderedFeatures'] == ['F1']
+        assert manifest['num_rows'] == 100
+        assert [shard['num_rows'] for shard in manifest['shards']] == [40, 40, 20]
+        assert manifest['shards'][2]['filename'] == 'shard-00002.' + dataset_format
+        assert manifest['shards'][1]['label_histogram'] == dict(zip('=IXD', d['ccs2genome_cigars'][40:80].sum(axis=0)))
+        assert np.array_equal(load_fextract_npz(prefix + '.shards')[0], d['fextractinput'])
+        for key, a in d.items():
+            assert np.array_equal(load_sharded_dataset(prefix + '.shards', shards=[1])[key], a[40:80])
+        sharded = load_sharded_dataset(prefix + '.shards')
+        assert sharded.num_rows == 100 and 'arrowqv' in sharded
+        for start, end in [(0, 100), (10, 30), (30, 90), (85, 200), (100, 100)]:
+            assert np.array_equal(sharded.read('fextractinput', start, end), d['fextractinput'][start:end])
+        if dataset_format == 'npydir':
+            # Rows of a single shard are memory-mapped, not copied
+            assert isinstance(sharded.read('arrowqv', 45, 70), np.memmap)
+
+
+def test_chunked_dataset():
+    if not op.exists(OUT_DIR):
+        os.makedirs(OUT_DIR)
+    d = make_dataset(100)
+    for codec, nthreads in [('zlib', 1), ('lzma', 3), ('bz2', 2), ('none', 2)]:
+        filename = op.join(OUT_DIR, 'dataset.{}.chunked'.format(codec))
+        with ChunkedDatasetWriter(filename, codec=codec, rows_per_chunk=16, nthreads=nthreads) as writer:
+            for start, end in [(0, 30), (30, 30), (30, 99), (99, 100)]:
+                writer.write(**{key: a[start:end] for key, a in d.items()})
+        dataset = ChunkedDataset(filename)
+        assert dataset.num_rows == 100 and dataset.keys() == list(d.keys())
+        for key, a in d.items():
+            assert np.array_equal(dataset[key], a)
+            for start, end in [(0, 16), (15, 33), (40, 41), (90, 200), (50, 50)]:
+                assert np.array_equal(dataset.read(key, start, end), a[start:end])
+        for a1, a2 in zip(load_fextract_npz(filename), [d[key] for key in d.keys()]):
+            assert np.array_equal(a1, a2)
+
+
+def test_feature_quantizer():
+    rng = np.random.RandomState(0)
+    a = np.concatenate([rng.uniform(-5, 5, (100, 1)), rng.randint(0, 2, (100, 1))], axis=1).astype(np.float32)
+    a[3, 0] = np.nan
+    quantizer = FeatureQuantizer(['F', 'OneHot'], dtype='int8', ranges=[(-4, 4), (0, 1)])
+    codes = quantizer.quantize(a)
+    assert codes.dtype == np.int8
+    b = dequantize_features(codes, **{name.split('_')[-1]: v for name, v in quantizer.attrs.items()})
+    assert np.isnan(b[3, 0]) and np.isnan(b).sum() == 1
+    assert np.array_equal(b[:, 1], a[:, 1])  # 0 and 1 are exact
+    clipped = np.clip(a[:, 0], -4, 4)
+    assert np.nanmax(np.abs(b[:, 0] - clipped)) <= 8.0 / 254 / 2 + 1e-6
+    report = quantizer.error_report()
+    assert report['OneHot']['max_abs_error'] == 0
+    assert report['F']['max_abs_error'] == pytest.approx(np.nanmax(np.abs(b[:, 0] - a[:, 0])), rel=1e-5)
+
+    quantizer = FeatureQuantizer(['F', 'OneHot'], dtype='float16')
+    assert quantizer.quantize(a).dtype == np.float16 and quantizer.attrs == {}
+    with pytest.raises(ValueError):
+        FeatureQuantizer(['F', 'OneHot'], dtype='int8')
+
+
+def test_collapse_duplicates():
+    if not op.exists(OUT_DIR):
+        os.makedirs(OUT_DIR)
+    d = make_dataset(20, ncol=2)
+    d['fextractinput'] = np.round(d['fextractinput'] / 4).astype(np.float32)  # few distinct feature rows
+    # Tiny collapse memory splits partitions again and merges runs block by block
+    for dataset_format, shard_rows, collapse_memory in [('npz', 0, None), ('npydir', 3, None), ('npz', 0, 100)]:
+        prefix = op.join(OUT_DIR, 'collapsed')
+        with open_dataset_writer(prefix, dataset_format, shard_rows=shard_rows, collapse_duplicates=True,
+                                 labels=list('=IXD'), collapse_memory=collapse_memory) as writer:
+            for start, end in [(0, 7), (7, 7), (7, 20)]:
+                writer.write(**{key: a[start:end] for key, a in d.items()})
+        assert not op.exists(prefix + '.collapse.tmp')
+        filename = prefix + ('.shards' if shard_rows > 0 else '.' + dataset_format)
+        x, arrowqv, _, y, nrow, _ = load_fextract_npz(filename)
+        counts = load_fextract_counts(filename)
+        # Unique rows in the order of first occurrences, whose counts add up to all rows
+        rows = [(tuple(f), tuple(c)) for f, c in zip(d['fextractinput'], d['ccs2genome_cigars'])]
+        firsts = sorted(set([rows.index(row) for row in rows]))
+        assert nrow == len(firsts) < 20 and counts.sum() == 20
+        assert np.array_equal(x, d['fextractinput'][firsts]) and np.array_equal(y, d['ccs2genome_cigars'][firsts])
+        assert np.array_equal(arrowqv, d['arrowqv'][firsts])
+        assert list(counts) == [rows.count(rows[idx]) for idx in firsts]
+        assert np.array_equal(load_fextract_npz(filename, return_counts=True)[-1], counts)
+        if shard_rows > 0:
+            # Label histograms count collapsed rows
+            shards = read_manifest(filename)['shards']
+            assert sum([sum(shard['label_histogram'].values()) for shard in shards]) == 20
+    assert load_fextract_counts(op.join(OUT_DIR, 'stream.npz')) is None
+    assert COUNTS_KEY not in np.load(op.join(OUT_DIR, 'stream.npz'))
@@ -1,10 +1,18 @@
 import os
+import gzip
+import json
 import os.path as op
 import numpy as np
 import pytest
-from tfccs.fextract2stat import compute_feature_stats
-from tfccs.utils import load_fextract_stat_json, load_fextract_npz
-from tfccs.fextract2numpy import fextract2numpy, one_hot_encode_cigar, one_hot_to_cigar
+from tfccs.fextract2stat import compute_feature_stats, FeatureStatAccumulator
+from tfccs.merge_stats import merge_stat_jsons
+from tfccs.fextract2statnumpy import fextract2statnumpy
+from tfccs.fextract_index import iter_lines
+from tfccs.utils import load_fextract_stat_json, load_fextract_npz, load_fextract_counts, check_dataset_stat_version
+from tfccs.fextract2numpy import (fextract2numpy, one_hot_encode_cigar, one_hot_to_cigar, one_hot_base,
+                                  one_hot_base_or_gap, ccs2genome_cigar_counting_prev_dels, encode_bases_block,
+                                  encode_cigars_block, parse_class_quotas, class_quotas_from_ratios,
+                                  BaseMapCounter, strata_codes, BASE_OR_GAP_ALPHABET)
 
 
 ROOT_DIR = op.dirname(op.dirname(__file__))
@@ -122,3 +130,557 @@ def test_one_hot():
     assert one_hot_to_cigar([0, 1, 0, 0]) == 'I'
     assert one_hot_to_cigar([0, 0, 1, 0]) == 'X'
     assert one_hot_to_cigar([0, 0, 0, 1]) == 'D'
+
+
+def test_encode_block():
+    bases = np.array([b'A', b'c', b'G', b't'])
+    one_hot, codes = encode_bases_block(bases)
+    assert codes[:, 0].tolist() == [0, 1, 2, 3]
+    assert one_hot.tolist() == [list(one_hot_base(b.decode()).values()) for b in bases]
+
+    pairs = np.array([b'A-', b'gT'])
+    one_hot, codes = encode_bases_block(pairs, num_bases=2, alphabet=BASE_OR_GAP_ALPHABET, name='PrevBases')
+    assert codes.tolist() == [[0, 4], [2, 3]]
+    for row, pair in zip(one_hot, pairs):
+        pair = pair.decode()
+        expected = list(one_hot_base_or_gap(pair[0], 'PrevBase0').values()) + \
+            list(one_hot_base_or_gap(pair[1], 'PrevBase1').values())
+        assert row.tolist() == expected
+
+    cigars, prev_dels = np.array([b'=', b'I', b'X', b'=', b'N']), np.array([0, 0, 0, 2, 1])
+    one_hot, codes = encode_cigars_block(cigars, prev_dels)
+    assert codes.tolist() == [0, 1, 2, 3, 3]
+    assert one_hot.tolist() == [ccs2genome_cigar_counting_prev_dels(c.decode() if d == 0 else '=', d)
+                                for c, d in zip(cigars, prev_dels)]
+
+    with pytest.raises(ValueError):
+        encode_bases_block(np.array([b'A', b'N']))
+    with pytest.raises(ValueError):
+        encode_bases_block(np.array([b'AC']))
+    with pytest.raises(ValueError):
+        encode_cigars_block(np.array([b'=', b'N']), np.array([0, 0]))
+
+
+def test_fextract2numpy_nproc():
+    """Multi-process conversion must output exactly the same as single-process conversion."""
+    out_dir = op.join(ROOT_DIR, 'out', 'test_fextract2numpy_nproc')
+    if not op.exists(out_dir):
+        os.mkdir(out_dir)
+    in_csv = op.join(ROOT_DIR, 'data', 'tiny.fextract.csv')
+    stat_json = op.join(ROOT_DIR, 'data', 'fextract.stat.json')
+    for num_train_rows in [0, 3]:
+        outs = []
+        for nproc in [1, 3]:
+            prefix = op.join(out_dir, 'nproc{}.rows{}'.format(nproc, num_train_rows))
+            fextract2numpy(fextract_filename=in_csv, output_prefix=prefix, num_train_rows=num_train_rows,
+                           min_dist2end=100, allowed_strands='FR', allowed_ccs2genome_cigars='IX=',
+                           stat_json=stat_json, min_np=1, max_np=2000, block_size=1000, nproc=nproc)
+            outs.append((load_fextract_npz(prefix + '.npz'), open(prefix + '.fextract.csv').read()))
+        (npz1, csv1), (npz3, csv3) = outs
+        assert csv1 == csv3
+        for a1, a3 in zip(npz1, npz3):
+            assert np.array_equal(a1, a3)
+
+
+def test_fextract2numpy_gzip():
+    """Converting gzip compressed fextract.csv must output the same as converting the uncompressed file."""
+    out_dir = op.join(ROOT_DIR, 'out', 'test_fextract2numpy_nproc')
+    if not op.exists(out_dir):
+        os.mkdir(out_dir)
+    in_csv = op.join(ROOT_DIR, 'data', 'tiny.fextract.csv')
+    gz_csv = op.join(out_dir, 'tiny.fextract.csv.gz')
+    with gzip.open(gz_csv, 'wb') as writer:
+        writer.write(open(in_csv, 'rb').read())
+    outs = []
+    for filename, nproc in [(in_csv, 1), (gz_csv, 1), (gz_csv, 2)]:
+        prefix = op.join(out_dir, 'gzip.{}.nproc{}'.format(op.basename(filename), nproc))
+        fextract2numpy(fextract_filename=filename, output_prefix=prefix, num_train_rows=0,
+                       min_dist2end=100, allowed_strands='FR', allowed_ccs2genome_cigars='IX=',
+                       stat_json=op.join(ROOT_DIR, 'data', 'fextract.stat.json'), min_np=1, max_np=2000,
+                       block_size=1000, nproc=nproc)
+        outs.append((load_fextract_npz(prefix + '.npz'), open(prefix + '.fextract.csv').read()))
+    npz1, csv1 = outs[0]
+    for npz2, csv2 in outs[1:]:
+        assert csv1 == csv2
+        for a1, a2 in zip(npz1, npz2):
+            assert np.array_equal(a1, a2)
+
+
+def test_fextract2numpy_multiple_files():
+    """Converting chunks of fextract.csv must output the same as converting the whole file."""
+    out_dir = op.join(ROOT_DIR, 'out', 'test_fextract2numpy_nproc')
+    if not op.exists(out_dir):
+        os.mkdir(out_dir)
+    in_csv = op.join(ROOT_DIR, 'data', 'tiny.fextract.csv')
+    stat_json = op.join(ROOT_DIR, 'data', 'fextract.stat.json')
+    lines = open(in_csv, 'r').readlines()
+    chunk_csvs = [op.join(out_dir, 'chunk-{}.fextract.csv'.format(idx)) for idx in range(3)]
+    for idx, chunk_csv in enumerate(chunk_csvs):
+        with open(chunk_csv, 'w') as writer:
+            writer.write(''.join([lines[0]] + lines[1:][idx::3]))
+    fofn = op.join(out_dir, 'chunks.fofn')
+    with open(fofn, 'w') as writer:
+        writer.write('\n'.join(chunk_csvs + [in_csv]))
+    concat_csv = op.join(out_dir, 'chunks.concat.fextract.csv')
+    with open(concat_csv, 'w') as writer:
+        writer.write(''.join([lines[0]] + [r for idx in range(3) for r in lines[1:][idx::3]] + lines[1:]))
+    for num_train_rows in [0, 5]:
+        expected_prefix = op.join(out_dir, 'chunks.concat.rows{}'.format(num_train_rows))
+        fextract2numpy(fextract_filename=concat_csv, output_prefix=expected_prefix, num_train_rows=num_train_rows,
+                       min_dist2end=100, allowed_strands='FR', allowed_ccs2genome_cigars='IX=',
+                       stat_json=stat_json, min_np=1, max_np=2000)
+        expected = load_fextract_npz(expected_prefix + '.npz')
+        for nproc in [1, 3]:
+            prefix = op.join(out_dir, 'chunks.nproc{}.rows{}'.format(nproc, num_train_rows))
+            fextract2numpy(fextract_filename=fofn, output_prefix=prefix, num_train_rows=num_train_rows,
+                           min_dist2end=100, allowed_strands='FR', allowed_ccs2genome_cigars='IX=',
+                           stat_json=stat_json, min_np=1, max_np=2000, block_size=1000, nproc=nproc)
+            assert open(prefix + '.fextract.csv').read() == open(expected_prefix + '.fextract.csv').read()
+            for a1, a2 in zip(expected, load_fextract_npz(prefix + '.npz')):
+                assert np.array_equal(a1, a2)
+
+    stat_jsons = []
+    for filename, nproc in [(concat_csv, 1), (fofn, 1), (fofn, 2)]:
+        stat_jsons.append(op.join(out_dir, 'chunks.{}.nproc{}.stat.json'.format(op.basename(filename), nproc)))
+        compute_feature_stats(in_csv=filename, out_stat_json=stat_jsons[-1], min_dist2end=100, allowed_strands='FR',
+                              allowed_ccs2genome_cigars='IX=', min_np=1, max_np=2000, nproc=nproc)
+    # Stats are merged in different orders, which are the same within float tolerance
+    stats = [json.load(open(stat_json))['BaseFeatureStat'] for stat_json in stat_jsons]
+    for other in stats[1:]:
+        assert [d['name'] for d in other] == [d['name'] for d in stats[0]]
+        for d1, d2 in zip(stats[0], other):
+            assert {k: d2[k] for k in ['mean', 'stdev', 'min', 'max']} == \
+                pytest.approx({k: d1[k] for k in ['mean', 'stdev', 'min', 'max']}, rel=1e-9, abs=1e-12)
+
+    # Glob patterns match chunks only, whose headers must be the same
+    glob_prefix = op.join(out_dir, 'chunks.glob')
+    fextract2numpy(fextract_filename=op.join(out_dir, 'chunk-*.fextract.csv'), output_prefix=glob_prefix,
+                   num_train_rows=0, min_dist2end=100, allowed_strands='FR', allowed_ccs2genome_cigars='IX=',
+                   stat_json=stat_json, min_np=1, max_np=2000)
+    with open(chunk_csvs[-1], 'w') as writer:
+        writer.write(lines[0].replace('CCSBaseSNR', 'SNR'))
+    with pytest.raises(ValueError, match='differs'):
+        fextract2numpy(fextract_filename=op.join(out_dir, 'chunk-*.fextract.csv'), output_prefix=glob_prefix,
+                       num_train_rows=0, min_dist2end=100, allowed_strands='FR', allowed_ccs2genome_cigars='IX=',
+                       stat_json=stat_json, min_np=1, max_np=2000)
+
+
+def test_fextract2numpy_reservoir():
+    """Reservoir samples must be subsets of good rows, and be the same regardless of nproc."""
+    out_dir = op.join(ROOT_DIR, 'out', 'test_fextract2numpy_nproc')
+    if not op.exists(out_dir):
+        os.mkdir(out_dir)
+    in_csv = op.join(ROOT_DIR, 'data', 'tiny.fextract.csv')
+    all_prefix = op.join(out_dir, 'reservoir.all')
+    fextract2numpy(fextract_filename=in_csv, output_prefix=all_prefix, num_train_rows=0,
+                   min_dist2end=10, allowed_strands='FR', allowed_ccs2genome_cigars='IX=',
+                   stat_json=None, min_np=1, max_np=2000)
+    all_rows = open(all_prefix + '.fextract.csv').readlines()
+    outs = []
+    for seed, nproc in [(0, 1), (0, 3), (1, 1)]:
+        prefix = op.join(out_dir, 'reservoir.seed{}.nproc{}'.format(seed, nproc))
+        fextract2numpy(fextract_filename=in_csv, output_prefix=prefix, num_train_rows=5,
+                       min_dist2end=10, allowed_strands='FR', allowed_ccs2genome_cigars='IX=',
+                       stat_json=None, min_np=1, max_np=2000, block_size=1000, nproc=nproc,
+                       sample='reservoir', seed=seed)
+        rows = open(prefix + '.fextract.csv').readlines()
+        assert len(rows) == 6
+        # Sampled rows are in the input order
+        indices = [all_rows.index(r) for r in rows[1:]]
+        assert indices == sorted(indices)
+        fextractinput = load_fextract_npz(prefix + '.npz')[0]
+        assert np.array_equal(fextractinput, load_fextract_npz(all_prefix + '.npz')[0][np.array(indices) - 1])
+        outs.append(rows)
+    assert outs[0] == outs[1]
+    assert outs[0] != outs[2]
+    with pytest.raises(ValueError):
+        fextract2numpy(fextract_filename=in_csv, output_prefix=prefix, num_train_rows=0,
+                       min_dist2end=10, allowed_strands='FR', allowed_ccs2genome_cigars='IX=',
+                       stat_json=None, min_np=1, max_np=2000, sample='reservoir')
+
+
+def test_fextract2numpy_collapse_duplicates():
+    """Unique rows repeated by their counts must be the same rows as those of the uncollapsed output."""
+    out_dir = op.join(ROOT_DIR, 'out', 'test_fextract2numpy_nproc')
+    if not op.exists(out_dir):
+        os.mkdir(out_dir)
+    in_csv = op.join(ROOT_DIR, 'data', 'tiny.fextract.csv')
+    outs = []
+    for collapse_duplicates in [False, True]:
+        prefix = op.join(out_dir, 'collapse.{}'.format(collapse_duplicates))
+        fextract2numpy(fextract_filename=in_csv, output_prefix=prefix, num_train_rows=0,
+                       min_dist2end=10, allowed_strands='FR', allowed_ccs2genome_cigars='IX=',
+                       stat_json=None, min_np=1, max_np=2000, block_size=1000,
+                       collapse_duplicates=collapse_duplicates)
+        fextractinput, _, _, cigars, _, _ = load_fextract_npz(prefix + '.npz')
+        counts = load_fextract_counts(prefix + '.npz')
+        assert (counts is None) != collapse_duplicates
+        if counts is not None:
+            fextractinput, cigars = np.repeat(fextractinput, counts, axis=0), np.repeat(cigars, counts, axis=0)
+        outs.append(sorted(map(tuple, np.concatenate([fextractinput, cigars], axis=1).tolist())))
+    assert outs[0] == outs[1]
+
+
+def test_fextract2numpy_class_quotas():
+    """Stratified samples must keep at most a quota of rows of each class, and record sampling rates."""
+    out_dir = op.join(ROOT_DIR, 'out', 'test_fextract2numpy_nproc')
+    if not op.exists(out_dir):
+        os.mkdir(out_dir)
+    in_csv = op.join(ROOT_DIR, 'data', 'tiny.fextract.csv')
+    all_prefix = op.join(out_dir, 'quotas.all')
+    fextract2numpy(fextract_filename=in_csv, output_prefix=all_prefix, num_train_rows=0,
+                   min_dist2end=10, allowed_strands='FR', allowed_ccs2genome_cigars='IX=',
+                   stat_json=None, min_np=1, max_np=2000)
+    all_counts = np.count_nonzero(load_fextract_npz(all_prefix + '.npz')[3], axis=0)
+    quotas = [2, 1, 1, 100]
+    outs = []
+    for sample, nproc in [('reservoir', 1), ('reservoir', 3), ('first', 1)]:
+        prefix = op.join(out_dir, 'quotas.{}.nproc{}'.format(sample, nproc))
+        fextract2numpy(fextract_filename=in_csv, output_prefix=prefix, num_train_rows=0,
+                       min_dist2end=10, allowed_strands='FR', allowed_ccs2genome_cigars='IX=',
+                       stat_json=None, min_np=1, max_np=2000, block_size=1000, nproc=nproc,
+                       sample=sample, class_quotas=quotas)
+        counts = np.count_nonzero(load_fextract_npz(prefix + '.npz')[3], axis=0)
+        assert list(counts) == list(np.minimum(quotas, all_counts))
+        d = json.load(open(prefix + '.base_map_probability.json'))['BaseMapProbability']
+        assert d['Sampling']['SequenceMatch'] == counts[0] / counts.sum()
+        assert d['SamplingRate']['SequenceMatch'] == counts[0] / all_counts[0]
+        assert d['SamplingRate']['PreviousIsDeletion'] == 1.0
+        outs.append(open(prefix + '.fextract.csv').read())
+    assert outs[0] == outs[1]
+    # The first rows of each class
+    first_rows = open(all_prefix + '.fextract.csv').readlines()
+    assert outs[2].splitlines(True)[1] == first_rows[1]
+
+    assert parse_class_quotas('=:10,I:5,X:5,D:1') == [10, 5, 5, 1]
+    assert class_quotas_from_ratios(parse_class_quotas('=:2,I:1,X:1,D:1', float), 100) == [40, 20, 20, 20]
+    for s in ['=:10,I:5,X:5', '=:10,I:5,X:5,D:0', '=:10,I:5,X:5,Y:1']:
+        with pytest.raises(ValueError):
+            parse_class_quotas(s)
+
+
+def test_fextract2numpy_raw_rows_index():
+    """A row index of kept rows must stream the same rows as the copied raw rows."""
+    out_dir = op.join(ROOT_DIR, 'out', 'test_fextract2numpy_nproc')
+    if not op.exists(out_dir):
+        os.mkdir(out_dir)
+    in_csv = op.join(ROOT_DIR, 'data', 'tiny.fextract.csv')
+    for num_train_rows, nproc in [(0, 1), (3, 1), (3, 3)]:
+        outs = []
+        for raw_rows in ['csv', 'index']:
+            prefix = op.join(out_dir, 'raw_rows_{}.nproc{}.rows{}'.format(raw_rows, nproc, num_train_rows))
+            fextract2numpy(fextract_filename=in_csv, output_prefix=prefix, num_train_rows=num_train_rows,
+                           min_dist2end=10, allowed_strands='FR', allowed_ccs2genome_cigars='IX=',
+                           stat_json=None, min_np=1, max_np=2000, block_size=1000, nproc=nproc, raw_rows=raw_rows)
+            outs.append(prefix)
+        csv_prefix, index_prefix = outs
+        assert not op.exists(index_prefix + '.fextract.csv')
+        assert ''.join(iter_lines(index_prefix + '.rows.idx')) == open(csv_prefix + '.fextract.csv').read()
+
+
+def test_fextract2numpy_shards():
+    """Sharded output must have the same rows as unsharded output."""
+    out_dir = op.join(ROOT_DIR, 'out', 'test_fextract2numpy_nproc')
+    if not op.exists(out_dir):
+        os.mkdir(out_dir)
+    in_csv = op.join(ROOT_DIR, 'data', 'tiny.fextract.csv')
+    stat_json = op.join(ROOT_DIR, 'data', 'fextract.stat.json')
+    for shard_rows in [0, 4]:
+        fextract2numpy(fextract_filename=in_csv, output_prefix=op.join(out_dir, 'shards{}'.format(shard_rows)),
+                       num_train_rows=0, min_dist2end=10, allowed_strands='FR', allowed_ccs2genome_cigars='IX=',
+                       stat_json=stat_json, min_np=1, max_np=2000, block_size=1000, shard_rows=shard_rows)
+    manifest = json.load(open(op.join(out_dir, 'shards4.shards', 'manifest.json')))
+    assert [shard['num_rows'] for shard in manifest['shards']] == [4, 4, 1]
+    assert manifest['OrderedFeatures'] == json.load(open(op.join(out_dir, 'shards4.features.order.json')))['OrderedFeatures']
+    assert manifest['stat_json_sha1'] is not None
+    for a1, a2 in zip(load_fextract_npz(op.join(out_dir, 'shards0.npz')),
+                      load_fextract_npz(op.join(out_dir, 'shards4.shards'))):
+        assert np.array_equal(a1, a2)
+
+
+def test_base_map_counter():
+    """Base map counts of strata must add up to total counts, which are the same as counting one-hot cigars."""
+    data = np.zeros(6, dtype=[('ArrowQv', np.float32), ('CCSHPLength', np.int64), ('CCSToGenomeStrand', 'S1')])
+    data['ArrowQv'] = [3, 15, 93, 0, 71, 15]
+    data['CCSHPLength'] = [1, 2, 12, 1, 10, 2]
+    data['CCSToGenomeStrand'] = [b'F', b'R', b'F', b'?', b'R', b'F']
+    cigars, _ = encode_cigars_block(np.array([b'=', b'I', b'X', b'=', b'=', b'I']), np.array([0, 0, 0, 1, 0, 0]))
+    counter = BaseMapCounter(['ArrowQv', 'CCSHPLength', 'CCSToGenomeStrand'])
+    for start, end in [(0, 2), (2, 2), (2, 6)]:
+        counter.update(cigars[start:end], strata_codes(counter.strata, data[start:end]))
+    assert list(counter.counts) == list(np.count_nonzero(cigars, axis=0)) == [2, 2, 1, 1]
+    tables = counter.strata_tables()
+    assert {level: list(c) for level, c in tables['ArrowQv'].items()} == \
+        {'0-9': [1, 0, 0, 1], '10-19': [0, 2, 0, 0], '70+': [1, 0, 1, 0]}
+    assert {level: list(c) for level, c in tables['CCSHPLength'].items()} == \
+        {'1': [1, 0, 0, 1], '2': [0, 2, 0, 0], '10+': [1, 0, 1, 0]}
+    assert {level: list(c) for level, c in tables['CCSToGenomeStrand'].items()} == \
+        {'F': [1, 1, 1, 0], 'R': [1, 1, 0, 0], '*': [0, 0, 0, 1]}
+
+
+def test_fextract2numpy_base_map_strata():
+    """Base map probabilities of strata must be written next to Sampling, which is the same as without strata."""
+    out_dir = op.join(ROOT_DIR, 'out', 'test_fextract2numpy_nproc')
+    if not op.exists(out_dir):
+        os.mkdir(out_dir)
+    in_csv = op.join(ROOT_DIR, 'data', 'tiny.fextract.csv')
+    outs = []
+    for strata, nproc in [(None, 1), (['ArrowQv', 'CCSToGenomeStrand'], 1), (['ArrowQv', 'CCSToGenomeStrand'], 2)]:
+        prefix = op.join(out_dir, 'strata.{}.{}'.format(strata is not None, nproc))
+        fextract2numpy(fextract_filename=in_csv, output_prefix=prefix, num_train_rows=7, min_dist2end=10,
+                       allowed_strands='FR', allowed_ccs2genome_cigars='IX=', stat_json=None, min_np=1, max_np=2000,
+                       block_size=1000, nproc=nproc, base_map_strata=strata)
+        outs.append(json.load(open(prefix + '.base_map_probability.json'))['BaseMapProbability'])
+    assert 'SamplingStrata' not in outs[0]
+    assert outs[1]['Sampling'] == outs[0]['Sampling'] and outs[1] == outs[2]
+    for table in outs[1]['SamplingStrata'].values():
+        assert sum([level['Count'] for level in table.values()]) == 7
+
+    """Appended shards must hold new rows after existing shards, which are not rewritten."""
+    out_dir = op.join(ROOT_DIR, 'out', 'test_fextract2numpy_nproc')
+    if not op.exists(out_dir):
+        os.mkdir(out_dir)
+    in_csv = op.join(ROOT_DIR, 'data', 'tiny.fextract.csv')
+    stat_json = op.join(ROOT_DIR, 'data', 'fextract.stat.json')
+    prefix = op.join(out_dir, 'append')
+    kwargs = dict(fextract_filename=in_csv, output_prefix=prefix, num_train_rows=0, min_dist2end=10,
+                  allowed_strands='FR', allowed_ccs2genome_cigars='IX=', min_np=1, max_np=2000, shard_rows=4)
+    fextract2numpy(stat_json=stat_json, **kwargs)
+    first_shard = op.join(prefix + '.shards', 'shard-00000.npz')
+    mtime = os.stat(first_shard).st_mtime_ns
+    rows = open(prefix + '.fextract.csv').readlines()
+    base_map_prob = json.load(open(prefix + '.base_map_probability.json'))
+    once = load_fextract_npz(prefix + '.shards')
+    fextract2numpy(stat_json=stat_json, append=True, **kwargs)
+    manifest = json.load(open(op.join(prefix + '.shards', 'manifest.json')))
+    assert [shard['num_rows'] for shard in manifest['shards']] == [4, 4, 1, 4, 4, 1]
+    assert manifest['num_rows'] == 18 and os.stat(first_shard).st_mtime_ns == mtime
+    twice = load_fextract_npz(prefix + '.shards')
+    for a1, a2 in zip(once[:4], twice[:4]):
+        assert np.array_equal(np.concatenate([a1, a1]), a2)
+    assert open(prefix + '.fextract.csv').readlines() == rows + rows[1:]
+    assert json.load(open(prefix + '.base_map_probability.json')) == base_map_prob
+    # Rows standardized by a different stat json could not be appended
+    with pytest.raises(ValueError):
+        fextract2numpy(stat_json=None, append=True, **kwargs)
+    with pytest.raises(ValueError):
+        fextract2numpy(stat_json=stat_json, append=True, feature_dtype='float16', **kwargs)
+    assert json.load(open(op.join(prefix + '.shards', 'manifest.json'))) == manifest
+    assert len(open(prefix + '.fextract.csv').readlines()) == 19
+
+
+def test_fextract2numpy_feature_dtype():
+    """Quantized features must be dequantized close to float32 features."""
+    out_dir = op.join(ROOT_DIR, 'out', 'test_fextract2numpy_nproc')
+    if not op.exists(out_dir):
+        os.mkdir(out_dir)
+    in_csv = op.join(ROOT_DIR, 'data', 'tiny.fextract.csv')
+    stat_json = op.join(ROOT_DIR, 'data', 'fextract.stat.json')
+    outs = {}
+    for feature_dtype, output_format in [('float32', 'npz'), ('float16', 'npz'), ('int8', 'npz'), ('int8', 'chunked')]:
+        prefix = op.join(out_dir, 'dtype_{}.{}'.format(feature_dtype, output_format))
+        fextract2numpy(fextract_filename=in_csv, output_prefix=prefix, num_train_rows=0, min_dist2end=10,
+                       allowed_strands='FR', allowed_ccs2genome_cigars='IX=', stat_json=stat_json, min_np=1,
+                       max_np=2000, output_format=output_format, feature_dtype=feature_dtype)
+        outs[(feature_dtype, output_format)] = load_fextract_npz(prefix + '.' + output_format)[0]
+        if feature_dtype != 'float32':
+            report = json.load(open(prefix + '.quantization.json'))
+            assert report['dtype'] == feature_dtype
+    x = outs[('float32', 'npz')]
+    for key, y in outs.items():
+        assert y.dtype == np.float32
+        assert np.allclose(x, y, atol=4.0 / 254 + 1e-6, equal_nan=True)
+    assert np.array_equal(outs[('int8', 'npz')], outs[('int8', 'chunked')], equal_nan=True)
+    assert np.dtype(np.load(op.join(out_dir, 'dtype_int8.npz.npz'))['fextractinput'].dtype) == np.int8
+
+
+def test_feature_stat_accumulator():
+    rng = np.random.RandomState(0)
+    a = rng.normal(1e4, 3.0, (1000, 3))
+    stats = FeatureStatAccumulator(['F1', 'F2', 'F3'])
+    for start, end in [(0, 1), (1, 1), (1, 400), (400, 1000)]:
+        stats.update(a[start:end])
+    assert stats.count == 1000
+    assert np.allclose(stats.mean, a.mean(axis=0), rtol=1e-12)
+    assert np.allclose(stats.stdev, a.std(axis=0), rtol=1e-9)
+    assert np.array_equal(stats.min, a.min(axis=0))
+    assert np.array_equal(stats.max, a.max(axis=0))
+
+
+def test_merge_stats():
+    """Merged stats of partial stat files must be the same as stats of all rows."""
+    out_dir = op.join(ROOT_DIR, 'out', 'test_fextract2stat')
+    if not op.exists(out_dir):
+        os.mkdir(out_dir)
+    rng = np.random.RandomState(0)
+    a = rng.normal(1e4, 3.0, (1000, 3))
+    partial_jsons = []
+    for idx, (start, end) in enumerate([(0, 1), (1, 400), (400, 1000)]):
+        stats = FeatureStatAccumulator(['F1', 'F2', 'F3'])
+        stats.update(a[start:end])
+        partial_jsons.append(op.join(out_dir, 'partial{}.stat.json'.format(idx)))
+        stats.write_json(partial_jsons[-1])
+    merged_json = op.join(out_dir, 'merged.stat.json')
+    merge_stat_jsons(partial_jsons, merged_json)
+    merged = FeatureStatAccumulator.from_json(merged_json)
+    assert merged.count == 1000 and merged.features == ['F1', 'F2', 'F3']
+    assert np.allclose(merged.mean, a.mean(axis=0), rtol=1e-12)
+    assert np.allclose(merged.stdev, a.std(axis=0), rtol=1e-9)
+    assert np.array_equal(merged.min, a.min(axis=0)) and np.array_equal(merged.max, a.max(axis=0))
+    stat_d, _ = load_fextract_stat_json(merged_json)
+    assert stat_d['F2'].stdev == pytest.approx(a[:, 1].std(), rel=1e-9)
+    # Stat files without count and m2 could not be merged
+    with pytest.raises(ValueError):
+        merge_stat_jsons([merged_json, op.join(ROOT_DIR, 'data', 'fextract.stat.json')], merged_json)
+
+    # Stats of byte ranges computed by multiple processes are the same as stats of a single pass
+    in_csv = op.join(ROOT_DIR, 'data', 'tiny.fextract.csv')
+    outs = []
+    for nproc in [1, 3]:
+        out_json = op.join(out_dir, 'tiny.nproc{}.stat.json'.format(nproc))
+        compute_feature_stats(in_csv=in_csv, out_stat_json=out_json, min_dist2end=10, allowed_strands='FR',
+                              allowed_ccs2genome_cigars='IX=', min_np=1, max_np=2000, nproc=nproc, block_size=1000)
+        outs.append(FeatureStatAccumulator.from_json(out_json))
+    assert outs[0].count == outs[1].count > 0
+    assert np.allclose(outs[0].mean, outs[1].mean) and np.allclose(outs[0].m2, outs[1].m2)
+    assert np.array_equal(outs[0].min, outs[1].min) and np.array_equal(outs[0].max, outs[1].max)
+
+
+def test_fextract2stat_sample():
+    """Stats estimated from sampled chunks must report standard errors, and read all rows given fraction 1."""
+    out_dir = op.join(ROOT_DIR, 'out', 'test_fextract2stat')
+    if not op.exists(out_dir):
+        os.mkdir(out_dir)
+    in_csv = op.join(ROOT_DIR, 'data', 'tiny.fextract.csv')
+    filter_args = dict(min_dist2end=10, allowed_strands='FR', allowed_ccs2genome_cigars='IX=', min_np=1, max_np=2000)
+    full_json = op.join(out_dir, 'tiny.full.stat.json')
+    compute_feature_stats(in_csv=in_csv, out_stat_json=full_json, **filter_args)
+    full = FeatureStatAccumulator.from_json(full_json)
+
+    all_json = op.join(out_dir, 'tiny.sample_all.stat.json')
+    compute_feature_stats(in_csv=in_csv, out_stat_json=all_json, sample_fraction=1.0, sample_chunk_size=1000,
+                          **filter_args)
+    items = json.load(open(all_json))['BaseFeatureStat']
+    assert all([item['count'] == full.count and item['sample_fraction'] == 1.0 for item in items])
+    assert all([item['mean_stderr'] == 0 and item['stdev_stderr'] == 0 for item in items])
+    stat_d, _ = load_fextract_stat_json(all_json)
+    for feature, mean in zip(full.features, full.mean):
+        assert stat_d[feature].mean == pytest.approx(mean, rel=1e-9, abs=1e-12)
+    with pytest.raises(ValueError):  # Sampled stats could not be merged
+        merge_stat_jsons([all_json], op.join(out_dir, 'tiny.merged.stat.json'))
+
+    outs = []
+    for seed in [0, 0, 1]:
+        out_json = op.join(out_dir, 'tiny.sample{}.stat.json'.format(len(outs)))
+        compute_feature_stats(in_csv=in_csv, out_stat_json=out_json, sample_fraction=0.5, seed=seed,
+                              sample_chunk_size=1000, **filter_args)
+        outs.append(json.load(open(out_json))['BaseFeatureStat'])
+    assert outs[0] == outs[1]
+    assert all([0 < item['sample_fraction'] < 1 and item['count'] < full.count for item in outs[0]])
+    assert any([item['mean_stderr'] > 0 for item in outs[0]])
+
+    compute_feature_stats(in_csv=in_csv, out_stat_json=out_json, max_rows=1, sample_chunk_size=1000, **filter_args)
+    assert 1 <= json.load(open(out_json))['BaseFeatureStat'][0]['count'] < full.count
+    gz_csv = op.join(out_dir, 'tiny.fextract.csv.gz')
+    with open(in_csv, 'rb') as reader, gzip.open(gz_csv, 'wb') as writer:
+        writer.write(reader.read())
+    with pytest.raises(ValueError):
+        compute_feature_stats(in_csv=gz_csv, out_stat_json=out_json, sample_fraction=0.5, **filter_args)
+
+
+def test_fextract2stat_update():
+    """Updating stats of old rows by new rows must be the same as stats of all rows, and bump the version."""
+    out_dir = op.join(ROOT_DIR, 'out', 'test_fextract2stat')
+    if not op.exists(out_dir):
+        os.mkdir(out_dir)
+    in_csv = op.join(ROOT_DIR, 'data', 'tiny.fextract.csv')
+    filter_args = dict(min_dist2end=10, allowed_strands='FR', allowed_ccs2genome_cigars='IX=', min_np=1, max_np=2000)
+    lines = open(in_csv).readlines()
+    old_csv, new_csv = op.join(out_dir, 'old.fextract.csv'), op.join(out_dir, 'new.fextract.csv')
+    open(old_csv, 'w').write(''.join(lines[:5]))
+    open(new_csv, 'w').write(''.join(lines[:1] + lines[5:]))
+    full_json, stat_json = op.join(out_dir, 'full.stat.json'), op.join(out_dir, 'growing.stat.json')
+    compute_feature_stats(in_csv=in_csv, out_stat_json=full_json, **filter_args)
+    compute_feature_stats(in_csv=old_csv, out_stat_json=stat_json, **filter_args)
+    prefix = op.join(out_dir, 'growing')
+    fextract2numpy(fextract_filename=old_csv, output_prefix=prefix, num_train_rows=0, stat_json=stat_json,
+                   **filter_args)
+    assert check_dataset_stat_version(prefix + '.npz', stat_json) == 1
+
+    compute_feature_stats(in_csv=new_csv, out_stat_json=stat_json, update=True, **filter_args)
+    full, updated = FeatureStatAccumulator.from_json(full_json), FeatureStatAccumulator.from_json(stat_json)
+    assert updated.count == full.count and updated.version == 2
+    assert [(item['version'], item['source']) for item in updated.history] == [(1, old_csv), (2, new_csv)]
+    assert np.allclose(updated.mean, full.mean) and np.allclose(updated.m2, full.m2)
+    assert np.array_equal(updated.min, full.min) and np.array_equal(updated.sketch.counts, full.sketch.counts)
+    # The dataset standardized with version 1 is detected
+    with pytest.raises(ValueError):
+        check_dataset_stat_version(prefix + '.npz', stat_json)
+    fextract2numpy(fextract_filename=new_csv, output_prefix=prefix, num_train_rows=0, stat_json=stat_json,
+                   output_format='npydir', shard_rows=2, **filter_args)
+    assert check_dataset_stat_version(prefix + '.shards', stat_json) == 2
+    # Rows of the same file could not be folded twice
+    with pytest.raises(ValueError):
+        compute_feature_stats(in_csv=new_csv, out_stat_json=stat_json, update=True, **filter_args)
+    assert FeatureStatAccumulator.from_json(stat_json).version == 2
+    with pytest.raises(ValueError):
+        compute_feature_stats(in_csv=new_csv, out_stat_json=op.join(out_dir, 'missing.stat.json'), update=True,
+                              **filter_args)
+
+
+def test_fextract2statnumpy():
+    """Single-pass stat + conversion must output the same as fextract2stat followed by fextract2numpy."""
+    out_dir = op.join(ROOT_DIR, 'out', 'test_fextract2statnumpy')
+    if not op.exists(out_dir):
+        os.mkdir(out_dir)
+    in_csv = op.join(ROOT_DIR, 'data', 'tiny.fextract.csv')
+    filter_args = dict(min_dist2end=10, allowed_strands='FR', allowed_ccs2genome_cigars='IX=', min_np=1, max_np=2000)
+    for num_train_rows in [0, 3]:
+        two_pass_prefix = op.join(out_dir, 'two_pass.rows{}'.format(num_train_rows))
+        compute_feature_stats(in_csv=in_csv, out_stat_json=two_pass_prefix + '.stat.json', **filter_args)
+        fextract2numpy(fextract_filename=in_csv, output_prefix=two_pass_prefix, num_train_rows=num_train_rows,
+                       stat_json=two_pass_prefix + '.stat.json', **filter_args)
+        one_pass_prefix = op.join(out_dir, 'one_pass.rows{}'.format(num_train_rows))
+        fextract2statnumpy(fextract_filename=in_csv, output_prefix=one_pass_prefix,
+                           out_stat_json=one_pass_prefix + '.stat.json', num_train_rows=num_train_rows,
+                           block_size=1000, **filter_args)
+
+        for suffix in ['.fextract.csv', '.features.order.json', '.base_map_probability.json']:
+            assert open(one_pass_prefix + suffix).read() == open(two_pass_prefix + suffix).read()
+        two_pass_stat, features = load_fextract_stat_json(two_pass_prefix + '.stat.json')
+        one_pass_stat, _ = load_fextract_stat_json(one_pass_prefix + '.stat.json')
+        for feature in features:
+            for name in ['mean', 'stdev', 'min', 'max']:
+                assert getattr(one_pass_stat[feature], name) == pytest.approx(
+                    getattr(two_pass_stat[feature], name), rel=1e-5, abs=1e-5)
+            assert one_pass_stat[feature].quantiles == two_pass_stat[feature].quantiles
+        for a1, a2 in zip(load_fextract_npz(one_pass_prefix + '.npz'), load_fextract_npz(two_pass_prefix + '.npz')):
+            assert np.allclose(a1, a2, rtol=1e-4, atol=1e-4, equal_nan=True)
+        assert not any([f.endswith('.spool') for f in os.listdir(out_dir)])
+
+
+def test_fextract2numpy_clip_quantiles():
+    """Features clipped at quantiles of stat json must be within standardized q0.1 and q99.9."""
+    out_dir = op.join(ROOT_DIR, 'out', 'test_fextract2stat')
+    if not op.exists(out_dir):
+        os.mkdir(out_dir)
+    in_csv = op.join(ROOT_DIR, 'data', 'tiny.fextract.csv')
+    filter_args = dict(min_dist2end=10, allowed_strands='FR', allowed_ccs2genome_cigars='IX=', min_np=1, max_np=2000)
+    prefix = op.join(out_dir, 'clip_quantiles')
+    compute_feature_stats(in_csv=in_csv, out_stat_json=prefix + '.stat.json', **filter_args)
+    stat_d, features = load_fextract_stat_json(prefix + '.stat.json')
+    for stat in stat_d.values():
+        assert stat.min <= stat.quantiles['q001'] <= stat.quantiles['q50'] <= stat.quantiles['q999'] <= stat.max
+    fextract2numpy(fextract_filename=in_csv, output_prefix=prefix, num_train_rows=0, stat_json=prefix + '.stat.json',
+                   clip_quantiles=True, **filter_args)
+    fextractinput = load_fextract_npz(prefix + '.npz')[0]
+    out_features = json.load(open(prefix + '.features.order.json'))['OrderedFeatures']
+    for feature in features:
+        stat = stat_d[feature]
+        if stat.stdev > 0 and feature in out_features:
+            col = fextractinput[:, out_features.index(feature)]
+            assert np.all(col >= (stat.quantiles['q001'] - stat.mean) / stat.stdev - 1e-5)
+            assert np.all(col <= (stat.quantiles['q999'] - stat.mean) / stat.stdev + 1e-5)
+    with pytest.raises(ValueError):
+        fextract2numpy(fextract_filename=in_csv, output_prefix=prefix, num_train_rows=0, stat_json=None,
+                       clip_quantiles=True, **filter_args)
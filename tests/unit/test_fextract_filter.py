@@ -0,0 +1,41 @@
+import csv
+import os.path as op
+import pytest
+import numpy as np
+from tfccs.fextract_reader import FextractReader
+from tfccs.fextract_filter import RowFilter, Predicate
+from tfccs.utils import is_good_fextract_row
+
+ROOT_DIR = op.dirname(op.dirname(__file__))
+DATA_DIR = op.join(ROOT_DIR, 'data')
+
+
+def test_predicate():
+    p = Predicate.from_string('CCSHPLength <= 8')
+    assert (p.column, p.op, p.value) == ('CCSHPLength', '<=', '8')
+    p = Predicate.from_string('CCSToGenomeCigar===')
+    assert (p.column, p.op, p.value) == ('CCSToGenomeCigar', '==', '=')
+    with pytest.raises(ValueError):
+        Predicate.from_string('CCSHPLength ~ 8')
+
+    data = np.array([(1.0, b'X'), (9.0, b'=')], dtype=[('CCSHPLength', np.float32), ('CCSToGenomeCigar', 'S8')])
+    assert Predicate.from_string('CCSHPLength<=8').mask(data).tolist() == [True, False]
+    assert Predicate.from_string('CCSToGenomeCigar!=X').mask(data).tolist() == [False, True]
+    with pytest.raises(ValueError):
+        Predicate.from_string('CCSHPLength<=X').mask(data)
+
+
+def test_row_filter():
+    in_csv = op.join(DATA_DIR, 'tiny.fextract.csv')
+    rows = [r for r in csv.DictReader(open(in_csv, 'r'), delimiter=',')]
+    row_filter = RowFilter(min_dist2end=10, allowed_strands='FR', allowed_ccs2genome_cigars='IX=',
+                           predicates=['CCSHPLength<=2', 'CCSBaseSNR > 5'])
+    reader = FextractReader(in_csv, columns=row_filter.columns(list(rows[0].keys())))
+    assert 'CCSHPLength' in reader.columns and 'Movie' not in reader.columns
+    mask = np.concatenate([row_filter.mask(block.data) for block in reader])
+    expected = [is_good_fextract_row(r, min_dist2end=10, allowed_strands='FR', allowed_ccs2genome_cigars='IX=') and
+                float(r['CCSHPLength']) <= 2 and float(r['CCSBaseSNR']) > 5 for r in rows]
+    assert mask.tolist() == expected
+
+    with pytest.raises(ValueError):
+        RowFilter(predicates=['NoSuchColumn<1']).columns(list(rows[0].keys()))
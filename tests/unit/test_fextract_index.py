@@ -0,0 +1,71 @@
+import os
+import os.path as op
+import pytest
+from tfccs.fextract_index import build_row_index, FextractIndex, RowIndexWriter, iter_lines
+from tfccs.utils import read_rows_of_indices
+
+ROOT_DIR = op.dirname(op.dirname(__file__))
+OUT_DIR = op.join(ROOT_DIR, 'out', 'test_fextract_index')
+
+
+def scan_rows_of_indices(filename, indices):
+    return [row for idx, row in enumerate(open(filename, 'r')) if idx in set(indices)]
+
+
+def test_row_index():
+    if not op.exists(OUT_DIR):
+        os.makedirs(OUT_DIR)
+    in_csv = op.join(ROOT_DIR, 'data', 'tiny.fextract.csv')
+    lines = open(in_csv, 'r').readlines()
+    index_filename = op.join(OUT_DIR, 'tiny.fextract.csv.idx')
+    row_index = build_row_index(in_csv, index_filename=index_filename, block_size=1000)
+    assert len(row_index) == len(lines) - 1
+    assert row_index.read_rows([3, 0, 8, 3]) == [lines[4], lines[1], lines[9], lines[4]]
+    with pytest.raises(ValueError):
+        row_index.read_rows([len(lines)])
+
+    indices = [0, 2, 3, 7, len(lines) - 1, len(lines) + 5]
+    assert read_rows_of_indices(in_csv, indices, index_filename=index_filename) == \
+        scan_rows_of_indices(in_csv, indices)
+
+
+def test_row_index_empty_lines():
+    if not op.exists(OUT_DIR):
+        os.makedirs(OUT_DIR)
+    in_csv = op.join(OUT_DIR, 'empty_lines.csv')
+    with open(in_csv, 'w') as writer:
+        writer.write('A,B\n1,2\n\n3,4\r\n\r\n5,6')
+    row_index = build_row_index(in_csv, block_size=3)
+    assert (row_index.num_rows, row_index.num_lines) == (3, 5)
+    assert row_index.read_rows([0, 1, 2]) == ['1,2\n', '3,4\r\n', '5,6']
+    # Line indices differ from row indices, fall back to scanning
+    assert read_rows_of_indices(in_csv, [0, 3]) == ['A,B\n', '3,4\n']
+
+    # Index is out of date once the file changes
+    with open(in_csv, 'a') as writer:
+        writer.write('\n7,8\n')
+    assert FextractIndex.find(in_csv) is None
+    with pytest.raises(ValueError):
+        FextractIndex(in_csv + '.idx', in_csv)
+
+
+def test_row_index_writer():
+    if not op.exists(OUT_DIR):
+        os.makedirs(OUT_DIR)
+    in_csv = op.join(OUT_DIR, 'sparse_rows.csv')
+    with open(in_csv, 'w') as writer:
+        writer.write('A,B\n1,2\n33,44\n\n5,6\n7,8')
+    index_filename = op.join(OUT_DIR, 'sparse_rows.rows.idx')
+    # Index the 1st and the 3rd rows only
+    with RowIndexWriter(index_filename, in_csv) as writer:
+        writer.write([4], [8])
+        writer.write([], [])
+        writer.write([15], [19])
+        with pytest.raises(ValueError):
+            writer.write([4], [8])
+    row_index = FextractIndex(index_filename)
+    assert (row_index.num_rows, row_index.num_lines) == (2, None)
+    assert row_index.read_rows([1, 0]) == ['5,6\n', '1,2\n']
+    assert list(iter_lines(index_filename)) == ['A,B\n', '1,2\n', '5,6\n']
+    assert list(iter_lines(in_csv)) == open(in_csv, 'r').readlines()
+    assert not op.exists(index_filename + '.spool')
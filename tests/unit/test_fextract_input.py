@@ -0,0 +1,77 @@
+import gzip
+import io
+import os
+import os.path as op
+import struct
+import sys
+import zlib
+import numpy as np
+import pytest
+from tfccs.fextract_reader import FextractReader, read_header
+from tfccs.fextract_input import open_fextract, is_seekable_input, STDIN
+
+ROOT_DIR = op.dirname(op.dirname(__file__))
+DATA_DIR = op.join(ROOT_DIR, 'data')
+
+
+def write_bgzf(data, out_filename, block_size):
+    """Write data as bgzip blocks of block_size uncompressed bytes, followed by the empty EOF block"""
+    with open(out_filename, 'wb') as writer:
+        for start in list(range(0, len(data), block_size)) + [len(data)]:
+            raw = data[start:start + block_size]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+            cdata = compressor.compress(raw) + compressor.flush()
+            writer.write(b'\x1f\x8b\x08\x04' + b'\0' * 4 + b'\0\xff' + struct.pack('<H', 6) + b'BC' +
+                         struct.pack('<HH', 2, len(cdata) + 25) + cdata +
+                         struct.pack('<II', zlib.crc32(raw), len(raw)))
+
+
+def make_inputs(out_dir):
+    in_csv = op.join(DATA_DIR, 'tiny.fextract.csv')
+    data = open(in_csv, 'rb').read()
+    if not op.exists(out_dir):
+        os.makedirs(out_dir)
+    gz_csv, bgzf_csv = op.join(out_dir, 'tiny.fextract.csv.gz'), op.join(out_dir, 'tiny.bgzf.fextract.csv.gz')
+    with gzip.open(gz_csv, 'wb') as writer:
+        writer.write(data)
+    write_bgzf(data, bgzf_csv, block_size=777)
+    return in_csv, gz_csv, bgzf_csv
+
+
+def test_open_fextract():
+    in_csv, gz_csv, bgzf_csv = make_inputs(op.join(ROOT_DIR, 'out', 'test_fextract_input'))
+    data = open(in_csv, 'rb').read()
+    for filename in [gz_csv, bgzf_csv]:
+        for nthreads in [1, 3]:
+            with open_fextract(filename, nthreads=nthreads) as reader:
+                assert reader.read() == data
+        assert read_header(filename) == read_header(in_csv)
+        assert not is_seekable_input(filename)
+    assert is_seekable_input(in_csv)
+
+
+def test_fextract_reader_compressed():
+    in_csv, gz_csv, bgzf_csv = make_inputs(op.join(ROOT_DIR, 'out', 'test_fextract_input'))
+    expected = np.concatenate([block.data for block in FextractReader(in_csv, block_size=1000)])
+    for filename in [gz_csv, bgzf_csv]:
+        reader = FextractReader(filename, block_size=1000, nthreads=2)
+        # Compressed files can be read more than once
+        for _ in range(2):
+            blocks = [block for block in reader]
+            assert len(blocks) > 1
+            assert np.concatenate([block.data for block in blocks]).tobytes() == expected.tobytes()
+        with pytest.raises(ValueError):
+            reader.byte_ranges(2)
+
+
+def test_fextract_reader_stdin(monkeypatch):
+    in_csv, gz_csv, _ = make_inputs(op.join(ROOT_DIR, 'out', 'test_fextract_input'))
+    expected = np.concatenate([block.data for block in FextractReader(in_csv)])
+    for filename in [in_csv, gz_csv]:
+        stdin = io.TextIOWrapper(io.BufferedReader(io.BytesIO(open(filename, 'rb').read())))
+        monkeypatch.setattr(sys, 'stdin', stdin)
+        reader = FextractReader(STDIN, block_size=1000)
+        assert reader.header == read_header(in_csv)
+        assert np.concatenate([block.data for block in reader]).tobytes() == expected.tobytes()
+        with pytest.raises(ValueError):
+            [block for block in reader]
@@ -0,0 +1,137 @@
+import csv
+import os.path as op
+import numpy as np
+import pytest
+from tfccs import fextract_reader
+from tfccs.fextract_reader import FextractReader
+from tfccs.fextract2numpy import (convert_fextract_row, convert_fextract_block, ProjectionPlan,
+                                  fextract_in_columns)
+from tfccs.utils import is_good_fextract_row, is_good_fextract_block
+
+ROOT_DIR = op.dirname(op.dirname(__file__))
+DATA_DIR = op.join(ROOT_DIR, 'data')
+FILTER_ARGS = dict(min_dist2end=100, allowed_strands='F', allowed_ccs2genome_cigars='IX=', min_np=1, max_np=2000)
+
+
+def read_blocks(in_csv, block_size):
+    reader = FextractReader(in_csv, block_size=block_size)
+    return reader, [block for block in reader]
+
+
+def test_fextract_reader():
+    in_csv = op.join(DATA_DIR, 'tiny.fextract.csv')
+    rows = [r for r in csv.DictReader(open(in_csv, 'r'), delimiter=',')]
+    raw_rows = open(in_csv, 'r').readlines()[1:]
+    # Tiny blocks so that rows span multiple blocks
+    reader, blocks = read_blocks(in_csv, block_size=1000)
+    assert reader.fieldnames == list(rows[0].keys())
+    assert len(blocks) > 1
+    assert sum([len(block) for block in blocks]) == len(rows)
+
+    data = np.concatenate([block.data for block in blocks])
+    for idx, r in enumerate(rows):
+        assert data['Movie'][idx].decode() == r['Movie']
+        assert data['CCSPos'][idx] == int(r['CCSPos'])
+        assert data['CCSBaseSNR'][idx] == np.float32(r['CCSBaseSNR'])
+    raw = b''.join([block.raw_rows(range(len(block))) for block in blocks])
+    assert raw.decode() == ''.join(raw_rows)
+
+    offsets = np.concatenate([block.offsets for block in blocks])
+    with open(in_csv, 'r') as reader:
+        for idx, offset in enumerate(offsets):
+            reader.seek(offset)
+            assert reader.readline() == raw_rows[idx]
+
+
+def test_convert_fextract_block():
+    for in_csv in [op.join(DATA_DIR, 'tiny.fextract.csv'),
+                   op.join(DATA_DIR, 'fextract2numpy', 'input.fextract.seqcontext.csv')]:
+        rows = [r for r in csv.DictReader(open(in_csv, 'r'), delimiter=',')]
+        good_rows = [r for r in rows if is_good_fextract_row(r, **FILTER_ARGS)]
+        reader = FextractReader(in_csv)
+        reader = FextractReader(in_csv, columns=fextract_in_columns(reader.fieldnames))
+        data = np.concatenate([block.data for block in reader])
+        good = is_good_fextract_block(data, **FILTER_ARGS)
+        assert good.sum() == len(good_rows)
+
+        plan = ProjectionPlan(reader.fieldnames)
+        out, arrow_qvs, ccs2genome_cigars = convert_fextract_block(data[good], plan)
+        for idx, r in enumerate(good_rows):
+            out_r, arrow_qv, ccs2genome_cigar = convert_fextract_row(r)
+            assert list(out_r.keys()) == plan.out_features
+            assert out[idx].tobytes() == np.fromiter(out_r.values(), dtype=np.float32).tobytes()
+            assert arrow_qvs[idx] == arrow_qv
+            assert list(ccs2genome_cigars[idx]) == ccs2genome_cigar
+        # Converting good rows of indices is the same as converting a copy of good rows
+        for expected, converted in zip((out, arrow_qvs, ccs2genome_cigars),
+                                       convert_fextract_block(data, plan, np.flatnonzero(good))):
+            assert converted.tobytes() == expected.tobytes()
+
+
+def test_byte_ranges():
+    in_csv = op.join(DATA_DIR, 'tiny.fextract.csv')
+    reader = FextractReader(in_csv, columns=['CCSPos'])
+    expected = np.concatenate([block['CCSPos'] for block in reader])
+    for num_ranges in [1, 2, 3, 20]:
+        byte_ranges = reader.byte_ranges(num_ranges)
+        assert len(byte_ranges) <= num_ranges
+        assert byte_ranges[0][0] == reader.data_start
+        assert byte_ranges[-1][1] == op.getsize(in_csv)
+        out = [block['CCSPos'] for byte_range in byte_ranges
+               for block in FextractReader(in_csv, columns=['CCSPos'], block_size=100, byte_range=byte_range)]
+        assert list(np.concatenate(out)) == list(expected)
+
+
+def test_projection_plan():
+    in_csv = op.join(DATA_DIR, 'fextract2numpy', 'input.fextract.seqcontext.csv')
+    fieldnames = FextractReader(in_csv).fieldnames
+    plan = ProjectionPlan(fieldnames)
+    assert len(plan) == len(plan.out_features)
+    assert [e[0] for e in plan.encoders] == ['CCSBase', 'PrevBases', 'NextBases']
+    with pytest.raises(ValueError, match='required to convert'):
+        ProjectionPlan([f for f in fieldnames if f != 'CCSBase'])
+
+
+def parse_csv(in_csv):
+    reader = FextractReader(in_csv, columns=['CCSPos', 'CCSBase', 'CCSBaseSNR'], block_size=1000)
+    blocks = [block for block in reader]
+    return [np.concatenate([getattr(block, name) for block in blocks]) for name in ['data', 'row_starts', 'row_ends']]
+
+
+def test_tokenizer(tmpdir, monkeypatch):
+    if fextract_reader._fextract_tokenizer is None:
+        pytest.skip("tfccs._fextract_tokenizer is not built")
+    rng = np.random.RandomState(0)
+    values = (['{!r}'.format(float(v)) for v in rng.standard_normal(300) * 10.0 ** rng.randint(-40, 40, 300)] +
+              ['{:.{}f}'.format(v, n) for v, n in zip(rng.standard_normal(300) * 1000, rng.randint(0, 25, 300))] +
+              ['{:.9g}'.format(v) for v in rng.random_sample(300)] +
+              ['0.' + '0' * n + '123456789' for n in range(30)] + ['-0', '+1.5', '.5', '5.', '1e5', '-2.5E-3'])
+    rows = ['{},{},{},x{}\n'.format(rng.randint(-10 ** 15, 10 ** 15), 'ACGT'[:idx % 5], v, idx)
+            for idx, v in enumerate(values)]
+    header = 'CCSPos,CCSBase,CCSBaseSNR,Skipped\n'
+    cases = {'numbers': rows, 'empty_lines': rows[:10] + ['\n'] + rows[10:], 'no_trailing_newline': rows,
+             'nan': rows[:10] + ['1,A,nan,x\n'] + rows[10:], 'carriage_return': [r[:-1] + '\r\n' for r in rows]}
+    for name, case_rows in cases.items():
+        in_csv = str(tmpdir.join(name + '.csv'))
+        with open(in_csv, 'w') as writer:
+            writer.write((header + ''.join(case_rows)).rstrip('\n') if name == 'no_trailing_newline' else
+                         header + ''.join(case_rows))
+        reader = FextractReader(in_csv, columns=['CCSPos', 'CCSBase', 'CCSBaseSNR'])
+        with open(in_csv, 'rb') as f:
+            raw = f.read()[reader.data_start:]
+        # Blocks of nan or carriage returns are parsed by np.loadtxt
+        assert (reader.tokenize(raw) is None) == (name in ['nan', 'carriage_return'])
+        tokenized = parse_csv(in_csv)
+        with monkeypatch.context() as m:
+            m.setattr(fextract_reader, '_fextract_tokenizer', None)
+            expected = parse_csv(in_csv)
+        assert len(tokenized[0]) == len(case_rows) - (name == 'empty_lines')
+        for out, expected_out in zip(tokenized, expected):
+            assert out.tobytes() == expected_out.tobytes()
+
+    # Rows with missing columns are not parsed by either tokenizer
+    in_csv = str(tmpdir.join('ragged.csv'))
+    with open(in_csv, 'w') as writer:
+        writer.write(header + ''.join(rows[:10]) + '1,A\n')
+    with pytest.raises(ValueError):
+        parse_csv(in_csv)
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from tfccs.quantile_sketch import QuantileSketch, MIN_INDEXABLE_VALUE
+
+
+def test_quantile_sketch_error_bound():
+    """Estimated quantiles must be within relative error alpha of exact quantiles."""
+    rng = np.random.RandomState(0)
+    a = np.stack([rng.lognormal(0, 2, 20000), rng.normal(0, 50, 20000), rng.randint(0, 5, 20000)], axis=1)
+    sketch = QuantileSketch(3, alpha=0.01)
+    for start in range(0, len(a), 3000):
+        sketch.update(a[start:start + 3000])
+    assert sketch.counts.sum(axis=1).tolist() == [len(a)] * 3
+    for q in [0, 0.001, 0.25, 0.5, 0.75, 0.999, 1]:
+        exact = np.sort(a, axis=0)[int(np.floor(q * (len(a) - 1)))]
+        estimates = sketch.quantiles(q)
+        assert np.all(np.abs(estimates - exact) <= 0.01 * np.abs(exact) + MIN_INDEXABLE_VALUE)
+        assert estimates[2] == exact[2]  # Exact quantiles of integers
+
+
+def test_quantile_sketch_merge():
+    """Sketches of disjoint rows merge into the sketch of all rows, and survive json items."""
+    rng = np.random.RandomState(1)
+    a = rng.normal(10, 3, (1000, 2))
+    a[5, 0], a[6, 1] = np.nan, np.inf
+    whole = QuantileSketch(2)
+    whole.update(a)
+    assert whole.counts.sum(axis=1).tolist() == [999, 999]
+    parts = [QuantileSketch(2) for _ in range(2)]
+    parts[0].update(a[:300])
+    parts[1].update(a[300:])
+    parts[0].merge(QuantileSketch.from_json_items(parts[1].to_json_items()))
+    assert np.array_equal(parts[0].counts, whole.counts) and np.array_equal(parts[0].mins, whole.mins)
+    assert np.array_equal(parts[0].quantiles(0.999), whole.quantiles(0.999))
+    assert np.isnan(QuantileSketch(2).quantiles(0.5)).all()
+    with pytest.raises(ValueError):
+        whole.merge(QuantileSketch(2, alpha=0.02))
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from tfccs.sampling import RowReservoir, row_sample_keys
+
+
+def test_row_sample_keys():
+    offsets = np.arange(1000, dtype=np.uint64) * 100
+    keys = row_sample_keys(7, 0, offsets)
+    assert np.array_equal(keys, row_sample_keys(7, np.zeros(1000), offsets))
+    assert not np.array_equal(keys, row_sample_keys(8, 0, offsets))
+    assert not np.array_equal(keys, row_sample_keys(7, 1, offsets))
+    assert len(np.unique(keys)) == len(keys)
+
+
+def test_row_reservoir():
+    n = 10000
+    offsets = np.arange(n, dtype=np.uint64)
+    keys = row_sample_keys(0, 0, offsets)
+    expected = np.sort(offsets[np.argsort(keys)[:100]])
+
+    reservoir = RowReservoir(100)
+    for start in range(0, n, 777):
+        reservoir.add(keys[start:start + 777], offsets[start:start + 777], offsets[start:start + 777] * 2)
+    assert len(reservoir) == 100
+    rows = reservoir.rows(sort_by=[0])
+    assert np.array_equal(rows[0], expected)
+    assert np.array_equal(rows[1], expected * 2)
+
+    # Reservoirs of disjoint rows merge into the same sample
+    merged = RowReservoir(100)
+    for start in range(0, n, 3000):
+        part = RowReservoir(100)
+        part.add(keys[start:start + 3000], offsets[start:start + 3000], offsets[start:start + 3000] * 2)
+        merged.merge(part)
+    assert np.array_equal(merged.rows(sort_by=[0])[0], expected)
+
+    # The sample is roughly uniform over rows
+    assert 0.3 < np.mean(expected < n // 2) < 0.7
+    with pytest.raises(ValueError):
+        RowReservoir(0)
@@ -1,7 +1,8 @@
 from tfccs.utils import (load_fextract_stat_json, cap_outlier_standardize, FextractStat,
-encode_kmer, decode_kmer)
+encode_kmer, decode_kmer, parse_memory_size, is_progress_due)
 import os.path as op
 import numpy as np
+import pytest
 
 ROOT_DIR = op.dirname(op.dirname(__file__))
 
@@ -23,6 +24,11 @@ def test_cap_outlier_standardize():
     # FextractStat('F1', 2, 1, 0, 4) - mean=2, std=1, min=0, max=4
     out = cap_outlier_standardize([0, 1, 2, 3, 7], FextractStat('F1', 2, 1, 0, 4), 3)
     assert list(out) == [-2.0, -1.0, 0., 1.0, 3.0]
+    stat = FextractStat('F1', 2, 1, 0, 9, quantiles={'q001': 0.5, 'q999': 8})
+    out = cap_outlier_standardize([0, 1, 2, 3, 7, 9], stat, 3, clip_quantiles=True)
+    assert list(out) == [-1.5, -1.0, 0., 1.0, 5.0, 6.0]
+    with pytest.raises(ValueError):
+        cap_outlier_standardize([0], FextractStat('F1', 2, 1, 0, 4), clip_quantiles=True)
 
 def test_encode_kmer():
     for c0 in 'ATGC-':
@@ -33,3 +39,18 @@ def test_encode_kmer():
                     encode_out = encode_kmer(s)
                     decode_out = decode_kmer(encode_out, 4)
                     assert decode_out == s
+
+def test_parse_memory_size():
+    assert parse_memory_size('1024') == 1024
+    assert parse_memory_size('64K') == 64 * 1024
+    assert parse_memory_size('512m') == 512 * 1024 ** 2
+    assert parse_memory_size('4GB') == 4 * 1024 ** 3
+    assert parse_memory_size('1.5G') == int(1.5 * 1024 ** 3)
+
+
+def test_is_progress_due():
+    assert is_progress_due(500000, 100000)
+    assert is_progress_due(520000, 100000)
+    assert not is_progress_due(400000, 100000)
+    assert not is_progress_due(620000, 100000)
+    assert is_progress_due(1000000, 1000000, interval=300000)
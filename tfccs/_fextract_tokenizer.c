@@ -0,0 +1,213 @@
+/*
+ * Optional tokenizer of fextract.csv blocks, see tfccs.fextract_reader.FextractReader.parse.
+ *
+ * tokenize(raw, out, specs, itemsize, starts, ends) parses rows of raw bytes into out, the buffer of a numpy
+ * structured array of rows of itemsize bytes, and saves the start and end (including the trailing newline) of
+ * each row in raw into int64 buffers starts and ends, which have at least as many items as rows of out.
+ * specs is a buffer of int64 triples (kind, offset, width), one per field of a row, where kind is SKIP, FLOAT32,
+ * INT64 or BYTES, and offset is the offset of the field in a row of out. Empty lines are skipped.
+ *
+ * Values are the same as those of np.loadtxt: floats are parsed to the correctly rounded double, then cast to
+ * float32. Only plain decimal numbers and printable ASCII strings without spaces are parsed. Return the number
+ * of parsed rows, or -1 if a field is not supported or a row does not have exactly the number of fields of specs,
+ * in which case the caller parses the block by np.loadtxt instead, which either parses it or raises the error.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+enum { SKIP = 0, FLOAT32 = 1, INT64 = 2, BYTES = 3 };
+
+#define MAX_FAST_DIGITS 19      /* Digits of a uint64 mantissa */
+#define MAX_EXACT_MANTISSA (1ULL << 53)
+#define MAX_EXACT_POW10 22
+#define MAX_SLOW_FIELD 63       /* Longer numbers are left to np.loadtxt */
+
+static const double POW10[MAX_EXACT_POW10 + 1] = {
+    1e0, 1e1, 1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9, 1e10, 1e11,
+    1e12, 1e13, 1e14, 1e15, 1e16, 1e17, 1e18, 1e19, 1e20, 1e21, 1e22};
+
+static inline int is_delimiter(char c) { return c == ',' || c == '\n'; }
+
+/*
+ * Parse a decimal number of [p, end) up to a delimiter into *value, and return the end of the number,
+ * or NULL if it is not a plain decimal number, e.g., nan, inf or with spaces.
+ * Numbers of at most 19 significant digits and a power of 10 of at most 22 are exact by one double
+ * operation (Clinger's fast path); others are parsed by strtod, which is also correctly rounded.
+ */
+static const char *parse_double(const char *p, const char *end, double *value) {
+    const char *start = p;
+    int negative = 0, num_digits = 0, significant = 0, exponent = 0;
+    uint64_t mantissa = 0;
+    if (p < end && (*p == '-' || *p == '+')) {
+        negative = *p == '-';
+        p++;
+    }
+    for (; p < end && (unsigned)(*p - '0') < 10; p++, num_digits++) {
+        if (mantissa == 0 && *p == '0')
+            continue;
+        if (significant < MAX_FAST_DIGITS)
+            mantissa = mantissa * 10 + (uint64_t)(*p - '0');
+        else
+            exponent++;
+        significant++;
+    }
+    if (p < end && *p == '.') {
+        for (p++; p < end && (unsigned)(*p - '0') < 10; p++, num_digits++) {
+            if (mantissa == 0 && *p == '0') {
+                exponent--;
+                continue;
+            }
+            if (significant < MAX_FAST_DIGITS) {
+                mantissa = mantissa * 10 + (uint64_t)(*p - '0');
+                exponent--;
+            }
+            significant++;
+        }
+    }
+    if (num_digits == 0)
+        return NULL;
+    int has_exponent = p < end && (*p == 'e' || *p == 'E');
+    if (has_exponent) {
+        const char *q = p + 1;
+        if (q < end && (*q == '-' || *q == '+'))
+            q++;
+        if (q == end || (unsigned)(*q - '0') >= 10)
+            return NULL;
+        while (q < end && (unsigned)(*q - '0') < 10)
+            q++;
+        p = q;
+    }
+    if (p < end && !is_delimiter(*p))
+        return NULL;
+    if (!has_exponent && significant <= MAX_FAST_DIGITS && mantissa <= MAX_EXACT_MANTISSA &&
+            exponent >= -MAX_EXACT_POW10 && exponent <= MAX_EXACT_POW10) {
+        double v = (double)mantissa;
+        v = exponent < 0 ? v / POW10[-exponent] : v * POW10[exponent];
+        *value = negative ? -v : v;
+        return p;
+    }
+    char buf[MAX_SLOW_FIELD + 1];
+    size_t length = (size_t)(p - start);
+    if (length > MAX_SLOW_FIELD)
+        return NULL;
+    memcpy(buf, start, length);
+    buf[length] = '\0';
+    char *parsed_end;
+    *value = strtod(buf, &parsed_end);
+    return parsed_end == buf + length ? p : NULL;
+}
+
+/* Parse a decimal integer of at most 18 digits of [p, end) into *value, see parse_double */
+static const char *parse_int64(const char *p, const char *end, int64_t *value) {
+    int negative = 0, num_digits = 0;
+    int64_t v = 0;
+    if (p < end && (*p == '-' || *p == '+')) {
+        negative = *p == '-';
+        p++;
+    }
+    for (; p < end && (unsigned)(*p - '0') < 10; p++, num_digits++)
+        v = v * 10 + (*p - '0');
+    if (num_digits == 0 || num_digits > 18 || (p < end && !is_delimiter(*p)))
+        return NULL;
+    *value = negative ? -v : v;
+    return p;
+}
+
+static Py_ssize_t tokenize_rows(const char *begin, const char *end, char *out, Py_ssize_t num_rows,
+                                const int64_t *specs, Py_ssize_t num_fields, Py_ssize_t itemsize,
+                                int64_t *starts, int64_t *ends) {
+    const char *p = begin;
+    Py_ssize_t row = 0;
+    while (p < end) {
+        if (*p == '\n') {
+            p++;
+            continue;
+        }
+        if (row >= num_rows)
+            return -1;
+        starts[row] = p - begin;
+        char *record = out + row * itemsize;
+        for (Py_ssize_t field = 0; field < num_fields; field++) {
+            const int64_t *spec = specs + 3 * field;
+            char *dst = record + spec[1];
+            if (spec[0] == FLOAT32) {
+                double value;
+                p = parse_double(p, end, &value);
+                if (p == NULL)
+                    return -1;
+                float f = (float)value;
+                memcpy(dst, &f, sizeof(f));
+            } else if (spec[0] == INT64) {
+                int64_t value;
+                p = parse_int64(p, end, &value);
+                if (p == NULL)
+                    return -1;
+                memcpy(dst, &value, sizeof(value));
+            } else {
+                const char *start = p;
+                while (p < end && !is_delimiter(*p)) {
+                    if ((unsigned char)*p <= 0x20 || (unsigned char)*p >= 0x7f)
+                        return -1;
+                    p++;
+                }
+                if (spec[0] == BYTES) {
+                    Py_ssize_t length = p - start;
+                    if (length > spec[2])
+                        return -1;
+                    memcpy(dst, start, (size_t)length);
+                    memset(dst + length, 0, (size_t)(spec[2] - length));
+                }
+            }
+            /* Fields are separated by commas, and the last field ends with a newline or the end of raw */
+            if (field + 1 < num_fields) {
+                if (p == end || *p != ',')
+                    return -1;
+                p++;
+            } else if (p < end) {
+                if (*p != '\n')
+                    return -1;
+                p++;
+            }
+        }
+        ends[row++] = p - begin;
+    }
+    return row;
+}
+
+static PyObject *tokenize(PyObject *self, PyObject *args) {
+    Py_buffer raw, out, specs, starts, ends;
+    Py_ssize_t itemsize, num_rows, parsed = 0;
+    if (!PyArg_ParseTuple(args, "y*w*y*nw*w*", &raw, &out, &specs, &itemsize, &starts, &ends))
+        return NULL;
+    num_rows = itemsize > 0 ? out.len / itemsize : 0;
+    if (specs.len % (3 * (Py_ssize_t)sizeof(int64_t)) != 0 || itemsize <= 0 ||
+            starts.len < num_rows * (Py_ssize_t)sizeof(int64_t) || ends.len < num_rows * (Py_ssize_t)sizeof(int64_t)) {
+        PyErr_SetString(PyExc_ValueError, "Specs must be int64 triples, itemsize must be positive, "
+                                          "and starts and ends must have an int64 per row of out!");
+        parsed = -2;
+    } else {
+        Py_BEGIN_ALLOW_THREADS
+        parsed = tokenize_rows((const char *)raw.buf, (const char *)raw.buf + raw.len, (char *)out.buf, num_rows,
+                               (const int64_t *)specs.buf, specs.len / (3 * (Py_ssize_t)sizeof(int64_t)),
+                               itemsize, (int64_t *)starts.buf, (int64_t *)ends.buf);
+        Py_END_ALLOW_THREADS
+    }
+    PyBuffer_Release(&raw);
+    PyBuffer_Release(&out);
+    PyBuffer_Release(&specs);
+    PyBuffer_Release(&starts);
+    PyBuffer_Release(&ends);
+    return parsed == -2 ? NULL : PyLong_FromSsize_t(parsed);
+}
+
+static PyMethodDef methods[] = {
+    {"tokenize", tokenize, METH_VARARGS,
+     "tokenize(raw, out, specs, itemsize, starts, ends): parse rows of raw into out, return the number of rows or -1"},
+    {NULL, NULL, 0, NULL}};
+
+static struct PyModuleDef module = {PyModuleDef_HEAD_INIT, "_fextract_tokenizer", NULL, -1, methods};
+
+PyMODINIT_FUNC PyInit__fextract_tokenizer(void) { return PyModule_Create(&module); }
@@ -19,12 +19,19 @@ Insertion0_REV
 ORDERED_FEATURES_KEY = "OrderedFeatures"
 BASE_FEATURE_STAT_KEY = "BaseFeatureStat"
 BASE_MAP_PROBABILITY_KEY = "BaseMapProbability"
+STAT_VERSION_KEY = "StatVersion"  # Version of fextract.stat.json, bumped by each fextract2stat --update
+STAT_HISTORY_KEY = "StatHistory"  # Rows folded into each version of fextract.stat.json
 
 MIN_DIST2END = 100
 ALLOWED_STRANDS = "F"
 ALLOWED_CIGARS = "IX="
 MIN_NUMPASSES = 1
 MAX_NUMPASSES = 2000
+PROGRESS_ROWS = 500000  # Progress of reading fextract csv is printed every 500000 rows, see is_progress_due
+STANDARDIZE_CAP = 4  # Standardized features are capped within [-4, 4], see cap_outlier_standardize
+# Quantiles of features in fextract.stat.json, estimated by tfccs.quantile_sketch, e.g., q999 is the 99.9th percentile
+STAT_QUANTILES = [('q001', 0.001), ('q25', 0.25), ('q50', 0.5), ('q75', 0.75), ('q999', 0.999)]
+CLIP_QUANTILES = ('q001', 'q999')  # Features are optionally clipped at q0.1 and q99.9, see cap_outlier_standardize
 
 DEFAULT_VALIDATION_CSV = "/pbi/dept/secondary/siv/testdata/ccsqv/Mule/hg2/hg2_validation_5pct_err.fextract.csv"
 HG2_GRC38_HIGHCONFIDENCE_NOINCONSISTENT = '/pbi/dept/consensus/ccsqv/data/Mule/hg2/hg2.Grch38.hc.bed'
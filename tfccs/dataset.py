@@ -0,0 +1,1010 @@
+"""
+Writers of fextract datasets converted from fextract.csv by fextract2numpy.
+
+A dataset consists of arrays with the same number of rows, one row per CCS base:
+    fextractinput --- 2d float32, standardized features
+    arrowqv --- 1d float32, ArrowQv
+    arrowqvbin8 --- 2d float32, one-hot encoded ArrowQv bins, see arrowqv2bin8
+    ccs2genome_cigars --- 2d float32, one-hot encoded '=IXD', see one_hot_encode_cigar
+
+A dataset is saved in either of two formats:
+    npz --- {prefix}.npz, a compressed .npz file, see NpzStreamWriter
+    npydir --- {prefix}.npydir/, a directory of uncompressed little-endian {key}.npy files and a
+               manifest.json, which can be memory-mapped and shared by processes, see NpyDirWriter
+    chunked --- {prefix}.chunked, chunks of rows compressed independently by multiple threads using a
+                selectable codec and level, so that row ranges can be read alone, see ChunkedDatasetWriter
+and may be split into shards of a fixed number of rows, {prefix}.shards/, see ShardedDatasetWriter.
+New shards may be appended to an existing sharded dataset without rewriting existing shards.
+Shards are read lazily, only arrays and rows which are accessed, see ShardedDataset.
+
+Rows of identical (fextractinput, ccs2genome_cigars) may be collapsed into unique rows and a 1d int64
+array counts of the number of rows of each unique row, see DuplicateCollapsingWriter.
+"""
+import os
+import bz2
+import json
+import lzma
+import zlib
+import shutil
+import zipfile
+import collections
+import concurrent.futures
+import logging
+import os.path as op
+import numpy as np
+
+FORMATTER = op.basename(__file__) + ':%(levelname)s:'+'%(message)s'
+logging.basicConfig(level=logging.DEBUG, format=FORMATTER)
+log = logging.getLogger(__name__)
+
+DATASET_KEYS = ['fextractinput', 'arrowqv', 'arrowqvbin8', 'ccs2genome_cigars']
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+DATASET_FORMAT_NPZ = 'npz'
+DATASET_FORMAT_NPY_DIR = 'npydir'
+DATASET_FORMAT_CHUNKED = 'chunked'
+DATASET_FORMATS = [DATASET_FORMAT_NPZ, DATASET_FORMAT_NPY_DIR, DATASET_FORMAT_CHUNKED]
+MANIFEST_FILENAME = 'manifest.json'
+NPY_DIR_VERSION = 1
+NPY_HEADER_SIZE = 128  # Reserved .npy header size, a multiple of 64 so that data is aligned
+DATASET_FORMAT_SHARDS = 'shards'
+SHARDS_VERSION = 1
+LABEL_KEY = 'ccs2genome_cigars'
+COUNTS_KEY = 'counts'
+COLLAPSE_KEYS = ['fextractinput', LABEL_KEY]
+CHUNKED_MAGIC = b'TFCCSCHK'
+CHUNKED_VERSION = 1
+DEFAULT_ROWS_PER_CHUNK = 32768
+FEATURE_DTYPES = ['float32', 'float16', 'int8']
+INT8_MIN_CODE = -127
+INT8_MAX_CODE = 127
+INT8_NAN_CODE = -128
+SCALE_ATTR = 'fextractinput_scale'
+OFFSET_ATTR = 'fextractinput_offset'
+STAT_VERSION_ATTR = 'stat_version'  # Version of the stat json which standardized fextractinput
+DEQUANTIZE_ROWS = 65536
+COLLAPSE_PARTITIONS = 64  # Rows are collapsed in partitions by hash, see DuplicateCollapsingWriter
+DEFAULT_COLLAPSE_MEMORY = 256 * 1024 * 1024
+MAX_COLLAPSE_LEVEL = 3  # Partitions larger than memory are split at most 3 times, e.g., of few distinct rows
+# codec -> (compress(data, level), decompress(data), default level)
+CODECS = {'zlib': (zlib.compress, zlib.decompress, 6),
+          'bz2': (bz2.compress, bz2.decompress, 9),
+          'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress, 6),
+          'none': (lambda data, level: data, bytes, 0)}
+
+
+def check_block(keys, arrays, dtypes, row_shapes):
+    """
+    Check a block of rows of arrays {key: rows} have all keys, the same number of rows, and the same dtype
+    and row shape as previous blocks, recorded in dtypes and row_shapes.
+    Return ({key: contiguous rows}, number of rows).
+    """
+    if set(arrays.keys()) != set(keys):
+        raise ValueError("Must write arrays {}, got {}!".format(keys, sorted(arrays.keys())))
+    num_rows = set([len(a) for a in arrays.values()])
+    if len(num_rows) != 1:
+        raise ValueError("Arrays must have the same number of rows, got {}!".format(num_rows))
+    out = {}
+    for key in keys:
+        a = np.ascontiguousarray(arrays[key])
+        if key not in dtypes:
+            dtypes[key], row_shapes[key] = a.dtype, a.shape[1:]
+        elif dtypes[key] != a.dtype or row_shapes[key] != a.shape[1:]:
+            raise ValueError("Array {} has inconsistent dtype or shape {} {}!".format(key, a.dtype, a.shape))
+        out[key] = a
+    return out, num_rows.pop()
+
+
+class FeatureQuantizer(object):
+    """
+    Quantize 2d float32 features to float16, or to int8 codes with a per-column scale and offset, where
+        value = offset + (code - INT8_MIN_CODE) * scale, and NaN is coded as INT8_NAN_CODE,
+    and keep track of reconstruction errors of each column.
+        features --- names of columns
+        dtype --- one of FEATURE_DTYPES, 'float32' to keep features as is
+        ranges --- [(min, max)] of each column, required by int8. Values out of range are clipped.
+    """
+
+    def __init__(self, features, dtype='float32', ranges=None):
+        if dtype not in FEATURE_DTYPES:
+            raise ValueError("Unsupported feature dtype {}! Only support {}".format(dtype, FEATURE_DTYPES))
+        self.features = list(features)
+        self.dtype = dtype
+        self.scale, self.offset = None, None
+        if dtype == 'int8':
+            if ranges is None or len(ranges) != len(self.features):
+                raise ValueError("Must provide range of each feature to quantize to int8!")
+            lo, hi = np.asarray(ranges, dtype=np.float64).T
+            self.offset = lo
+            self.scale = np.where(hi > lo, (hi - lo) / (INT8_MAX_CODE - INT8_MIN_CODE), 1.0)
+        n = len(self.features)
+        self.count = np.zeros(n, dtype=np.int64)
+        self.sum_sq_error = np.zeros(n, dtype=np.float64)
+        self.max_abs_error = np.zeros(n, dtype=np.float64)
+
+    @property
+    def attrs(self):
+        """Dataset attrs to dequantize, see dequantize_features"""
+        if self.dtype != 'int8':
+            return {}
+        return {SCALE_ATTR: self.scale, OFFSET_ATTR: self.offset}
+
+    def quantize(self, a):
+        """Return quantized features of a 2d float32 array, and update reconstruction errors"""
+        if self.dtype == 'float32':
+            return a
+        if self.dtype == 'float16':
+            q = a.astype(np.float16)
+        else:
+            codes = np.rint((a - self.offset) / self.scale) + INT8_MIN_CODE
+            codes = np.clip(np.nan_to_num(codes, nan=INT8_NAN_CODE), INT8_NAN_CODE, INT8_MAX_CODE)
+            codes[~np.isnan(a) & (codes < INT8_MIN_CODE)] = INT8_MIN_CODE
+            q = codes.astype(np.int8)
+        error = np.abs(dequantize_features(q, self.scale, self.offset).astype(np.float64) - a)
+        valid = ~np.isnan(a)
+        error[~valid] = 0
+        self.count += np.count_nonzero(valid, axis=0)
+        self.sum_sq_error += np.sum(error * error, axis=0)
+        if len(a) > 0:
+            self.max_abs_error = np.maximum(self.max_abs_error, error.max(axis=0))
+        return q
+
+    def error_report(self):
+        """Return {feature: {'max_abs_error': ..., 'rmse': ...}} of reconstruction errors"""
+        rmse = np.sqrt(self.sum_sq_error / np.maximum(self.count, 1))
+        report = {}
+        for idx, feature in enumerate(self.features):
+            report[feature] = {'max_abs_error': float(self.max_abs_error[idx]), 'rmse': float(rmse[idx])}
+            if self.dtype == 'int8':
+                report[feature].update({'scale': float(self.scale[idx]), 'offset': float(self.offset[idx])})
+        return report
+
+    def write_report(self, out_json):
+        """Write dtype and reconstruction errors of each feature to out_json"""
+        with open(out_json, 'w') as writer:
+            json.dump({'dtype': self.dtype, 'features': self.error_report()}, writer, indent=4, sort_keys=True)
+        worst = int(np.argmax(self.max_abs_error)) if len(self.features) else None
+        if worst is not None:
+            log.info("Quantized features to {}, max abs error {} of feature {}, see {}".format(
+                self.dtype, self.max_abs_error[worst], self.features[worst], out_json))
+
+
+def dequantize_features(a, scale=None, offset=None):
+    """
+    Return float32 features of quantized features a, see FeatureQuantizer.
+    int8 codes are dequantized in blocks of rows in float64, so that exact values such as 0 and 1 are restored.
+    """
+    if a.dtype != np.int8:
+        return a if a.dtype == np.float32 else a.astype(np.float32)
+    if scale is None or offset is None:
+        raise ValueError("Must provide scale and offset to dequantize int8 features!")
+    scale, offset = np.asarray(scale, dtype=np.float64), np.asarray(offset, dtype=np.float64)
+    out = np.empty(a.shape, dtype=np.float32)
+    for start in range(0, len(a), DEQUANTIZE_ROWS):
+        codes = np.asarray(a[start:start + DEQUANTIZE_ROWS])
+        block = offset + (codes.astype(np.float64) - INT8_MIN_CODE) * scale
+        block[codes == INT8_NAN_CODE] = np.nan
+        out[start:start + DEQUANTIZE_ROWS] = block
+    return out
+
+
+class ArraySpool(object):
+    """
+    Spill rows of arrays to raw files on disk block by block, and read them back block by block.
+        prefix --- rows of each array are spooled to {prefix}.{key}.spool
+        keys --- names of arrays
+    """
+
+    def __init__(self, prefix, keys):
+        self.prefix = prefix
+        self.keys = list(keys)
+        self.num_rows = 0
+        self.dtypes = {}
+        self.row_shapes = {}
+        self.writers = {key: open(self.filename(key), 'wb') for key in self.keys}
+
+    def filename(self, key):
+        return '{}.{}.spool'.format(self.prefix, key)
+
+    def write(self, **arrays):
+        """Append a block of rows, e.g., write(fextractinput=a, arrowqv=b, ...)"""
+        arrays, num_rows = check_block(self.keys, arrays, self.dtypes, self.row_shapes)
+        for key in self.keys:
+            self.writers[key].write(arrays[key].reshape(-1).view(np.uint8))
+        self.num_rows += num_rows
+
+    def close(self):
+        """Finish writing, spooled rows can be read afterwards"""
+        for writer in self.writers.values():
+            writer.close()
+
+    def read_blocks(self, rows_per_block):
+        """Yield {key: rows} of at most rows_per_block rows, in the order of rows written"""
+        self.close()
+        readers = {key: open(self.filename(key), 'rb') for key in self.keys}
+        try:
+            for start in range(0, self.num_rows, rows_per_block):
+                num_rows = min(rows_per_block, self.num_rows - start)
+                yield {key: np.fromfile(readers[key], dtype=self.dtypes[key],
+                                        count=num_rows * int(np.prod(self.row_shapes[key], dtype=np.int64))
+                                        ).reshape((num_rows,) + self.row_shapes[key])
+                       for key in self.keys}
+        finally:
+            for reader in readers.values():
+                reader.close()
+
+    def remove(self):
+        """Remove spool files"""
+        self.close()
+        for key in self.keys:
+            if op.exists(self.filename(key)):
+                os.remove(self.filename(key))
+
+
+class NpzStreamWriter(object):
+    """
+    Write a dataset to a compressed .npz file block by block, using memory bounded by block size.
+    Rows of each array are spooled to a raw file next to the output file, and streamed
+    into the .npz file on close(). The .npz file is readable by np.load, and is the same as
+    np.savez_compressed(out_npz, **{key: all rows of key}, **attrs).
+        out_npz --- output .npz file
+        keys --- names of arrays, in the order of .npz members
+        attrs --- {name: small array} not aligned with rows, e.g., quantization scales, see FeatureQuantizer
+    """
+
+    def __init__(self, out_npz, keys=DATASET_KEYS, attrs=None):
+        self.out_npz = out_npz
+        self.keys = list(keys)
+        self.attrs = dict(attrs or {})
+        self.spool = ArraySpool(out_npz, self.keys)
+
+    @property
+    def num_rows(self):
+        return self.spool.num_rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.spool.remove()
+
+    def write(self, **arrays):
+        """Append a block of rows, e.g., write(fextractinput=a, arrowqv=b, ...)"""
+        self.spool.write(**arrays)
+
+    def close(self):
+        """Stream spooled rows into .npz members, and remove spool files"""
+        spool = self.spool
+        spool.close()
+        try:
+            with zipfile.ZipFile(self.out_npz, mode='w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zipf:
+                for key in self.keys:
+                    header = np.lib.format.header_data_from_array_1_0(
+                        np.empty((0,) + spool.row_shapes[key], dtype=spool.dtypes[key]))
+                    header['shape'] = (spool.num_rows,) + spool.row_shapes[key]
+                    # always force zip64, the same as np.savez_compressed
+                    with zipf.open(key + '.npy', 'w', force_zip64=True) as writer, \
+                            open(spool.filename(key), 'rb') as reader:
+                        np.lib.format.write_array_header_1_0(writer, header)
+                        while True:
+                            buf = reader.read(COPY_BUFFER_SIZE)
+                            if not buf:
+                                break
+                            writer.write(buf)
+                for name, a in self.attrs.items():
+                    with zipf.open(name + '.npy', 'w', force_zip64=True) as writer:
+                        np.lib.format.write_array(writer, np.asarray(a))
+        finally:
+            spool.remove()
+
+
+def npy_header(dtype, shape, header_size=NPY_HEADER_SIZE):
+    """Return a .npy version 1.0 header of exactly header_size bytes, see numpy.lib.format"""
+    d = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': tuple(shape)}
+    header = repr(d).encode('latin1')
+    prefix_size = len(np.lib.format.MAGIC_PREFIX) + 4  # magic, version and uint16 header length
+    if prefix_size + len(header) + 1 > header_size:
+        raise ValueError("Could not fit .npy header {} in {} bytes!".format(header, header_size))
+    header_length = header_size - prefix_size
+    return (np.lib.format.MAGIC_PREFIX + bytes([1, 0]) + np.uint16(header_length).astype('<u2').tobytes() +
+            header.ljust(header_length - 1) + b'\n')
+
+
+class NpyDirWriter(ArraySpool):
+    """
+    Write a dataset to a directory of uncompressed .npy files block by block, one {key}.npy per array.
+    Rows are appended to {key}.npy directly after a reserved header, which is filled in on close(),
+    together with manifest.json, so that rows are written only once. Arrays are little-endian,
+    and can be memory-mapped by load_npy_dir.
+        out_dir --- output directory, e.g., {prefix}.npydir
+        keys --- names of arrays
+        attrs --- {name: small array} not aligned with rows, saved to {name}.npy, see NpzStreamWriter
+    """
+
+    def __init__(self, out_dir, keys=DATASET_KEYS, attrs=None):
+        self.out_dir = out_dir
+        self.attrs = dict(attrs or {})
+        if not op.exists(out_dir):
+            os.makedirs(out_dir)
+        super(NpyDirWriter, self).__init__(out_dir, keys)
+        for writer in self.writers.values():
+            writer.write(b'\0' * NPY_HEADER_SIZE)
+
+    def filename(self, key):
+        return op.join(self.out_dir, key + '.npy')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.remove()
+
+    def write(self, **arrays):
+        """Append a block of rows, e.g., write(fextractinput=a, arrowqv=b, ...)"""
+        arrays = {key: np.asarray(a) for key, a in arrays.items()}
+        super(NpyDirWriter, self).write(**{key: a.astype(a.dtype.newbyteorder('<'), copy=False)
+                                           for key, a in arrays.items()})
+
+    def close(self):
+        """Write .npy headers and manifest.json"""
+        if all(writer.closed for writer in self.writers.values()):
+            return
+        for key, writer in self.writers.items():
+            if key not in self.dtypes:
+                raise ValueError("No rows of array {} were written to {}!".format(key, self.out_dir))
+            writer.seek(0)
+            writer.write(npy_header(self.dtypes[key], (self.num_rows,) + self.row_shapes[key]))
+        super(NpyDirWriter, self).close()
+        for name, a in self.attrs.items():
+            np.save(self.filename(name), np.asarray(a))
+        manifest = {'format': DATASET_FORMAT_NPY_DIR, 'version': NPY_DIR_VERSION, 'num_rows': self.num_rows,
+                    'arrays': {key: {'filename': op.basename(self.filename(key)),
+                                     'dtype': np.lib.format.dtype_to_descr(self.dtypes[key]),
+                                     'shape': [self.num_rows] + list(self.row_shapes[key])}
+                               for key in self.keys},
+                    'attrs': {name: op.basename(self.filename(name)) for name in self.attrs}}
+        with open(op.join(self.out_dir, MANIFEST_FILENAME), 'w') as writer:
+            json.dump(manifest, writer, indent=4, sort_keys=True)
+
+
+class ChunkedDatasetWriter(object):
+    """
+    Write a dataset to a single file of independently compressed chunks of rows_per_chunk rows.
+    Chunks are compressed by nthreads threads, since zlib, bz2 and lzma release the GIL, and written in order.
+    Layout of the file:
+        CHUNKED_MAGIC --- 8 bytes
+        chunks --- compressed little-endian rows of each array, chunk by chunk
+        footer --- JSON of codec, dtypes, row shapes, rows and [offset, size] of each chunk of each array
+        length of footer --- uint64, little endian
+        CHUNKED_MAGIC --- 8 bytes
+    See ChunkedDataset to read.
+        filename --- output file, e.g., {prefix}.chunked
+        keys --- names of arrays
+        codec --- one of CODECS
+        level --- compression level, None to use the default level of codec
+        rows_per_chunk --- number of rows per chunk
+        nthreads --- number of compression threads
+        attrs --- {name: small array} not aligned with rows, saved in the footer, see NpzStreamWriter
+    """
+
+    def __init__(self, filename, keys=DATASET_KEYS, codec='zlib', level=None, rows_per_chunk=DEFAULT_ROWS_PER_CHUNK,
+                 nthreads=1, attrs=None):
+        if codec not in CODECS:
+            raise ValueError("Unsupported codec {}! Only support {}".format(codec, sorted(CODECS)))
+        self.filename = filename
+        self.keys = list(keys)
+        self.codec = codec
+        self.level = CODECS[codec][2] if level is None else int(level)
+        self.rows_per_chunk = rows_per_chunk
+        self.nthreads = max(1, nthreads)
+        self.attrs = {name: np.asarray(a) for name, a in (attrs or {}).items()}
+        self.dtypes = {}
+        self.row_shapes = {}
+        self.chunk_rows = []
+        self.chunks = {key: [] for key in self.keys}
+        self.buffer = []
+        self.buffered_rows = 0
+        self.pending = collections.deque()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.nthreads)
+        self.writer = open(filename, 'wb')
+        self.writer.write(CHUNKED_MAGIC)
+
+    @property
+    def num_rows(self):
+        return sum(self.chunk_rows) + self.buffered_rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown()
+            self.writer.close()
+            os.remove(self.filename)
+
+    def write(self, **arrays):
+        """Append a block of rows, e.g., write(fextractinput=a, arrowqv=b, ...)"""
+        arrays, num_rows = check_block(self.keys, arrays, self.dtypes, self.row_shapes)
+        if num_rows == 0:
+            return
+        self.buffer.append(arrays)
+        self.buffered_rows += num_rows
+        if self.buffered_rows >= self.rows_per_chunk:
+            buffered = {key: np.concatenate([d[key] for d in self.buffer]) for key in self.keys}
+            start = 0
+            while self.buffered_rows - start >= self.rows_per_chunk:
+                self.submit_chunk({key: a[start:start + self.rows_per_chunk] for key, a in buffered.items()})
+                start += self.rows_per_chunk
+            self.buffer = [{key: a[start:] for key, a in buffered.items()}]
+            self.buffered_rows -= start
+
+    def submit_chunk(self, arrays):
+        """Compress a chunk in background threads, and write compressed chunks which are ready in order"""
+        compress = CODECS[self.codec][0]
+        for key in self.keys:
+            a = arrays[key]
+            data = a.astype(a.dtype.newbyteorder('<'), copy=False).tobytes()
+            self.pending.append((key, self.executor.submit(compress, data, self.level)))
+        self.chunk_rows.append(len(arrays[self.keys[0]]))
+        # Bound memory of pending chunks
+        while len(self.pending) > 2 * self.nthreads * len(self.keys):
+            self.write_next_chunk()
+
+    def write_next_chunk(self):
+        key, future = self.pending.popleft()
+        data = future.result()
+        self.chunks[key].append([self.writer.tell(), len(data)])
+        self.writer.write(data)
+
+    def close(self):
+        """Compress and write remaining rows and the footer"""
+        if self.buffered_rows > 0:
+            self.submit_chunk({key: np.concatenate([d[key] for d in self.buffer]) for key in self.keys})
+            self.buffer, self.buffered_rows = [], 0
+        while self.pending:
+            self.write_next_chunk()
+        self.executor.shutdown()
+        footer = {'version': CHUNKED_VERSION, 'codec': self.codec, 'level': self.level, 'keys': self.keys,
+                  'num_rows': self.num_rows, 'chunk_rows': self.chunk_rows,
+                  'arrays': {key: {'dtype': np.lib.format.dtype_to_descr(self.dtypes[key].newbyteorder('<')),
+                                   'row_shape': list(self.row_shapes[key]), 'chunks': self.chunks[key]}
+                             for key in self.keys},
+                  'attrs': {name: {'dtype': np.lib.format.dtype_to_descr(a.dtype), 'shape': list(a.shape),
+                                   'values': a.reshape(-1).tolist()} for name, a in self.attrs.items()}}
+        footer_bytes = json.dumps(footer, sort_keys=True).encode()
+        self.writer.write(footer_bytes)
+        self.writer.write(np.uint64(len(footer_bytes)).astype('<u8').tobytes())
+        self.writer.write(CHUNKED_MAGIC)
+        self.writer.close()
+
+
+class ChunkedDataset(object):
+    """
+    Read a dataset written by ChunkedDatasetWriter, only decompressing chunks of requested rows.
+    Support keys() and [key] the same as np.load of .npz files.
+        filename --- input file
+        nthreads --- number of decompression threads
+    """
+
+    def __init__(self, filename, nthreads=1):
+        self.filename = filename
+        self.nthreads = max(1, nthreads)
+        with open(filename, 'rb') as reader:
+            if reader.read(len(CHUNKED_MAGIC)) != CHUNKED_MAGIC:
+                raise ValueError("{} is not a chunked dataset file!".format(filename))
+            reader.seek(-8 - len(CHUNKED_MAGIC), os.SEEK_END)
+            footer_length = int(np.frombuffer(reader.read(8), dtype='<u8')[0])
+            if reader.read(len(CHUNKED_MAGIC)) != CHUNKED_MAGIC:
+                raise ValueError("{} is truncated!".format(filename))
+            reader.seek(-8 - len(CHUNKED_MAGIC) - footer_length, os.SEEK_END)
+            self.footer = json.loads(reader.read(footer_length).decode())
+        if self.footer['version'] != CHUNKED_VERSION:
+            raise ValueError("Unsupported chunked dataset version {} of {}!".format(self.footer['version'], filename))
+        self.chunk_starts = np.concatenate(([0], np.cumsum(self.footer['chunk_rows'], dtype=np.int64)))
+
+    @property
+    def num_rows(self):
+        return self.footer['num_rows']
+
+    def keys(self):
+        return list(self.footer['keys']) + list(self.footer.get('attrs', {}).keys())
+
+    def __getitem__(self, key):
+        if key in self.footer.get('attrs', {}):
+            item = self.footer['attrs'][key]
+            return np.asarray(item['values'], dtype=np.dtype(item['dtype'])).reshape(item['shape'])
+        return self.read(key)
+
+    def read(self, key, start=0, end=None):
+        """Return rows [start, end) of array key, decompressing only chunks which overlap the rows"""
+        if key not in self.footer['arrays']:
+            raise KeyError("Array {} does not exist in {}!".format(key, self.filename))
+        end = self.num_rows if end is None else min(end, self.num_rows)
+        item = self.footer['arrays'][key]
+        dtype, row_shape = np.dtype(item['dtype']), tuple(item['row_shape'])
+        if start >= end:
+            return np.empty((0,) + row_shape, dtype=dtype)
+        first = int(np.searchsorted(self.chunk_starts, start, side='right')) - 1
+        last = int(np.searchsorted(self.chunk_starts, end, side='left'))
+        with open(self.filename, 'rb') as reader:
+            compressed = []
+            for offset, size in item['chunks'][first:last]:
+                reader.seek(offset)
+                compressed.append(reader.read(size))
+        decompress = CODECS[self.footer['codec']][1]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.nthreads) as executor:
+            data = list(executor.map(decompress, compressed))
+        a = np.frombuffer(b''.join(data), dtype=dtype).reshape((-1,) + row_shape)
+        base = self.chunk_starts[first]
+        return a[start - base:end - base]
+
+    def read_rows(self, start=0, end=None):
+        """Return {key: rows [start, end)} of all arrays"""
+        return {key: self.read(key, start, end) for key in self.keys()}
+
+
+def read_manifest(in_dir, dataset_format=None, version=None):
+    """Return manifest.json of a dataset directory, check format and version unless they are None"""
+    manifest_filename = op.join(in_dir, MANIFEST_FILENAME)
+    if not op.exists(manifest_filename):
+        raise ValueError("Could not find {} of dataset {}!".format(MANIFEST_FILENAME, in_dir))
+    manifest = json.load(open(manifest_filename, 'r'))
+    if (dataset_format is not None and manifest.get('format') != dataset_format) or \
+            (version is not None and manifest.get('version') != version):
+        raise ValueError("Unsupported dataset format {} version {} of {}!".format(
+            manifest.get('format'), manifest.get('version'), in_dir))
+    return manifest
+
+
+def load_npy_dir(in_dir, mmap_mode='r'):
+    """
+    Load a dataset written by NpyDirWriter, and return {key: array}.
+    Arrays are memory-mapped read-only by default, so loading is instant and pages are shared by processes.
+    """
+    manifest = read_manifest(in_dir, DATASET_FORMAT_NPY_DIR, NPY_DIR_VERSION)
+    d = {}
+    for key, item in manifest['arrays'].items():
+        d[key] = np.load(op.join(in_dir, item['filename']), mmap_mode=mmap_mode)
+        if list(d[key].shape) != item['shape']:
+            raise ValueError("Array {} of {} has shape {}, expected {}!".format(key, in_dir, d[key].shape, item['shape']))
+    for name, filename in manifest.get('attrs', {}).items():
+        d[name] = np.load(op.join(in_dir, filename))
+    return d
+
+
+class ShardedDatasetWriter(object):
+    """
+    Write a dataset as numbered shards of shard_rows rows each, except the last one, to
+    {out_dir}/shard-{index:05d}.{dataset_format}, and on close() write {out_dir}/manifest.json,
+    which records rows and label histogram of each shard, see load_sharded_dataset.
+        out_dir --- output directory, e.g., {prefix}.shards
+        shard_rows --- number of rows per shard
+        dataset_format --- format of shards, npz or npydir
+        keys --- names of arrays
+        labels --- names of columns of one-hot LABEL_KEY array, to count labels of each shard
+        metadata --- extra items of manifest.json, e.g., {'features': [...]}
+        compression --- compression of chunked shards, see open_dataset_writer
+        attrs --- {name: small array} not aligned with rows, saved in each shard, see NpzStreamWriter
+        append --- if True, append new shards to an existing dataset of out_dir, which must have the same
+                   shard format, shard rows, keys, attrs and labels. Existing shards are not rewritten, and
+                   items of the existing manifest.json other than shards are kept.
+    Label histograms count rows represented by each row, i.e., COUNTS_KEY, if rows are collapsed.
+    manifest.json is replaced atomically, so that readers see either the old or the new dataset.
+    """
+
+    def __init__(self, out_dir, shard_rows, dataset_format=DATASET_FORMAT_NPZ, keys=DATASET_KEYS,
+                 labels=None, metadata=None, compression=None, attrs=None, append=False):
+        if shard_rows <= 0:
+            raise ValueError("Number of rows per shard must be positive, got {}!".format(shard_rows))
+        self.out_dir = out_dir
+        self.shard_rows = shard_rows
+        self.dataset_format = dataset_format
+        self.keys = list(keys)
+        self.labels = labels
+        self.metadata = dict(metadata or {})
+        self.compression = compression
+        self.attrs = dict(attrs or {})
+        self.shards = []
+        self.writer = None
+        self.label_counts = None
+        if append:
+            self.load_manifest()
+        if not op.exists(out_dir):
+            os.makedirs(out_dir)
+
+    def load_manifest(self):
+        """Load shards and metadata of an existing dataset of out_dir to append new shards"""
+        manifest = read_manifest(self.out_dir, DATASET_FORMAT_SHARDS, SHARDS_VERSION)
+        expected = {'shard_format': self.dataset_format, 'shard_rows': self.shard_rows, 'keys': self.keys,
+                    'attrs': sorted(self.attrs), 'labels': self.labels}
+        for name, value in expected.items():
+            if manifest.get(name) != value:
+                raise ValueError("Could not append to {}, whose {} is {}, not {}!".format(
+                    self.out_dir, name, manifest.get(name), value))
+        self.shards = manifest.pop('shards')
+        for name in ['format', 'version', 'num_rows'] + list(expected):
+            manifest.pop(name, None)
+        self.metadata.update(manifest)
+
+    @property
+    def num_rows(self):
+        return sum([shard['num_rows'] for shard in self.shards]) + (0 if self.writer is None else self.writer.num_rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.writer is not None:
+            self.writer.__exit__(exc_type, exc_value, traceback)
+
+    def shard_prefix(self, index):
+        return op.join(self.out_dir, 'shard-{:05d}'.format(index))
+
+    def write(self, **arrays):
+        """Append a block of rows, which may span shards, e.g., write(fextractinput=a, arrowqv=b, ...)"""
+        num_rows = len(arrays[self.keys[0]])
+        start = 0
+        while start < num_rows:
+            if self.writer is None:
+                self.writer = open_dataset_writer(self.shard_prefix(len(self.shards)), self.dataset_format, self.keys,
+                                                  compression=self.compression, attrs=self.attrs)
+                self.label_counts = None
+            end = start + min(num_rows - start, self.shard_rows - self.writer.num_rows)
+            block = {key: a[start:end] for key, a in arrays.items()}
+            self.writer.write(**block)
+            if self.labels is not None and LABEL_KEY in block:
+                if COUNTS_KEY in block:
+                    counts = np.dot(np.asarray(block[COUNTS_KEY], dtype=np.int64),
+                                    (np.asarray(block[LABEL_KEY]) != 0).astype(np.int64))
+                else:
+                    counts = np.count_nonzero(block[LABEL_KEY], axis=0)
+                self.label_counts = counts if self.label_counts is None else self.label_counts + counts
+            start = end
+            if self.writer.num_rows >= self.shard_rows:
+                self.close_shard()
+
+    def close_shard(self):
+        shard = {'filename': op.basename(dataset_filename(self.shard_prefix(len(self.shards)), self.dataset_format)),
+                 'num_rows': self.writer.num_rows}
+        if self.label_counts is not None:
+            shard['label_histogram'] = {label: int(count) for label, count in zip(self.labels, self.label_counts)}
+        self.writer.close()
+        self.writer = None
+        self.shards.append(shard)
+
+    def close(self):
+        """Close the last shard and write manifest.json"""
+        if self.writer is not None:
+            self.close_shard()
+        manifest = dict(self.metadata)
+        manifest.update({'format': DATASET_FORMAT_SHARDS, 'version': SHARDS_VERSION,
+                         'shard_format': self.dataset_format, 'shard_rows': self.shard_rows,
+                         'num_rows': self.num_rows, 'keys': self.keys, 'attrs': sorted(self.attrs), 'labels': self.labels,
+                         'shards': self.shards})
+        manifest_filename = op.join(self.out_dir, MANIFEST_FILENAME)
+        with open(manifest_filename + '.tmp', 'w') as writer:
+            json.dump(manifest, writer, indent=4, sort_keys=True)
+        os.replace(manifest_filename + '.tmp', manifest_filename)
+        log.info("Written {} rows in {} shards to {}".format(self.num_rows, len(self.shards), self.out_dir))
+
+
+class ShardedDataset(object):
+    """
+    Read a dataset written by ShardedDatasetWriter lazily. Support keys() and [key] the same as np.load of .npz
+    files, where [key] concatenates rows of array key of all shards, and attrs are read from the first shard.
+    Shards are opened on access, and only arrays which are accessed are read, e.g., npydir shards are
+    memory-mapped, and rows of a single shard, see read, are returned without copying.
+        in_dir --- input directory
+        shards --- indices of shards to read, None to read all shards
+        mmap_mode --- mmap_mode of npydir shards, see load_npy_dir
+    """
+
+    def __init__(self, in_dir, shards=None, mmap_mode='r'):
+        self.in_dir = in_dir
+        self.mmap_mode = mmap_mode
+        self.manifest = read_manifest(in_dir, DATASET_FORMAT_SHARDS, SHARDS_VERSION)
+        self.shards = self.manifest['shards'] if shards is None else [self.manifest['shards'][idx] for idx in shards]
+        if len(self.shards) == 0:
+            raise ValueError("No shards to load from {}!".format(in_dir))
+        self.shard_starts = np.concatenate(([0], np.cumsum([shard['num_rows'] for shard in self.shards],
+                                                           dtype=np.int64)))
+
+    @property
+    def num_rows(self):
+        return int(self.shard_starts[-1])
+
+    def keys(self):
+        return list(self.manifest['keys']) + list(self.manifest.get('attrs', []))
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __getitem__(self, key):
+        if key in self.manifest.get('attrs', []):
+            return self.load_shard(0)[key]
+        return self.read(key)
+
+    def load_shard(self, idx):
+        """Return {key: array} of the idx-th shard to read, see load_dataset"""
+        return load_dataset(op.join(self.in_dir, self.shards[idx]['filename']), mmap_mode=self.mmap_mode)
+
+    def read(self, key, start=0, end=None):
+        """Return rows [start, end) of array key, reading only shards which overlap the rows"""
+        if key not in self.manifest['keys']:
+            raise KeyError("Array {} does not exist in {}!".format(key, self.in_dir))
+        end = self.num_rows if end is None else min(end, self.num_rows)
+        start = min(start, end)
+        first = min(len(self.shards) - 1, int(np.searchsorted(self.shard_starts, start, side='right')) - 1)
+        last = max(first + 1, int(np.searchsorted(self.shard_starts, end, side='left')))
+        arrays = []
+        for idx in range(first, last):
+            d = self.load_shard(idx)
+            shard_start, shard_end = max(0, start - self.shard_starts[idx]), end - self.shard_starts[idx]
+            if isinstance(d, ChunkedDataset):
+                arrays.append(d.read(key, shard_start, shard_end))
+            else:
+                arrays.append(d[key][shard_start:shard_end])
+        return arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+
+
+def load_sharded_dataset(in_dir, shards=None, mmap_mode='r'):
+    """
+    Load a dataset written by ShardedDatasetWriter, and return a ShardedDataset, whose [key] is rows of all shards.
+        shards --- indices of shards to load, None to load all shards
+    """
+    return ShardedDataset(in_dir, shards=shards, mmap_mode=mmap_mode)
+
+
+def load_dataset(filename, mmap_mode='r'):
+    """
+    Load a dataset of any format, and return {key: array}, or a ChunkedDataset or ShardedDataset which supports
+    keys() and [key] alike, see load_npy_dir and load_sharded_dataset.
+    """
+    if not op.isdir(filename):
+        with open(filename, 'rb') as reader:
+            if reader.read(len(CHUNKED_MAGIC)) == CHUNKED_MAGIC:
+                return ChunkedDataset(filename)
+        return np.load(filename)
+    if read_manifest(filename).get('format') == DATASET_FORMAT_SHARDS:
+        return load_sharded_dataset(filename, mmap_mode=mmap_mode)
+    return load_npy_dir(filename, mmap_mode=mmap_mode)
+
+
+def load_dataset_attr(filename, name):
+    """
+    Return attr name of a dataset of any format, or None if it does not exist, without reading rows of arrays,
+    e.g., only manifest.json and the attr of the first shard of a sharded dataset.
+    """
+    if op.isdir(filename) and read_manifest(filename).get('format') == DATASET_FORMAT_SHARDS:
+        d = ShardedDataset(filename, shards=[0])
+    else:
+        d = load_dataset(filename, mmap_mode='r')
+    return np.asarray(d[name]) if name in list(d.keys()) else None
+
+
+class DuplicateCollapsingWriter(object):
+    """
+    Collapse rows of identical values of arrays key_columns into unique rows, in the order of their first
+    occurrences, and on close() write unique rows and COUNTS_KEY, the number of rows of each unique row, to writer.
+    Values of other arrays, e.g., arrowqv, are those of the first occurrence.
+    Memory does not grow with the number of rows: rows of each block are collapsed and spilled to
+    num_partitions partition files on disk by hash of key columns, so that identical rows are in the same
+    partition. On close(), each partition is collapsed by np.unique, after being split again by another hash
+    if it is larger than max_memory, and collapsed partitions are merged in the order of first occurrences.
+        writer --- dataset writer of keys and COUNTS_KEY, see open_dataset_writer
+        spill_dir --- directory of partition files, which is removed on close()
+        keys --- names of arrays
+        key_columns --- names of arrays which identify a row
+        max_memory --- approximate number of bytes of rows to collapse or merge at once
+        num_partitions --- number of partitions of rows
+    """
+
+    def __init__(self, writer, spill_dir, keys=DATASET_KEYS, key_columns=COLLAPSE_KEYS,
+                 max_memory=DEFAULT_COLLAPSE_MEMORY, num_partitions=COLLAPSE_PARTITIONS):
+        self.writer = writer
+        self.spill_dir = spill_dir
+        self.keys = list(keys)
+        self.key_columns = list(key_columns)
+        self.max_memory = int(max_memory)
+        self.num_partitions = num_partitions
+        self.dtypes = {}
+        self.row_shapes = {}
+        self.record_dtype = None
+        self.num_rows = 0
+        self.num_unique_rows = 0
+        if not op.exists(spill_dir):
+            os.makedirs(spill_dir)
+        self.partitions = [open(self.partition_filename(0, idx), 'wb') for idx in range(num_partitions)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.remove_spill_dir()
+            self.writer.__exit__(exc_type, exc_value, traceback)
+
+    def partition_filename(self, level, idx):
+        return op.join(self.spill_dir, 'partition-{}-{:05d}.spill'.format(level, idx))
+
+    @staticmethod
+    def key_bytes(a):
+        """Return a contiguous copy of a, whose -0.0 is replaced by 0.0, so that equal rows have equal bytes"""
+        a = np.asarray(a)
+        return np.ascontiguousarray(a + a.dtype.type(0) if np.issubdtype(a.dtype, np.floating) else a)
+
+    def key_rows(self, records):
+        """Return a 1d void array of bytes of key columns of records, so that equal rows have equal values"""
+        row_bytes = np.concatenate([self.key_bytes(records[key]).reshape(len(records), -1).view(np.uint8)
+                                    for key in self.key_columns], axis=1)
+        return np.ascontiguousarray(row_bytes).view('V{}'.format(row_bytes.shape[1])).reshape(-1)
+
+    @staticmethod
+    def partition_indices(rows, level, num_partitions):
+        """Return partition indices of rows, a 1d void array, by a hash of their bytes salted by level"""
+        row_bytes = rows.view(np.uint8).reshape(len(rows), -1)
+        width = -(-row_bytes.shape[1] // 8) * 8
+        words = np.zeros((len(rows), width), dtype=np.uint8)
+        words[:, :row_bytes.shape[1]] = row_bytes
+        words = words.view(np.uint64)
+        h = np.full(len(rows), 0xcbf29ce484222325 + level, dtype=np.uint64)
+        for col in range(words.shape[1]):
+            h ^= words[:, col]
+            h *= np.uint64(0x100000001b3)
+            h ^= h >> np.uint64(29)
+        return ((h >> np.uint64(32)) % np.uint64(num_partitions)).astype(np.int64)
+
+    def collapse(self, records):
+        """Return unique records of key columns in the order of first occurrences, whose counts are summed"""
+        _, first, inverse = np.unique(self.key_rows(records), return_index=True, return_inverse=True)
+        counts = np.bincount(inverse.reshape(-1), weights=records[COUNTS_KEY], minlength=len(first))
+        out = records[first]
+        out[COUNTS_KEY] = counts.astype(np.int64)
+        return out[np.argsort(out['row'], kind='stable')]
+
+    def write(self, **arrays):
+        """Append a block of rows, e.g., write(fextractinput=a, arrowqv=b, ...)"""
+        arrays, num_rows = check_block(self.keys, arrays, self.dtypes, self.row_shapes)
+        if num_rows == 0:
+            return
+        if self.record_dtype is None:
+            self.record_dtype = np.dtype([('row', np.int64), (COUNTS_KEY, np.int64)] +
+                                         [(key, self.dtypes[key], self.row_shapes[key]) for key in self.keys])
+        records = np.empty(num_rows, dtype=self.record_dtype)
+        records['row'] = np.arange(self.num_rows, self.num_rows + num_rows)
+        records[COUNTS_KEY] = 1
+        for key in self.keys:
+            records[key] = arrays[key]
+        self.num_rows += num_rows
+        self.spill(self.collapse(records), 0, self.partitions)
+
+    def spill(self, records, level, writers):
+        """Append records to partition files of writers by partition indices of level"""
+        parts = self.partition_indices(self.key_rows(records), level, len(writers))
+        order = np.argsort(parts, kind='stable')
+        bounds = np.searchsorted(parts[order], np.arange(len(writers) + 1))
+        for idx, writer in enumerate(writers):
+            if bounds[idx + 1] > bounds[idx]:
+                writer.write(records[order[bounds[idx]:bounds[idx + 1]]].tobytes())
+
+    def collapse_partition(self, filename, level):
+        """Yield collapsed records of a partition file, split by hash of level + 1 if larger than max_memory"""
+        size = op.getsize(filename)
+        if size == 0:
+            pass
+        elif size <= self.max_memory or level >= MAX_COLLAPSE_LEVEL:
+            yield self.collapse(np.fromfile(filename, dtype=self.record_dtype))
+        else:
+            filenames = [self.partition_filename(level + 1, idx) for idx in range(self.num_partitions)]
+            writers = [open(name, 'wb') for name in filenames]
+            rows_per_block = max(1, self.max_memory // self.record_dtype.itemsize)
+            with open(filename, 'rb') as reader:
+                while True:
+                    records = np.fromfile(reader, dtype=self.record_dtype, count=rows_per_block)
+                    if len(records) == 0:
+                        break
+                    self.spill(records, level + 1, writers)
+            for writer in writers:
+                writer.close()
+            for name in filenames:
+                for records in self.collapse_partition(name, level + 1):
+                    yield records
+        os.remove(filename)
+
+    def merge_runs(self, filenames):
+        """
+        Write records of run files, each of which is sorted by row, to writer in the order of rows, reading
+        runs block by block.
+        """
+        rows_per_block = max(1, self.max_memory // (self.record_dtype.itemsize * max(1, len(filenames))))
+        readers = [open(name, 'rb') for name in filenames]
+        try:
+            buffers = [np.fromfile(reader, dtype=self.record_dtype, count=rows_per_block) for reader in readers]
+            while any([len(b) > 0 for b in buffers]):
+                # Rows of each run up to the smallest last row of non-empty buffers are all buffered
+                bound = min([b['row'][-1] for b in buffers if len(b) > 0])
+                ready = [b[b['row'] <= bound] for b in buffers]
+                records = np.concatenate(ready)
+                records = records[np.argsort(records['row'], kind='stable')]
+                self.writer.write(**{COUNTS_KEY: records[COUNTS_KEY]}, **{key: records[key] for key in self.keys})
+                self.num_unique_rows += len(records)
+                records, ready = None, None
+                for idx, reader in enumerate(readers):
+                    buffers[idx] = buffers[idx][buffers[idx]['row'] > bound]
+                    if len(buffers[idx]) == 0:
+                        buffers[idx] = np.fromfile(reader, dtype=self.record_dtype, count=rows_per_block)
+        finally:
+            for reader in readers:
+                reader.close()
+
+    def close(self):
+        """Collapse partitions, write unique rows and their counts, and close writer"""
+        for writer in self.partitions:
+            writer.close()
+        if self.record_dtype is not None:
+            runs = []
+            for idx in range(self.num_partitions):
+                for records in self.collapse_partition(self.partition_filename(0, idx), 0):
+                    runs.append(op.join(self.spill_dir, 'run-{:05d}.spill'.format(len(runs))))
+                    records.tofile(runs[-1])
+            self.merge_runs(runs)
+        self.remove_spill_dir()
+        self.writer.close()
+        log.info("Collapsed {} rows into {} unique rows".format(self.num_rows, self.num_unique_rows))
+
+    def remove_spill_dir(self):
+        for writer in self.partitions:
+            writer.close()
+        if op.exists(self.spill_dir):
+            shutil.rmtree(self.spill_dir)
+
+
+def dataset_filename(output_prefix, dataset_format=DATASET_FORMAT_NPZ, shard_rows=0):
+    """Return {output_prefix}.npz or {output_prefix}.npydir, or {output_prefix}.shards if shard_rows > 0"""
+    if dataset_format not in DATASET_FORMATS:
+        raise ValueError("Unsupported dataset format {}! Only support {}".format(dataset_format, DATASET_FORMATS))
+    return output_prefix + '.' + (DATASET_FORMAT_SHARDS if shard_rows > 0 else dataset_format)
+
+
+def open_dataset_writer(output_prefix, dataset_format=DATASET_FORMAT_NPZ, keys=DATASET_KEYS, shard_rows=0,
+                        labels=None, metadata=None, compression=None, attrs=None, collapse_duplicates=False,
+                        append=False, collapse_memory=None):
+    """
+    Return a writer of dataset_filename(output_prefix, dataset_format, shard_rows).
+    If shard_rows > 0, write shards of dataset_format, see ShardedDatasetWriter for labels and metadata.
+        compression --- {'codec': ..., 'level': ..., 'nthreads': ...} of chunked format, see ChunkedDatasetWriter
+        attrs --- {name: small array} not aligned with rows, see NpzStreamWriter
+        collapse_duplicates --- if True, write unique rows of COLLAPSE_KEYS and their COUNTS_KEY,
+                                see DuplicateCollapsingWriter
+        collapse_memory --- max_memory of DuplicateCollapsingWriter, None for DEFAULT_COLLAPSE_MEMORY
+        append --- if True, append new shards to an existing sharded dataset, which requires shard_rows > 0
+    """
+    if collapse_duplicates:
+        writer = open_dataset_writer(output_prefix, dataset_format, keys=list(keys) + [COUNTS_KEY],
+                                     shard_rows=shard_rows, labels=labels, metadata=metadata,
+                                     compression=compression, attrs=attrs, append=append)
+        return DuplicateCollapsingWriter(writer, output_prefix + '.collapse.tmp', keys=keys,
+                                         max_memory=collapse_memory or DEFAULT_COLLAPSE_MEMORY)
+    filename = dataset_filename(output_prefix, dataset_format, shard_rows)
+    if append and shard_rows <= 0:
+        raise ValueError("Could only append to a sharded dataset, shard rows must be positive!")
+    if shard_rows > 0:
+        return ShardedDatasetWriter(filename, shard_rows, dataset_format=dataset_format, keys=keys,
+                                    labels=labels, metadata=metadata, compression=compression, attrs=attrs,
+                                    append=append)
+    if dataset_format == DATASET_FORMAT_CHUNKED:
+        return ChunkedDatasetWriter(filename, keys=keys, attrs=attrs, **(compression or {}))
+    if dataset_format == DATASET_FORMAT_NPY_DIR:
+        return NpyDirWriter(filename, keys=keys, attrs=attrs)
+    return NpzStreamWriter(filename, keys=keys, attrs=attrs)
@@ -6,6 +6,7 @@ import os.path as op
 import csv
 from tfccs.utils import load_fextract_npz
 from tfccs.fextract2numpy import one_hot_to_cigar, convert_fextract_row
+from tfccs.fextract_index import iter_lines, ROWS_INDEX_SUFFIX
 from argparse import ArgumentParser
 
 
@@ -28,7 +29,8 @@ def eval_model(model_dir, x_test, y_test):
 
 
 def npz_csv_must_match(y_test, in_csv):
-    reader = csv.DictReader(open(in_csv, 'r'), delimiter=',')
+    """in_csv --- fextract.csv, or a row index such as {prefix}.rows.idx, see iter_lines"""
+    reader = csv.DictReader(iter_lines(in_csv), delimiter=',')
     idx = 0
     for idx, r in enumerate(reader):
         _, _, one_hot_encoded_cigar = convert_fextract_row(r)
@@ -42,10 +44,11 @@ def npz_csv_must_match(y_test, in_csv):
 
 def add_predicted_cigars_and_write(in_csv, predicted_cigars, out_csv):
     """
-    For each row in in_csv, simply attach predicted_cigars[row] as the last column and write to out_csv
+    For each row in in_csv, simply attach predicted_cigars[row] as the last column and write to out_csv.
+    in_csv may be a row index such as {prefix}.rows.idx, whose rows are streamed from the indexed fextract.csv.
     """
-    with open(in_csv, 'r') as reader, open(out_csv, 'w') as writer:
-        for idx, r in enumerate(reader):
+    with open(out_csv, 'w') as writer:
+        for idx, r in enumerate(iter_lines(in_csv)):
             predicted_cigar_idx = idx - 1
             if idx == 0:
                 writer.write(
@@ -66,10 +69,12 @@ def run(args):
     tfpb_file = op.join(args.in_model_dir, 'saved_model.pb')
     if not op.exists(tfpb_file):
         raise IOError("Could not find tensorflow saved model file {}!".format(tfpb_file))
-    if not args.in_fextract_csv.endswith('.csv'):
-        raise ValueError("Input fextact csv file {} must ends with csv!".format(args.in_fextract_csv))
-    if not args.in_fextract_npz.endswith('.npz'):
-        raise ValueError("Input fextact npz file {} must ends with npz!".format(args.in_fextract_npz))
+    if not args.in_fextract_csv.endswith(('.csv', ROWS_INDEX_SUFFIX)):
+        raise ValueError("Input fextact csv file {} must ends with csv or {}!".format(
+            args.in_fextract_csv, ROWS_INDEX_SUFFIX))
+    if not args.in_fextract_npz.rstrip('/').endswith(('.npz', '.npydir', '.shards', '.chunked')):
+        raise ValueError("Input fextact npz file {} must ends with npz, npydir, shards or chunked!".format(
+            args.in_fextract_npz))
     if not args.out_csv.endswith('.csv'):
         raise ValueError("Output fextact csv file {} must ends with csv!".format(args.out_csv))
 
@@ -84,8 +89,10 @@ def get_parser():
     desc = """Load a model and evaluate on test data."""
     p = ArgumentParser(desc)
     p.add_argument("in_model_dir", help="Input tensorflow model directory.")
-    p.add_argument("in_fextract_npz", help="Input fextract.npz file for test")
-    p.add_argument("in_fextract_csv", help="Input fextract.csv file which must match input fextract.npz")
+    p.add_argument("in_fextract_npz", help="Input fextract.npz file or fextract.npydir directory for test")
+    p.add_argument("in_fextract_csv", help=("Input fextract.csv file which must match input fextract.npz, " +
+                                            "or a row index file {} created by fextract2numpy --raw-rows index".format(
+                                                ROWS_INDEX_SUFFIX)))
     p.add_argument("out_csv", help="Output csv the same as input_fextract_csv with an additional column PredictedCigar")
     return p
 
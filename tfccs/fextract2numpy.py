@@ -5,20 +5,39 @@ Convert each row of fextract.csv to features to use in NN training.
 1) Exclude NO_TRAIN_FEATURES, and DUPLICATED_FEATURES
 2) One-hot encode each CCSBase from ACGT to 1000, 0100, 0010, 0001
 
+fextract.csv is parsed in blocks of rows rather than row by row, see tfccs.fextract_reader.
+Benchmark: python script/bench_fextract2numpy.py
+
 Compression rate: 10 fold, 700MB fextract.csv --> 70MB npz
 Runtime: 2 minutes
 """
+import collections
 import datetime
+import hashlib
+import itertools
 import numpy as np
 import timeit
 import argparse
-import csv
 import sys
 import json
 import logging
+import multiprocessing
+import os
 import os.path as op
-from tfccs.constants import NO_TRAIN_FEATURES, ORDERED_FEATURES_KEY, BASE_MAP_PROBABILITY_KEY
-from tfccs.utils import load_fextract_stat_json, is_good_fextract_row, cap_outlier_standardize, add_filter_args
+from tfccs.constants import NO_TRAIN_FEATURES, ORDERED_FEATURES_KEY, BASE_MAP_PROBABILITY_KEY, STANDARDIZE_CAP
+from tfccs.utils import (load_fextract_stat_json, cap_outlier_standardize, standardized_range, add_filter_args,
+                         parse_memory_size, load_stat_version, is_progress_due,
+                         add_decompression_threads_arg)
+from tfccs.dataset import (open_dataset_writer, FeatureQuantizer, read_manifest, dataset_filename, DATASET_KEYS,
+                           DATASET_FORMATS, DATASET_FORMAT_NPZ, DATASET_FORMAT_SHARDS, SHARDS_VERSION, CODECS,
+                           FEATURE_DTYPES, STAT_VERSION_ATTR)
+from tfccs.fextract_reader import (FextractReader, read_header, column_dtype, open_fextract_readers,
+                                   task_byte_ranges, DEFAULT_BLOCK_SIZE)
+from tfccs.fextract_input import is_stdin, expand_fextract_inputs, DEFAULT_DECOMPRESSION_THREADS
+from tfccs.fextract_filter import RowFilter
+from tfccs.fextract_index import RowIndexWriter, ROWS_INDEX_SUFFIX
+from tfccs.sampling import (StratifiedReservoir, sample_keys, SAMPLE_FIRST, SAMPLE_RESERVOIR, SAMPLE_MODES,
+                            DEFAULT_SEED)
 
 FORMATTER = op.basename(__file__) + ':%(levelname)s:'+'%(message)s'
 logging.basicConfig(level=logging.DEBUG, format=FORMATTER)
@@ -26,6 +45,18 @@ log = logging.getLogger(__name__)
 
 
 DUPLICATED_FEATURES = ["CCSBaseSNR"]  # duplication of SNR_A/SNR_C/SNR_G/SNR_T
+MEMORY_PER_BLOCK_BYTE = 10  # Peak memory per byte of a fextract csv block: raw, parsed and converted rows
+COLLAPSE_MEMORY_FACTOR = 4  # Collapsing a partition sorts copies of its rows, see collapse_memory_for_memory
+MIN_BLOCK_SIZE = 1024 * 1024
+RAW_ROWS_CSV = 'csv'  # Copy kept rows to {output_prefix}.fextract.csv
+RAW_ROWS_INDEX = 'index'  # Record offsets of kept rows in fextract.csv to {output_prefix}.rows.idx
+RAW_ROWS_MODES = [RAW_ROWS_CSV, RAW_ROWS_INDEX]
+BASE_MAP_NAMES = {'=': 'SequenceMatch', 'I': 'Insertion', 'X': 'Substitution', 'D': 'PreviousIsDeletion'}
+SAMPLING_RATE_KEY = 'SamplingRate'  # Fraction of input rows of each class kept by stratified sampling
+SAMPLING_STRATA_KEY = 'SamplingStrata'  # Fractions of classes in each level of strata, see BaseMapCounter
+BASE_MAP_STRATA = ['ArrowQv', 'CCSHPLength', 'CCSToGenomeStrand']
+MAX_STRATUM_HP_LENGTH = 10  # CCSHPLength >= 10 are in one level
+STRAND_LEVELS = 'FR*'  # '*' for any other strand
 
 
 def arrowqv2bin8(arrowqv):
@@ -99,6 +130,95 @@ def ccs2genome_cigar_counting_prev_dels(current_cigar, num_prev_deletions):
     return ret
 
 
+# Lookup tables which map a byte to a class code, INVALID_CODE for unexpected bytes.
+# Class codes are column indices in one-hot encodes, e.g., ACGT-: PrevBase0A, ..., PrevBase0T, PrevBase0GAP
+INVALID_CODE = 255
+BASE_ALPHABET = 'ACGT'
+BASE_OR_GAP_ALPHABET = 'ACGT-'
+CIGAR_ALPHABET = '=IXD'  # Must match cigar_index_in_one_hot
+
+
+def make_lut(alphabet, ignore_case=True):
+    """Return a lookup table of 256 uint8 codes, which maps each letter of alphabet to its index."""
+    lut = np.full(256, INVALID_CODE, dtype=np.uint8)
+    for idx, letter in enumerate(alphabet):
+        lut[ord(letter)] = idx
+        if ignore_case:
+            lut[ord(letter.upper())] = idx
+            lut[ord(letter.lower())] = idx
+    return lut
+
+
+BASE_LUT = make_lut(BASE_ALPHABET)
+BASE_OR_GAP_LUT = make_lut(BASE_OR_GAP_ALPHABET)
+CIGAR_LUT = make_lut(CIGAR_ALPHABET[:-1], ignore_case=False)  # 'D' is only encoded from CcsToGenomePrevDeletions
+STRAND_LUT = make_lut(STRAND_LEVELS[:-1], ignore_case=False)
+
+
+def one_hot_suffix(letter):
+    return 'GAP' if letter == '-' else letter
+
+
+def byte_matrix(values):
+    """Return a 2d uint8 view of a fixed width bytes array, one row per value, padded by 0."""
+    values = np.ascontiguousarray(values)
+    return values.view(np.uint8).reshape(len(values), values.dtype.itemsize)
+
+
+def encode_chars(chars, lut, values, name):
+    """
+    Map a 2d uint8 array of characters, one row per value, through lut to codes.
+    Raise ValueError on unexpected characters.
+    """
+    codes = lut[chars]
+    bad = (codes == INVALID_CODE).any(axis=1)
+    if bad.any():
+        raise ValueError("Unexpected {} {}!".format(name, values[bad][0]))
+    return codes
+
+
+def encode_bases_block(values, num_bases=1, alphabet=BASE_ALPHABET, name='CCSBase'):
+    """
+    Block version of one_hot_base and one_hot_base_or_gap.
+        values --- bytes array, each value has exactly num_bases bases, e.g., CCSBase or PrevBases
+        alphabet --- BASE_ALPHABET or BASE_OR_GAP_ALPHABET
+    Return (one_hot, codes), where one_hot is a float32 array of shape (N, num_bases * len(alphabet)),
+    whose columns are alphabet of the 1st base, then alphabet of the 2nd base, ..., and codes is a
+    uint8 array of shape (N, num_bases) of indices in alphabet.
+    """
+    chars = byte_matrix(values)
+    if chars.shape[1] > num_bases and chars[:, num_bases].any():
+        raise ValueError("Unexpected {} {}!".format(name, values[chars[:, num_bases] != 0][0]))
+    if chars.shape[1] < num_bases:
+        chars = np.pad(chars, ((0, 0), (0, num_bases - chars.shape[1])))
+    lut = BASE_OR_GAP_LUT if alphabet == BASE_OR_GAP_ALPHABET else make_lut(alphabet)
+    codes = encode_chars(chars[:, :num_bases], lut, values, name)
+    n_letters = len(alphabet)
+    one_hot = np.zeros((len(values), num_bases * n_letters), dtype=np.float32)
+    one_hot[np.arange(len(values))[:, None], codes + np.arange(num_bases) * n_letters] = 1
+    return one_hot, codes
+
+
+def encode_cigars_block(cigars, prev_deletions):
+    """
+    Block version of ccs2genome_cigar_counting_prev_dels.
+        cigars --- bytes array of CCSToGenomeCigar
+        prev_deletions --- int array of CcsToGenomePrevDeletions
+    Return (one_hot, codes), where one_hot is a float32 array of shape (N, 4) and codes is
+    a uint8 array of shape (N,), both in the order of CIGAR_ALPHABET.
+    """
+    prev_dels = np.asarray(prev_deletions) != 0
+    chars = byte_matrix(cigars)
+    # Bases following deletions are 'D' regardless of CCSToGenomeCigar
+    bad = (chars[:, 1] != 0) & ~prev_dels if chars.shape[1] > 1 else np.zeros(len(cigars), dtype=bool)
+    codes = np.where(prev_dels, np.uint8(cigar_index_in_one_hot('D')), CIGAR_LUT[chars[:, 0]])
+    bad |= codes == INVALID_CODE
+    if bad.any():
+        raise ValueError("Unexpected CCSToGenomeCigar {}!".format(cigars[bad][0]))
+    one_hot = np.eye(len(CIGAR_ALPHABET), dtype=np.float32)[codes]
+    return one_hot, codes
+
+
 def convert_fextract_row(input_d):
     """
     1) Remove NO_TRAIN_FEATURES and DUPLICATED_FEATURES
@@ -126,141 +246,844 @@ def convert_fextract_row(input_d):
     return input_d, arrow_qv, ccs2genome_cigar
 
 
+BASE_COLUMNS = ['CCSBase', 'PrevBases', 'NextBases']
+
+
+def fextract_out_features(fieldnames):
+    """
+    Return output features of convert_fextract_row in the same order, given input fextract.csv fieldnames.
+    """
+    base_features = [f for f in one_hot_base('A').keys()]
+    for column in ['PrevBases', 'NextBases']:
+        if column in fieldnames:
+            prefix = column[:-1]  # PrevBases -> PrevBase
+            base_features.extend(one_hot_base_or_gap('A', prefix + '0').keys())
+            base_features.extend(one_hot_base_or_gap('A', prefix + '1').keys())
+    excluded = set(NO_TRAIN_FEATURES + BASE_COLUMNS + DUPLICATED_FEATURES)
+    out_features = [f for f in fieldnames if f not in excluded]
+    return out_features + [f for f in base_features if f not in out_features]
+
+
+def fextract_in_columns(fieldnames):
+    """
+    Return columns of fextract.csv which must be parsed to filter rows and convert rows.
+    """
+    needed = set(NO_TRAIN_FEATURES).difference(['Movie', 'HoleNumber', 'PrevCcsToGenomeCigar',
+                                                'NextCcsToGenomeCigar', 'Insertion0_FWD', 'Insertion0_REV'])
+    return [f for f in fieldnames if f in needed or f not in NO_TRAIN_FEATURES]
+
+
+CONVERT_COLUMNS = ['CCSBase', 'ArrowQv', 'CCSToGenomeCigar', 'CcsToGenomePrevDeletions']
+
+
+class ProjectionPlan(object):
+    """
+    Projection of fextract columns to output features, compiled once from the fextract.csv header,
+    so that converting a block is a gather of numeric columns plus one-hot encoders, see convert_fextract_block.
+        fieldnames --- fieldnames of fextract.csv
+    Raise ValueError if columns required to convert rows are missing, or if an output feature is not numeric.
+    """
+
+    def __init__(self, fieldnames):
+        self.fieldnames = list(fieldnames)
+        missing = [c for c in CONVERT_COLUMNS if c not in self.fieldnames]
+        if missing:
+            raise ValueError("Columns {} required to convert fextract rows do not exist!".format(missing))
+        self.out_features = fextract_out_features(self.fieldnames)
+        index = {f: idx for idx, f in enumerate(self.out_features)}
+        # (source column, output column) of features copied as is
+        self.numeric = [(f, index[f]) for f in self.fieldnames if f in index]
+        non_numeric = [f for f, _ in self.numeric if np.dtype(column_dtype(f)).kind == 'S']
+        if non_numeric:
+            raise ValueError("Could not convert non-numeric columns {} to features!".format(non_numeric))
+        # (source column, number of bases, alphabet, output columns) of one-hot encoded bases
+        self.encoders = [('CCSBase', 1, BASE_ALPHABET, [index['CCSBase' + one_hot_suffix(letter)]
+                                                        for letter in BASE_ALPHABET])]
+        for column in ['PrevBases', 'NextBases']:
+            if column in self.fieldnames:
+                prefix = column[:-1]  # PrevBases -> PrevBase
+                self.encoders.append((column, 2, BASE_OR_GAP_ALPHABET,
+                                      [index[prefix + str(pos) + one_hot_suffix(letter)]
+                                       for pos in range(2) for letter in BASE_OR_GAP_ALPHABET]))
+        covered = [col for _, col in self.numeric] + [col for e in self.encoders for col in e[3]]
+        if sorted(covered) != list(range(len(self.out_features))):
+            raise ValueError("Output features {} do not match fextract columns!".format(self.out_features))
+
+    def __len__(self):
+        return len(self.out_features)
+
+    def numeric_runs(self, dtype):
+        """
+        Group numeric features into runs of float32 fields which are adjacent in both dtype and output features.
+        Return a list of (first field, number of fields, first output column) of each run.
+        """
+        runs = []
+        for f, col in self.numeric:
+            field_dtype, offset = dtype.fields[f][:2]
+            if field_dtype == np.float32 and runs and runs[-1][3] == np.float32:
+                first, num, first_col, _ = runs[-1]
+                if offset == dtype.fields[first][1] + 4 * num and col == first_col + num:
+                    runs[-1][1] += 1
+                    continue
+            runs.append([f, 1, col, field_dtype])
+        return [(f, num, col) for f, num, col, _ in runs]
+
+    def project(self, data, indices=None):
+        """
+        Return a 2d float32 array of output features of rows of indices of data, a numpy structured array
+        of fextract rows, None for all rows. Only projected fields of rows are copied, not whole rows of data.
+        """
+        rows = slice(None) if indices is None else indices
+        out = np.empty((len(data) if indices is None else len(indices), len(self.out_features)), dtype=np.float32)
+        # Copy a run of float32 fields as one 2d view of rows, instead of field by field
+        for f, num, col in self.numeric_runs(data.dtype):
+            if num == 1:
+                out[:, col] = data[f][rows]
+                continue
+            view = np.dtype({'names': [f], 'formats': [(np.float32, (num,))], 'offsets': [data.dtype.fields[f][1]],
+                             'itemsize': data.dtype.itemsize})
+            out[:, col:col + num] = data.view(view)[f][rows]
+        for column, num_bases, alphabet, cols in self.encoders:
+            out[:, cols], _ = encode_bases_block(data[column][rows], num_bases, alphabet, column)
+        return out
+
+
+def convert_fextract_block(data, plan, indices=None):
+    """
+    Block version of convert_fextract_row.
+        data --- numpy structured array of fextract rows, see FextractReader
+        plan --- ProjectionPlan of fextract.csv
+        indices --- indices of good rows of data to convert, None to convert all rows
+    Return (features, arrow_qvs, ccs2genome_cigars), where features is a 2d float32 array
+    whose columns are plan.out_features, and ccs2genome_cigars is one-hot encoded.
+    """
+    rows = slice(None) if indices is None else indices
+    out = plan.project(data, indices)
+    arrow_qvs = data['ArrowQv'][rows].astype(np.float32)
+    ccs2genome_cigars, _ = encode_cigars_block(data['CCSToGenomeCigar'][rows],
+                                               data['CcsToGenomePrevDeletions'][rows])
+    return out, arrow_qvs, ccs2genome_cigars
+
+
+def arrowqv2bin8_block(arrow_qvs):
+    """Block version of arrowqv2bin8"""
+    arrowqvfloor = (np.asarray(arrow_qvs) / 10.0).astype(np.int64)
+    arrowqvfloor[arrowqvfloor > 7] = 7
+    return np.eye(8, dtype=np.float32)[arrowqvfloor]
+
+
+def convert_fextract_rows(reader, plan, row_filter, max_rows=0, with_raw_rows=True, strata=()):
+    """
+    Filter and convert rows of a FextractReader block by block.
+        reader --- FextractReader
+        plan --- ProjectionPlan of fextract.csv
+        row_filter --- RowFilter
+        max_rows --- stop after max_rows good rows, 0 means no limitation
+        with_raw_rows --- False to return b'' as raw_rows, when only row_spans are needed
+        strata --- columns of BASE_MAP_STRATA to count base maps by, see strata_codes
+    Yield (features, arrow_qvs, ccs2genome_cigars, raw_rows, row_spans, strata_codes) of good rows in each block,
+    see FextractBlock.row_spans.
+    """
+    num_rows = 0
+    for block in reader:
+        good_indices = np.flatnonzero(row_filter.mask(block.data))
+        if max_rows > 0:
+            good_indices = good_indices[:max_rows - num_rows]
+        out_r, arrow_qv, ccs2genome_cigar = convert_fextract_block(block.data, plan, good_indices)
+        raw_rows = block.raw_rows(good_indices) if with_raw_rows else b''
+        codes = strata_codes(strata, block.data, good_indices)
+        row_spans, block = block.row_spans(good_indices), None
+        yield out_r, arrow_qv, ccs2genome_cigar, raw_rows, row_spans, codes
+        out_r, arrow_qv, ccs2genome_cigar, raw_rows, row_spans, codes = None, None, None, None, None, None
+        num_rows += len(good_indices)
+        if max_rows > 0 and num_rows >= max_rows:
+            return
+
+
+def convert_fextract_byte_range(args):
+    """
+    Worker of multi-process conversion, which filters and converts rows in a byte range of fextract.csv,
+    or all rows of fextract.csv if byte range is None.
+    Return (features, arrow_qvs, ccs2genome_cigars, raw_rows, row_spans, strata_codes) of good rows in this range.
+    """
+    (fextract_filename, byte_range, columns, plan, row_filter, max_rows, block_size, with_raw_rows, nthreads,
+     strata) = args
+    reader = FextractReader(fextract_filename, columns=columns, block_size=block_size, byte_range=byte_range,
+                            nthreads=nthreads)
+    outs = [out for out in convert_fextract_rows(reader, plan, row_filter, max_rows, with_raw_rows, strata)]
+    if len(outs) == 0:
+        n_col = len(plan)
+        return (np.empty((0, n_col), dtype=np.float32), np.empty(0, dtype=np.float32),
+                np.empty((0, 4), dtype=np.float32), b'', np.empty((0, 2), dtype=np.uint64),
+                np.empty((0, len(strata)), dtype=np.int64))
+    return (np.concatenate([out[0] for out in outs]), np.concatenate([out[1] for out in outs]),
+            np.concatenate([out[2] for out in outs]), b''.join([out[3] for out in outs]),
+            np.concatenate([out[4] for out in outs]), np.concatenate([out[5] for out in outs]))
+
+
+def sample_fextract_rows(reader, plan, row_filter, reservoir, file_index, sample, seed, stratified=False,
+                         with_raw_rows=True, strata=()):
+    """
+    Add good rows of a FextractReader to a StratifiedReservoir and return it, see tfccs.sampling.
+    Only rows whose keys are less than thresholds of reservoirs are converted.
+        file_index --- index of the fextract file of reader
+        sample, seed --- see sample_keys
+        stratified --- True if classes of rows are ccs2genome cigar classes in the order of CIGAR_ALPHABET,
+                       otherwise all rows are of class 0.
+    Columns of the reservoir are (file_indices, offsets, features, arrow_qvs, ccs2genome_cigars, raw_rows,
+    row_spans, strata_codes), where raw_rows is an object array of raw bytes of each row, b'' if not with_raw_rows.
+    """
+    for block in reader:
+        good_indices = np.flatnonzero(row_filter.mask(block.data))
+        row_spans = block.row_spans(good_indices)
+        keys = sample_keys(sample, seed, file_index, row_spans[:, 0])
+        if stratified:
+            _, classes = encode_cigars_block(block['CCSToGenomeCigar'][good_indices],
+                                             block['CcsToGenomePrevDeletions'][good_indices])
+        else:
+            classes = np.zeros(len(good_indices), dtype=np.uint8)
+        reservoir.count(classes)
+        candidates = reservoir.candidates(keys, classes)
+        good_indices, row_spans, keys, classes = (good_indices[candidates], row_spans[candidates],
+                                                  keys[candidates], classes[candidates])
+        if len(good_indices) > 0:
+            out_r, arrow_qv, ccs2genome_cigar = convert_fextract_block(block.data, plan, good_indices)
+            raw_rows = np.full(len(good_indices), b'', dtype=object)
+            if with_raw_rows:
+                raw_rows[:] = [block.raw[start:end] for start, end in
+                               zip(block.row_starts[good_indices], block.row_ends[good_indices])]
+            reservoir.add(keys, classes, np.full(len(keys), file_index, dtype=np.int64), row_spans[:, 0],
+                          out_r, arrow_qv, ccs2genome_cigar, raw_rows, row_spans,
+                          strata_codes(strata, block.data, good_indices))
+        block = None
+    return reservoir
+
+
+def sample_fextract_byte_range(args):
+    """Worker of multi-process sampling, which returns a StratifiedReservoir of a byte range, see sample_fextract_rows"""
+    (fextract_filename, file_index, byte_range, columns, plan, row_filter, quotas, sample, seed, stratified,
+     block_size, with_raw_rows, nthreads, strata) = args
+    reader = FextractReader(fextract_filename, columns=columns, block_size=block_size, byte_range=byte_range,
+                            nthreads=nthreads)
+    return sample_fextract_rows(reader, plan, row_filter, StratifiedReservoir(quotas), file_index, sample, seed,
+                                stratified, with_raw_rows, strata)
+
+
+def sampled_rows(reservoir):
+    """Yield rows of a reservoir of sample_fextract_rows in the input order, the same as convert_fextract_rows"""
+    rows = reservoir.rows(sort_by=[0, 1])
+    if rows is not None:
+        _, _, out_r, arrow_qv, ccs2genome_cigar, raw_rows, row_spans, codes = rows
+        yield out_r, arrow_qv, ccs2genome_cigar, b''.join(raw_rows), row_spans, codes
+
+
+def parse_class_quotas(s, value_type=int):
+    """
+    Parse per-class values of ccs2genome cigar classes, e.g., '=:100000,I:50000,X:50000,D:50000',
+    return a list of values in the order of CIGAR_ALPHABET. All classes must have positive values.
+    """
+    d = {}
+    for item in s.split(','):
+        cigar, _, value = item.strip().rpartition(':')
+        if cigar not in CIGAR_ALPHABET or cigar in d:
+            raise ValueError("Could not parse class {} of '{}', expected e.g., '=:100,I:50,X:50,D:50'!".format(
+                cigar, s))
+        try:
+            d[cigar] = value_type(value)
+        except ValueError:
+            raise ValueError("Could not parse value {} of class {} in '{}'!".format(value, cigar, s))
+    missing = [cigar for cigar in CIGAR_ALPHABET if cigar not in d]
+    if missing or min(d.values()) <= 0:
+        raise ValueError("Values of all classes {} must be positive, got '{}'!".format(list(CIGAR_ALPHABET), s))
+    return [d[cigar] for cigar in CIGAR_ALPHABET]
+
+
+def class_quotas_from_ratios(ratios, num_rows):
+    """Split num_rows into quotas of classes proportional to ratios, each quota is at least 1"""
+    ratios = np.asarray(ratios, dtype=np.float64)
+    return [max(1, int(q)) for q in np.floor(num_rows * ratios / ratios.sum())]
+
+
+class RawRowsWriter(object):
+    """
+    Write kept rows of fextract.csv, which evalmodel joins with predictions.
+        fextract_filename --- input fextract.csv
+        output_prefix --- output prefix
+        mode --- RAW_ROWS_CSV: copy kept rows to {output_prefix}.fextract.csv,
+                 RAW_ROWS_INDEX: record offsets of kept rows to a row index {output_prefix}.rows.idx,
+                 which refers to fextract_filename instead of duplicating rows, see tfccs.fextract_index.
+                 Compressed or piped fextract_filename only supports RAW_ROWS_CSV.
+        header --- header of fextract_filename, None to read from fextract_filename
+        append --- if True, append rows to an existing {output_prefix}.fextract.csv of the same header, which
+                   is truncated back to its original size on errors. Only supports RAW_ROWS_CSV.
+    """
+
+    def __init__(self, fextract_filename, output_prefix, mode=RAW_ROWS_CSV, header=None, append=False):
+        if mode not in RAW_ROWS_MODES:
+            raise ValueError("Unsupported raw rows mode {}! Only support {}".format(mode, RAW_ROWS_MODES))
+        self.mode = mode
+        self.append_offset = None
+        if mode == RAW_ROWS_CSV:
+            self.filename = output_prefix + '.fextract.csv'
+            header = read_header(fextract_filename) if header is None else header
+            if append and op.exists(self.filename):
+                if read_header(self.filename) != header:
+                    raise ValueError("Could not append rows to {} of a different header!".format(self.filename))
+                self.append_offset = op.getsize(self.filename)
+                self.writer = open(self.filename, 'a')
+            else:
+                self.writer = open(self.filename, 'w')
+                self.writer.write(header)
+        elif append:
+            raise ValueError("Could not append raw rows to a row index, use {}!".format(RAW_ROWS_CSV))
+        else:
+            self.filename = output_prefix + ROWS_INDEX_SUFFIX
+            self.writer = RowIndexWriter(self.filename, fextract_filename)
+
+    @property
+    def with_raw_rows(self):
+        """True if raw bytes of rows are required, otherwise only row spans are required"""
+        return self.mode == RAW_ROWS_CSV
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.writer.__exit__(exc_type, exc_value, traceback)
+            if self.append_offset is not None:
+                os.truncate(self.filename, self.append_offset)
+
+    def write(self, raw_rows, row_spans):
+        """Append kept rows, see FextractBlock.raw_rows and FextractBlock.row_spans"""
+        if self.mode == RAW_ROWS_CSV:
+            self.writer.write(raw_rows.decode())
+        else:
+            self.writer.write(row_spans[:, 0], row_spans[:, 1])
+
+    def close(self):
+        self.writer.close()
+        print("Created raw rows {}.".format(self.filename))
+
+
+def ordered_imap(pool, func, tasks, max_pending):
+    """
+    Similar to pool.imap(func, tasks), but only submit at most max_pending tasks ahead of
+    the consumer, so that memory of pending results is bounded.
+    """
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def block_size_for_memory(max_memory, nproc):
+    """
+    Return size of fextract csv blocks, so that converting blocks uses about max_memory bytes.
+    With multiple processes, up to nproc + 1 pending blocks and a block being written are in memory.
+    """
+    num_blocks_in_memory = 1 if nproc <= 1 else nproc + 2
+    return max(MIN_BLOCK_SIZE, max_memory // (MEMORY_PER_BLOCK_BYTE * num_blocks_in_memory))
+
+
+def collapse_memory_for_memory(max_memory):
+    """
+    Return bytes of rows which DuplicateCollapsingWriter collapses or merges at once, so that collapsing,
+    which sorts copies of rows, uses about max_memory bytes, or None for its default if max_memory is None.
+    """
+    return None if max_memory is None else max(1, max_memory // COLLAPSE_MEMORY_FACTOR)
+
+
+def get_standardized_columns(out_features, stat_d, stat_features):
+    """
+    Return [(column index in out_features, FextractStat)] of features to standardize.
+        stat_d, stat_features --- see load_fextract_stat_json
+    """
+    standardized_columns = []
+    for stat_feature in stat_features.difference(DUPLICATED_FEATURES):
+        if stat_feature not in out_features:
+            raise ValueError("Feature {} exists in stat json file but not in fextract csv!".format(stat_feature))
+        # stat_d: feature -> FextractStat
+        standardized_columns.append((out_features.index(stat_feature), stat_d[stat_feature]))
+    return standardized_columns
+
+
+def standardize(npa, standardized_columns, clip_quantiles=False):
+    """
+    Standardize columns of a 2d array in place and return it, see get_standardized_columns.
+    If clip_quantiles, clip outliers at q0.1 and q99.9 instead of +-STANDARDIZE_CAP, see cap_outlier_standardize.
+    """
+    for col, stat in standardized_columns:
+        npa[:, col] = cap_outlier_standardize(npa[:, col], stat, clip_quantiles=clip_quantiles)
+    return npa
+
+
+def quantization_ranges(out_features, fieldnames, standardized_columns, clip_quantiles=False):
+    """
+    Return [(min, max)] of each output feature to quantize features to int8, see FeatureQuantizer.
+    Standardized features are within [-STANDARDIZE_CAP, STANDARDIZE_CAP], or within standardized q0.1 and q99.9
+    if clip_quantiles, see standardized_range. One-hot encoded bases are 0 or 1.
+    """
+    ranges = [None] * len(out_features)
+    for col, stat in standardized_columns:
+        ranges[col] = standardized_range(stat, STANDARDIZE_CAP, clip_quantiles=clip_quantiles)
+    for col, feature in enumerate(out_features):
+        if feature not in fieldnames:  # One-hot encoded bases, see fextract_out_features
+            ranges[col] = (0, 1)
+    missing = [feature for feature, r in zip(out_features, ranges) if r is None]
+    if missing:
+        raise ValueError("Could not quantize features {} to int8, which are not standardized!".format(missing))
+    return ranges
+
+
+def create_quantizer(out_features, fieldnames, standardized_columns, feature_dtype, clip_quantiles=False):
+    """Return FeatureQuantizer of output features, see quantization_ranges"""
+    ranges = None
+    if feature_dtype == 'int8':
+        ranges = quantization_ranges(out_features, fieldnames, standardized_columns, clip_quantiles=clip_quantiles)
+    return FeatureQuantizer(out_features, dtype=feature_dtype, ranges=ranges)
+
+
+def write_output_features(output_prefix, out_features):
+    """Write output features to {output_prefix}.header as txt and {output_prefix}.features.order.json"""
+    out_header_filename = output_prefix + ".header"
+    with open(out_header_filename, 'w') as writer:
+        writer.write(','.join(out_features))
+
+    out_ordered_features_json_filename = output_prefix + ".features.order.json"
+    with open(out_ordered_features_json_filename, 'w') as writer:
+        json.dump({ORDERED_FEATURES_KEY: out_features}, writer, sort_keys=True, indent=4)
+    print("Created header file {}.".format(out_ordered_features_json_filename))
+
+
+def stratum_levels(stratum):
+    """Return names of levels of a stratum of BASE_MAP_STRATA, see stratum_codes"""
+    if stratum == 'ArrowQv':  # The same bins as arrowqv2bin8
+        return ['{}-{}'.format(10 * i, 10 * i + 9) for i in range(7)] + ['70+']
+    if stratum == 'CCSHPLength':
+        return [str(i) for i in range(MAX_STRATUM_HP_LENGTH)] + ['{}+'.format(MAX_STRATUM_HP_LENGTH)]
+    if stratum == 'CCSToGenomeStrand':
+        return list(STRAND_LEVELS)
+    raise ValueError("Unsupported base map stratum {}! Only support {}".format(stratum, BASE_MAP_STRATA))
+
+
+def stratum_codes(stratum, values):
+    """Return int64 indices of levels of values of column stratum, see stratum_levels"""
+    if stratum == 'ArrowQv':
+        return np.clip(np.asarray(values) / 10.0, 0, 7).astype(np.int64)
+    if stratum == 'CCSHPLength':
+        return np.clip(np.asarray(values, dtype=np.int64), 0, MAX_STRATUM_HP_LENGTH)
+    if stratum == 'CCSToGenomeStrand':
+        codes = STRAND_LUT[byte_matrix(values)[:, 0]].astype(np.int64)
+        codes[codes == INVALID_CODE] = len(STRAND_LEVELS) - 1
+        return codes
+    raise ValueError("Unsupported base map stratum {}! Only support {}".format(stratum, BASE_MAP_STRATA))
+
+
+def strata_codes(strata, data, indices=None):
+    """
+    Return a 2d int64 array of levels of rows of indices of fextract rows data, None for all rows,
+    one column per stratum of strata
+    """
+    rows = slice(None) if indices is None else indices
+    out = np.empty((len(data) if indices is None else len(indices), len(strata)), dtype=np.int64)
+    for col, stratum in enumerate(strata):
+        out[:, col] = stratum_codes(stratum, data[stratum][rows])
+    return out
+
+
+class BaseMapCounter(object):
+    """
+    Count ccs2genome cigar classes of converted rows by one np.bincount per block, in total and
+    in each level of strata, e.g., ArrowQv bins, see stratum_levels.
+        strata --- columns of BASE_MAP_STRATA to count by
+    """
+
+    def __init__(self, strata=()):
+        self.strata = list(strata)
+        self.levels = [stratum_levels(stratum) for stratum in self.strata]
+        self.counts = np.zeros(len(CIGAR_ALPHABET), dtype=np.int64)
+        self.strata_counts = [np.zeros((len(levels), len(CIGAR_ALPHABET)), dtype=np.int64) for levels in self.levels]
+
+    def update(self, ccs2genome_cigars, codes):
+        """Count rows of one-hot encoded ccs2genome_cigars and levels codes, see strata_codes"""
+        n = len(CIGAR_ALPHABET)
+        classes = np.argmax(np.asarray(ccs2genome_cigars).reshape(-1, n), axis=1)
+        self.counts += np.bincount(classes, minlength=n)
+        for col, levels in enumerate(self.levels):
+            self.strata_counts[col] += np.bincount(codes[:, col] * n + classes,
+                                                   minlength=len(levels) * n).reshape(len(levels), n)
+
+    def strata_tables(self):
+        """Return {stratum: {level: counts of classes}} of levels which have rows"""
+        return {stratum: {level: counts for level, counts in zip(levels, table) if counts.sum() > 0}
+                for stratum, levels, table in zip(self.strata, self.levels, self.strata_counts)}
+
+
+def class_fractions(counts):
+    """Return {name of class: fraction} of counts of classes in the order of CIGAR_ALPHABET"""
+    n = int(np.sum(counts))
+    # see one_hot_encode_cigar, order '=IXD': {0, 1, 2, 3}
+    return {BASE_MAP_NAMES[cigar]: float(counts[cigar_index_in_one_hot(cigar)]) / n for cigar in CIGAR_ALPHABET}
+
+
+def base_map_probability(cigar_counts):
+    # Return fraction of bases in 'I=XD' classes
+    assert len(cigar_counts) == 4, "Must have exactly 4 output classes each representing a cigar operation"
+    return {"Sampling": class_fractions(cigar_counts)}
+
+
+def dataset_metadata(fextract_filename, out_features, stat_json, feature_dtype='float32', clip_quantiles=False):
+    """Return items of manifest.json of a sharded dataset, which identify how the dataset was created"""
+    stat_version = None if stat_json is None else load_stat_version(stat_json)
+    stat_json_sha1 = None
+    if stat_json is not None:
+        with open(stat_json, 'rb') as reader:
+            stat_json_sha1 = hashlib.sha1(reader.read()).hexdigest()
+    return {'fextract_filename': fextract_filename if is_stdin(fextract_filename) else op.abspath(fextract_filename),
+            ORDERED_FEATURES_KEY: out_features,
+            'stat_json': None if stat_json is None else op.abspath(stat_json), 'stat_json_sha1': stat_json_sha1,
+            'stat_version': stat_version,
+            'feature_dtype': feature_dtype, 'clip_quantiles': clip_quantiles}
+
+
+def dataset_attrs(quantizer, stat_json):
+    """
+    Return attrs of a dataset, scales and offsets of quantized features, see FeatureQuantizer, and the version
+    of stat_json which standardized features, if any, see tfccs.utils.check_dataset_stat_version.
+    """
+    attrs = dict(quantizer.attrs)
+    if stat_json is not None:
+        attrs[STAT_VERSION_ATTR] = np.array(load_stat_version(stat_json), dtype=np.int64)
+    return attrs
+
+
+def check_append(output_prefix, metadata, shard_rows):
+    """
+    Check that new rows of metadata, see dataset_metadata, can be appended to the existing sharded dataset
+    {output_prefix}.shards, whose {output_prefix}.features.order.json, stat json hash, feature dtype and
+    clipping of outliers must match.
+    Return the manifest of the existing dataset.
+    """
+    if shard_rows <= 0:
+        raise ValueError("Could only append to a sharded dataset, shard rows must be positive!")
+    manifest = read_manifest(dataset_filename(output_prefix, shard_rows=shard_rows), DATASET_FORMAT_SHARDS,
+                             SHARDS_VERSION)
+    with open(output_prefix + '.features.order.json', 'r') as reader:
+        ordered_features = json.load(reader)[ORDERED_FEATURES_KEY]
+    if ordered_features != metadata[ORDERED_FEATURES_KEY] or \
+            manifest.get(ORDERED_FEATURES_KEY) != metadata[ORDERED_FEATURES_KEY]:
+        raise ValueError("Could not append rows of features {} to {}.shards of features {}!".format(
+            metadata[ORDERED_FEATURES_KEY], output_prefix, ordered_features))
+    for name, default in [('stat_json_sha1', None), ('feature_dtype', 'float32'), ('clip_quantiles', False)]:
+        if manifest.get(name, default) != metadata[name]:
+            raise ValueError("Could not append rows of {} {} to {}.shards of {} {}!".format(
+                name, metadata[name], output_prefix, name, manifest.get(name, default)))
+    return manifest
+
+
+def label_counts_of_shards(manifest):
+    """Return counts of ccs2genome cigars '=IXD' of all shards of a sharded dataset manifest"""
+    return np.array([sum([shard['label_histogram'][cigar] for shard in manifest['shards']])
+                     for cigar in CIGAR_ALPHABET], dtype=np.int64)
+
+
+def write_base_map_probability(output_prefix, cigar_counts, sampling_rates=None, strata_tables=None):
+    """
+    Write probabilty of base map '=IXD' in Sampling spaces to {output_prefix}.base_map_probability.json
+        sampling_rates --- None, or fractions of input rows of each class in the order of CIGAR_ALPHABET, which are
+                           kept by stratified sampling, and written to 'SamplingRate' next to 'Sampling'.
+        strata_tables --- None, or {stratum: {level: counts of classes}}, see BaseMapCounter.strata_tables, which
+                          are written to 'SamplingStrata' as {stratum: {level: {class: fraction, 'Count': rows}}}.
+    """
+    out_base_map_prob_json = output_prefix + '.base_map_probability.json'
+    out_probs = base_map_probability(cigar_counts)
+    if sampling_rates is not None:
+        out_probs[SAMPLING_RATE_KEY] = {BASE_MAP_NAMES[cigar]: float(rate)
+                                        for cigar, rate in zip(CIGAR_ALPHABET, sampling_rates)}
+    if strata_tables:
+        out_probs[SAMPLING_STRATA_KEY] = {stratum: {level: dict(class_fractions(counts), Count=int(counts.sum()))
+                                                    for level, counts in table.items()}
+                                          for stratum, table in strata_tables.items()}
+    print("Dump Base Map probability {} to: {}".format(out_probs, out_base_map_prob_json))
+    with open(out_base_map_prob_json, 'w') as writer:
+        json.dump({BASE_MAP_PROBABILITY_KEY: out_probs}, writer, sort_keys=True, indent=4)
+
+
 def fextract2numpy(fextract_filename, output_prefix,
                    min_dist2end, allowed_strands,
                    allowed_ccs2genome_cigars, min_np, max_np,
-                   num_train_rows, stat_json):
+                   num_train_rows, stat_json, block_size=DEFAULT_BLOCK_SIZE, nproc=1, max_memory=None,
+                   filters=None, raw_rows=RAW_ROWS_CSV, output_format=DATASET_FORMAT_NPZ, shard_rows=0,
+                   compression=None, feature_dtype='float32', decompression_threads=DEFAULT_DECOMPRESSION_THREADS,
+                   sample=SAMPLE_FIRST, seed=DEFAULT_SEED, class_quotas=None, collapse_duplicates=False,
+                   append=False, base_map_strata=None, clip_quantiles=False):
+    """
+    Convert good rows of fextract_filename to standardized features, and write to output_prefix.npz,
+    or to output_prefix.npydir if output_format is 'npydir', see tfccs.dataset.
+    If shard_rows > 0, write shards of shard_rows rows to output_prefix.shards, see dataset_metadata.
+    compression --- codec, level and threads of 'chunked' output format, see compression_from_args.
+    feature_dtype --- store standardized features as float32, float16 or int8, see FeatureQuantizer.
+                      Reconstruction errors are written to output_prefix.quantization.json.
+    Good rows pass filter arguments and all predicates of filters, e.g., ['CCSHPLength<=8'], see RowFilter.
+    Kept rows are copied to output_prefix.fextract.csv, or indexed by output_prefix.rows.idx, see RawRowsWriter.
+    Rows are converted, standardized and written in blocks, so that peak memory is about
+    max_memory bytes regardless of input size, None to use default block_size. Duplicate rows are collapsed in
+    partitions spilled to disk, which are collapsed within max_memory as well, see collapse_memory_for_memory.
+    fextract_filename may be gzip or bgzip compressed, or '-' for stdin, which only supports nproc=1.
+    fextract_filename may also be a glob pattern or a .fofn file of fextract files with the same header, see
+    expand_fextract_inputs. Files are converted in order, by nproc processes, and written to one output
+    of at most num_train_rows rows in total.
+    sample --- SAMPLE_FIRST to convert the first num_train_rows good rows, or SAMPLE_RESERVOIR to convert
+               a uniform sample of num_train_rows good rows drawn using seed, in the input order, see tfccs.sampling.
+    class_quotas --- None, or numbers of rows of each ccs2genome cigar class in the order of CIGAR_ALPHABET, which
+                     override num_train_rows. Rows of each class are sampled by sample, and all rows of a class
+                     are kept if there are fewer rows than its quota. Sampling rates of classes are written to
+                     output_prefix.base_map_probability.json, see write_base_map_probability.
+    collapse_duplicates --- if True, collapse rows of identical standardized features and ccs2genome cigar into
+                            unique rows and their counts, see DuplicateCollapsingWriter. Raw rows are not collapsed.
+    append --- if True, append new shards of converted rows to the existing output_prefix.shards, which must have
+               the same features, stat json and output options, see check_append, and append raw rows to
+               output_prefix.fextract.csv. Base map probabilities are updated from label histograms of all shards.
+    base_map_strata --- None, or columns of BASE_MAP_STRATA, e.g., ['ArrowQv'], to write base map probabilities
+                        of each level of each column to output_prefix.base_map_probability.json, see BaseMapCounter.
+    clip_quantiles --- if True, clip outliers of features at q0.1 and q99.9 of stat_json before standardization,
+                       instead of capping standardized features at +-STANDARDIZE_CAP, see cap_outlier_standardize.
+    """
+    if clip_quantiles and stat_json is None:
+        raise ValueError("Could not clip features at quantiles without a stat json file!")
+    if sample not in SAMPLE_MODES:
+        raise ValueError("Unsupported sample mode {}! Only support {}".format(sample, SAMPLE_MODES))
+    if class_quotas is not None:
+        if len(class_quotas) != len(CIGAR_ALPHABET) or min(class_quotas) <= 0:
+            raise ValueError("Quotas of classes {} must be positive, got {}!".format(list(CIGAR_ALPHABET),
+                                                                                 class_quotas))
+        num_train_rows = sum(class_quotas)
+        if append:
+            raise ValueError("Could not append stratified samples, whose sampling rates differ from existing rows!")
+    if base_map_strata and append:
+        raise ValueError("Could not append base map probabilities of strata, which are not kept in shards!")
+    if sample == SAMPLE_RESERVOIR and num_train_rows <= 0:
+        raise ValueError("Reservoir sampling requires a positive number of training rows!")
     if num_train_rows == 0:
         log.info("Will convert all qualified rows to output npz!")
+    if max_memory is not None:
+        block_size = min(block_size, block_size_for_memory(max_memory, nproc))
+        log.info("Converting fextract csv in blocks of {} bytes, max memory {} bytes".format(block_size, max_memory))
 
-    reader = csv.DictReader(open(fextract_filename, 'r'), delimiter=',')
-    raw_reader = open(fextract_filename, 'r')
-    header = next(raw_reader)  # Skip header
-    features = reader.fieldnames
+    fextract_filenames = expand_fextract_inputs(fextract_filename)
+    readers = open_fextract_readers(fextract_filenames, block_size=block_size, nthreads=decompression_threads)
+    if nproc > 1 and is_stdin(fextract_filename):
+        raise ValueError("Could not convert stdin by multiple processes!")
+    if raw_rows == RAW_ROWS_INDEX and len(fextract_filenames) > 1:
+        raise ValueError("Could not index raw rows of multiple fextract files {}!".format(fextract_filename))
+    features = readers[0].fieldnames
 
     # If fextract.stat.json was provided as input, check features in csv and stat.json MATCH
     stat_d, stat_features = None, None
     if stat_json is not None:
         stat_d, stat_features = load_fextract_stat_json(stat_json)
-        trainable_features = set(features).difference(set(NO_TRAIN_FEATURES + ['CCSBase', 'PrevBases', 'NextBases']))
+        trainable_features = set(features).difference(set(NO_TRAIN_FEATURES + BASE_COLUMNS))
         if trainable_features != stat_features:
             raise ValueError("Features in csv and stat.json differ!\n" +
                              "Unique features in csv: {}\nUnique features in stat.json: {}\n".format(
                                  trainable_features.difference(stat_features), stat_features.difference(trainable_features)))
 
-    dataset = []
-    arrow_qvs = []
-    ccs2genome_cigars = []
-    idx = 0
-    out_features = None
+    plan = ProjectionPlan(features)
+    out_features = plan.out_features
+    row_filter = RowFilter(min_dist2end=min_dist2end, allowed_strands=allowed_strands,
+                           allowed_ccs2genome_cigars=allowed_ccs2genome_cigars, min_np=min_np, max_np=max_np,
+                           predicates=filters)
+    base_map_counter = BaseMapCounter(base_map_strata or [])
+    strata = base_map_counter.strata
+    missing = [stratum for stratum in strata if stratum not in features]
+    if missing:
+        raise ValueError("Could not count base maps by {}, which are not columns of fextract csv!".format(missing))
+    columns = sorted(set(fextract_in_columns(features) + row_filter.columns(features) + strata), key=features.index)
+    for reader in readers:
+        reader.select(columns)
+
+    # If fextract.stat.json provided and check, apply normalization to each column.
+    standardized_columns = []
+    if stat_d is not None and stat_features is not None:
+        standardized_columns = get_standardized_columns(out_features, stat_d, stat_features)
+    quantizer = create_quantizer(out_features, features, standardized_columns, feature_dtype, clip_quantiles)
+    metadata = dataset_metadata(fextract_filename, out_features, stat_json, feature_dtype, clip_quantiles)
+    if append:
+        check_append(output_prefix, metadata, shard_rows)
+
+    def collect(converted):
+        # Standardize and write converted rows in order, until num_train_rows rows are collected.
+        n = 0
+        for out_r, arrow_qv, ccs2genome_cigar, raw_rows, row_spans, codes in converted:
+            if num_train_rows > 0 and n + len(out_r) > num_train_rows:
+                keep = num_train_rows - n
+                out_r, arrow_qv, ccs2genome_cigar = out_r[:keep], arrow_qv[:keep], ccs2genome_cigar[:keep]
+                row_spans, codes = row_spans[:keep], codes[:keep]
+                if raw_rows:
+                    raw_rows = raw_rows[:int((row_spans[:, 1] - row_spans[:, 0]).sum())]
+            raw_rows_writer.write(raw_rows, row_spans)
+            out_r = standardize(out_r, standardized_columns, clip_quantiles)
+            npz_writer.write(fextractinput=quantizer.quantize(out_r),
+                             arrowqv=arrow_qv, arrowqvbin8=arrowqv2bin8_block(arrow_qv),
+                             ccs2genome_cigars=ccs2genome_cigar)
+            base_map_counter.update(ccs2genome_cigar, codes)
+            n += len(out_r)
+            if is_progress_due(n, len(out_r)):
+                print("Processing {} rows".format(n))
+            out_r, arrow_qv, ccs2genome_cigar, raw_rows, row_spans, codes = None, None, None, None, None, None
+            if num_train_rows > 0 and n >= num_train_rows:
+                break
+        return n
 
     t0 = datetime.datetime.now()
-    raw_train_writer = open(output_prefix + '.fextract.csv', 'w')
-    raw_train_writer.write(header)
-    for r, raw_r in zip(reader, raw_reader):
-        is_good = is_good_fextract_row(r, min_dist2end=min_dist2end,
-                                       allowed_strands=allowed_strands,
-                                       allowed_ccs2genome_cigars=allowed_ccs2genome_cigars,
-                                       min_np=min_np, max_np=max_np)
-        if not is_good:
-            continue
-        out_r, arrow_qv, ccs2genome_cigar = convert_fextract_row(r)
-        if out_features is None:
-            out_features = list(out_r.keys())
-        else:
-            if out_features != list(out_r.keys()):
-                raise ValueError("Could not convert row {} to consistent output features!".format(r[0:50]))
-        if (num_train_rows == 0 or idx < num_train_rows):
-            raw_train_writer.write(raw_r)
+    with RawRowsWriter(fextract_filenames[0], output_prefix, raw_rows, header=readers[0].header,
+                       append=append) as raw_rows_writer, \
+            open_dataset_writer(output_prefix, output_format, keys=DATASET_KEYS, shard_rows=shard_rows,
+                                labels=list(CIGAR_ALPHABET), metadata=metadata,
+                                compression=compression, attrs=dataset_attrs(quantizer, stat_json),
+                                collapse_duplicates=collapse_duplicates, append=append,
+                                collapse_memory=collapse_memory_for_memory(max_memory)) as npz_writer:
+        with_raw_rows = raw_rows_writer.with_raw_rows
+        sampling_rates = None
+        if sample == SAMPLE_RESERVOIR or class_quotas is not None:
+            # Sample byte ranges into reservoirs, which are merged exactly, see tfccs.sampling.
+            stratified = class_quotas is not None
+            quotas = class_quotas if stratified else [num_train_rows]
+            reservoir = StratifiedReservoir(quotas)
+            if nproc > 1:
+                tasks = [(reader.filename, file_index, byte_range, columns, plan, row_filter, quotas, sample, seed,
+                          stratified, block_size, with_raw_rows, decompression_threads, strata)
+                         for file_index, reader in enumerate(readers)
+                         for byte_range in task_byte_ranges(reader, nproc, block_size, len(readers))]
+                log.info("Sampling {} byte ranges of {} files using {} processes".format(
+                    len(tasks), len(readers), nproc))
+                with multiprocessing.Pool(nproc) as pool:
+                    for task_reservoir in ordered_imap(pool, sample_fextract_byte_range, tasks, max_pending=nproc + 1):
+                        reservoir.merge(task_reservoir)
+            else:
+                for file_index, reader in enumerate(readers):
+                    sample_fextract_rows(reader, plan, row_filter, reservoir, file_index, sample, seed,
+                                         stratified, with_raw_rows, strata)
+            if stratified:
+                sampling_rates = reservoir.rates
+                for cigar, quota, size in zip(CIGAR_ALPHABET, quotas, reservoir.sizes):
+                    if size < quota:
+                        log.warning("Sampled all {} rows of class {}, less than quota {}".format(size, cigar, quota))
+                num_train_rows = len(reservoir)
+            idx = collect(sampled_rows(reservoir))
+            reservoir = None
+        elif nproc > 1:
+            # Split input files into newline-aligned byte ranges, convert ranges in worker processes and
+            # merge converted rows in the original order. Each range needs at most num_train_rows rows.
+            tasks = [(reader.filename, byte_range, columns, plan, row_filter, num_train_rows, block_size,
+                      with_raw_rows, decompression_threads, strata)
+                     for reader in readers for byte_range in task_byte_ranges(reader, nproc, block_size, len(readers))]
+            log.info("Converting {} byte ranges of {} files using {} processes".format(len(tasks), len(readers), nproc))
+            with multiprocessing.Pool(nproc) as pool:
+                idx = collect(ordered_imap(pool, convert_fextract_byte_range, tasks, max_pending=nproc + 1))
+                # collect may stop before all results are consumed. Wait for pending tasks rather than
+                # terminating workers which may be sending results, which could deadlock Pool.terminate.
+                pool.close()
+                pool.join()
         else:
-            break
-        new_r = np.fromiter(out_r.values(), dtype=np.float32)
-        dataset.append(new_r)
-        arrow_qvs.append(arrow_qv)
-        ccs2genome_cigars.append(ccs2genome_cigar)
-        if idx % 500000 == 0:
-            print("Processing {} rows".format(idx))
-        idx += 1
-    raw_train_writer.close()
-
-    if len(dataset) == 0:
-        raise ValueError("Output empty train data!")
-    if num_train_rows > 0 and len(dataset) < num_train_rows:
-        raise ValueError(f"Collected {len(dataset)} training data points, less than required {num_train_rows}!")
-    assert len(arrow_qvs) == len(ccs2genome_cigars)
-    if num_train_rows == 0:
-        num_train_rows = len(arrow_qvs)
+            idx = collect(itertools.chain.from_iterable(
+                convert_fextract_rows(reader, plan, row_filter, num_train_rows, with_raw_rows, strata)
+                for reader in readers))
 
-    t1 = datetime.datetime.now()
-    print("Loaded input {} rows, time={}.".format(len(dataset), t1-t0))
-
-    npa = np.asarray(dataset, dtype=np.float32)  # column: out_features, row: CCS bases
-    arrow_qvs = np.asarray(arrow_qvs, dtype=np.float32)
-    arrow_qv_bins = np.asarray([arrowqv2bin8(qv) for qv in arrow_qvs], dtype=np.float32)
-    ccs2genome_cigars = np.asarray(ccs2genome_cigars, dtype=np.float32)
+        if idx == 0:
+            raise ValueError("Output empty train data!")
+        if num_train_rows > 0 and idx < num_train_rows:
+            raise ValueError(f"Collected {idx} training data points, less than required {num_train_rows}!")
+        if num_train_rows == 0:
+            num_train_rows = idx
+        t1 = datetime.datetime.now()
+        print("Loaded input {} rows, time={}.".format(idx, t1-t0))
     t2 = datetime.datetime.now()
-    print("Created np array time={}.".format(t2-t1))
+    print("Dumped {} rows of training data, time={}".format(num_train_rows, t2-t1))
 
-    # If fextract.stat.json provided and check, apply normalization to each column.
-    if stat_d is not None and stat_features is not None:
-        npat = npa.T  # npat 2d array, row: out_features, column: CCS bases
-        for stat_feature in stat_features.difference(DUPLICATED_FEATURES):
-            if stat_feature not in out_features:
-                raise ValueError("Feature {} exists in {} file but not in {}!".format(
-                    stat_feature, stat_json, fextract_filename))
-            idx = out_features.index(stat_feature)
-
-            def standardize_func(a):
-                return cap_outlier_standardize(a, stat_d[stat_feature])  # stat_d: feature -> FextractStat
-            tmp = standardize_func(npat[idx])
-            npat[idx] = tmp
-        npa = npat.T  # npa 2d array, row: CCS bases, column: out_features
-
-    # Write output header as txt
-    out_header_filename = output_prefix + ".header"
-    with open(out_header_filename, 'w') as writer:
-        writer.write(','.join(out_features))
+    cigar_counts = base_map_counter.counts
+    if append:
+        cigar_counts = label_counts_of_shards(read_manifest(dataset_filename(output_prefix, shard_rows=shard_rows)))
+    write_output_features(output_prefix, out_features)
+    write_base_map_probability(output_prefix, cigar_counts, sampling_rates, base_map_counter.strata_tables())
+    if feature_dtype != 'float32':
+        quantizer.write_report(output_prefix + '.quantization.json')
 
-    # Write ordered output features as json
-    out_ordered_features_json_filename = output_prefix + ".features.order.json"
-    with open(out_ordered_features_json_filename, 'w') as writer:
-        json.dump({ORDERED_FEATURES_KEY: out_features}, writer, sort_keys=True, indent=4)
-    print("Created header file {}, time={}.".format(out_ordered_features_json_filename, t2-t1))
-
-    # Write output npz
-    def zipsave(out_filename, start_row, end_row):
-        np.savez_compressed(out_filename,
-                            fextractinput=npa[start_row:end_row],
-                            arrowqv=arrow_qvs[start_row:end_row],
-                            arrowqvbin8=arrow_qv_bins[start_row:end_row],
-                            ccs2genome_cigars=ccs2genome_cigars[start_row:end_row])
-
-    out_train_filename = output_prefix + ".npz"
-    zipsave(out_train_filename, 0, num_train_rows)
-    t3 = datetime.datetime.now()
-    print("Dumped {} rows of training data, time={}".format(num_train_rows, t3-t2))
-
-    def base_map_probability(cc2genome_cigars, start_row, end_row):
-        # Return fraction of bases in 'I=XD' classes
-        c = ccs2genome_cigars[start_row:end_row]
-        n = len(c)
-        a = sum(c)
-        assert len(a) == 4, "Must have exactly 4 output classes each representing a cigar operation"
-        # see one_hot_encode_cigar, order '=IDX': {0, 1, 2, 3}
-        out_probs = {"Sampling": {
-            "SequenceMatch": a[cigar_index_in_one_hot('=')] / n,
-            "Insertion": a[cigar_index_in_one_hot('I')] / n,
-            "Substitution": a[cigar_index_in_one_hot('X')] / n,
-            "PreviousIsDeletion": a[cigar_index_in_one_hot('D')] / n
-        }}
-        return out_probs
-
-    # Write probabilty of base map '=IXD' in Sampling spaces.
-    out_base_map_prob_json = output_prefix + '.base_map_probability.json'
-    out_probs = base_map_probability(ccs2genome_cigars, 0, num_train_rows)
-    print("Dump Base Map probability {} to: {}".format(out_probs, out_base_map_prob_json))
-    with open(out_base_map_prob_json, 'w') as writer:
-        json.dump({BASE_MAP_PROBABILITY_KEY: out_probs}, writer, sort_keys=True, indent=4)
+
+def add_raw_rows_arg(p):
+    p.add_argument("--raw-rows", default=RAW_ROWS_CSV, choices=RAW_ROWS_MODES,
+                   help=("How to keep raw rows of output data for evalmodel. " +
+                         "csv - copy rows to ${output_prefix}.fextract.csv, " +
+                         "index - record row offsets of fextract csv file to ${output_prefix}" + ROWS_INDEX_SUFFIX))
+    return p
+
+
+def add_base_map_strata_arg(p):
+    p.add_argument("--base-map-stratum", dest="base_map_strata", action="append", default=None,
+                   choices=BASE_MAP_STRATA,
+                   help=("Also write base map probabilities of each level of a fextract column, e.g., ArrowQv bins, " +
+                         "to 'SamplingStrata' of ${output_prefix}.base_map_probability.json. Can be repeated"))
+    return p
+
+
+def add_clip_quantiles_arg(p):
+    p.add_argument("--clip-quantiles", action='store_true', default=False,
+                   help=("Clip outliers of features at q0.1 and q99.9 of the stat json before standardization, " +
+                         "instead of capping standardized features within [-4, 4]. " +
+                         "Requires quantiles in the stat json"))
+    return p
+
+
+def add_output_format_arg(p):
+    p.add_argument("--output-format", default=DATASET_FORMAT_NPZ, choices=DATASET_FORMATS,
+                   help=("Output dataset format. npz - compressed ${output_prefix}.npz, " +
+                         "npydir - directory ${output_prefix}.npydir of uncompressed .npy files, " +
+                         "which is faster to write and is memory-mapped when loaded, " +
+                         "chunked - ${output_prefix}.chunked of chunks compressed by multiple threads, " +
+                         "which can be read by row ranges"))
+    p.add_argument("--shard-rows", type=int, default=0,
+                   help=("If positive, write output dataset as shards of shard-rows rows in the output format " +
+                         "to ${output_prefix}.shards, with a manifest.json. Default: 0, no sharding"))
+    p.add_argument("--compression-codec", default='zlib', choices=sorted(CODECS),
+                   help="Compression codec of chunked output format")
+    p.add_argument("--compression-level", type=int, default=None,
+                   help="Compression level of chunked output format. Default: default level of codec")
+    p.add_argument("--compression-threads", type=int, default=1,
+                   help="Number of threads to compress chunks of chunked output format")
+    p.add_argument("--feature-dtype", default='float32', choices=FEATURE_DTYPES,
+                   help=("Store standardized features as float32, float16, or int8 with a per-column scale and " +
+                         "offset, which requires --stat-json. Features are dequantized to float32 when loaded, " +
+                         "reconstruction errors are written to ${output_prefix}.quantization.json"))
+    p.add_argument("--collapse-duplicates", action='store_true', default=False,
+                   help=("Collapse rows of identical standardized features and ccs2genome cigar into unique rows, " +
+                         "and store the number of rows of each unique row as array 'counts', which is used as " +
+                         "sample weights by training. Raw rows are not collapsed. Rows are collapsed in " +
+                         "partitions spilled to ${output_prefix}.collapse.tmp, within --max-memory if given"))
+    return p
+
+
+def compression_from_args(args):
+    """Return compression of chunked output format from command line arguments, see add_output_format_arg"""
+    return {'codec': args.compression_codec, 'level': args.compression_level, 'nthreads': args.compression_threads}
+
+
+def class_quotas_from_args(args):
+    """Return quotas of classes from --class-quotas or --class-ratios, None if neither is set"""
+    if args.class_quotas is not None and args.class_ratios is not None:
+        raise ValueError("--class-quotas and --class-ratios are mutually exclusive!")
+    if args.class_quotas is not None:
+        return parse_class_quotas(args.class_quotas, int)
+    if args.class_ratios is not None:
+        if args.num_train_rows <= 0:
+            raise ValueError("--class-ratios requires a positive --num-train-rows!")
+        return class_quotas_from_ratios(parse_class_quotas(args.class_ratios, float), args.num_train_rows)
+    return None
 
 
 def run(args):
@@ -273,7 +1096,13 @@ def run(args):
     fextract2numpy(fextract_filename=args.fextract_filename, output_prefix=args.output_prefix,
                    num_train_rows=args.num_train_rows, min_dist2end=args.min_dist2end,
                    allowed_strands=args.allowed_strands, allowed_ccs2genome_cigars=args.allowed_cigars,
-                   min_np=args.min_np, max_np=args.max_np, stat_json=args.stat_json)
+                   min_np=args.min_np, max_np=args.max_np, stat_json=args.stat_json, nproc=args.nproc,
+                   max_memory=args.max_memory, filters=args.filters, raw_rows=args.raw_rows,
+                   output_format=args.output_format, shard_rows=args.shard_rows,
+                   compression=compression_from_args(args), feature_dtype=args.feature_dtype,
+                   decompression_threads=args.decompression_threads, sample=args.sample, seed=args.seed,
+                   class_quotas=class_quotas_from_args(args), collapse_duplicates=args.collapse_duplicates,
+                   append=args.append, base_map_strata=args.base_map_strata, clip_quantiles=args.clip_quantiles)
     return 0
 
 
@@ -281,12 +1110,37 @@ def get_parser():
     """Set up and return argument parser."""
     desc = """Convert fextract csv file to zipped numpy file - ${output_prefix}.npz with N rows\n"""
     p = argparse.ArgumentParser(desc)
-    p.add_argument("fextract_filename", help="fextract csv file")
+    p.add_argument("fextract_filename",
+                   help=("fextract csv file, may be gzip or bgzip compressed, or - for stdin. Multiple files may be " +
+                         "passed as a quoted glob pattern, e.g., 'chunk-*.fextract.csv', or a file of filenames *.fofn"))
     p.add_argument("output_prefix", help="Output prefix")
     p.add_argument("--stat-json", default=None,
                    help=("If set, standardize features using mean/stdev/min/max from stat.json. " +
                          "otherwise, do NOT standarize features"))
+    add_clip_quantiles_arg(p)
     p.add_argument("--num-train-rows", type=int, default=0, help="Number of training rows, 0 means no limitation")
+    p.add_argument("--sample", default=SAMPLE_FIRST, choices=SAMPLE_MODES,
+                   help=("How to select --num-train-rows good rows. first - the first rows, " +
+                         "reservoir - a uniform random sample of rows in one pass, in the input order"))
+    p.add_argument("--seed", type=int, default=DEFAULT_SEED, help="Random seed of --sample reservoir")
+    p.add_argument("--class-quotas", default=None,
+                   help=("Stratify rows by ccs2genome cigar class, and select at most a quota of rows of each class " +
+                         "by --sample, e.g., '=:100000,I:50000,X:50000,D:50000'. Overrides --num-train-rows"))
+    p.add_argument("--class-ratios", default=None,
+                   help=("Stratify rows by ccs2genome cigar class, and split --num-train-rows into quotas " +
+                         "proportional to ratios, e.g., '=:0.4,I:0.2,X:0.2,D:0.2'"))
+    p.add_argument("--append", action='store_true', default=False,
+                   help=("Append new shards to an existing ${output_prefix}.shards of the same features, " +
+                         "--stat-json and output options, and append raw rows to ${output_prefix}.fextract.csv, " +
+                         "without rewriting existing shards. Requires --shard-rows"))
+    p.add_argument("--nproc", type=int, default=1,
+                   help="Number of processes, each converts a fextract csv file or a byte range of it")
+    p.add_argument("--max-memory", type=parse_memory_size, default=None,
+                   help="Approximate peak memory for converting rows, e.g., 4G or 512M. Default: no limitation")
+    add_decompression_threads_arg(p)
+    add_raw_rows_arg(p)
+    add_base_map_strata_arg(p)
+    add_output_format_arg(p)
     return add_filter_args(p)
 
 
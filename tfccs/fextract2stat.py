@@ -2,70 +2,399 @@
 Compute mean, stdev, min, max of trainable columns, and save to output file.
 Example:
     python compute_stat_fextract.py in.fextract.csv out.fextract.stat.csv
+
+Besides mean, stdev, min and max, each feature of the output file keeps count and m2, the sum of squared
+differences from mean, so that stat files of disjoint rows, e.g., of chunks of a movie, can be merged exactly
+by merge-stats, see FeatureStatAccumulator.
+Quantiles q0.1, q25, q50, q75 and q99.9 of each feature are estimated in the same pass by a mergeable quantile
+sketch within relative error 0.01, which is also kept in the output file, see tfccs.quantile_sketch.
+
+For quick iterations, stats may be estimated from a seeded random sample of chunks of uncompressed files,
+which are read by byte offsets, see accumulate_sampled_chunks. Standard errors of mean and stdev of each feature
+are estimated from variation between chunks and written next to the estimates, see sample_standard_errors.
+
+As a dataset grows, rows of a new fextract csv file can be folded into an existing stat file by --update, in time
+proportional to the new rows. Each update bumps StatVersion of the stat file and appends the new rows to
+StatHistory, so that datasets standardized with an older version can be detected, see check_dataset_stat_version.
 """
 
 import datetime
 import numpy as np
 import timeit
 import argparse
-import csv
 import json
+import multiprocessing
+import os
+import os.path as op
 import sys
-from tfccs.constants import NO_TRAIN_FEATURES, BASE_FEATURE_STAT_KEY
-from tfccs.utils import is_good_fextract_row, add_filter_args
+from tfccs.constants import (NO_TRAIN_FEATURES, BASE_FEATURE_STAT_KEY, STAT_QUANTILES, STAT_VERSION_KEY,
+                             STAT_HISTORY_KEY)
+from tfccs.utils import add_filter_args, add_decompression_threads_arg, parse_memory_size, is_progress_due
+from tfccs.fextract_reader import FextractReader, open_fextract_readers, task_byte_ranges, DEFAULT_BLOCK_SIZE
+from tfccs.fextract_input import is_stdin, expand_fextract_inputs, DEFAULT_DECOMPRESSION_THREADS
+from tfccs.fextract_filter import RowFilter
+from tfccs.quantile_sketch import QuantileSketch
+from tfccs.sampling import DEFAULT_SEED
+
+SAMPLE_CHUNK_SIZE = 256 * 1024  # Rows are sampled in newline-aligned chunks of about 256KB, about 700 rows
+
+
+def stat_features(fieldnames):
+    """Return sorted trainable features of fextract.csv whose stats are computed"""
+    return sorted(set(fieldnames).difference(NO_TRAIN_FEATURES + ["CCSBase", "PrevBases", "NextBases"]))
+
+
+def write_feature_stat_json(out_stat_json, features, mean_features, stdev_features, min_features, max_features,
+                            extra_items=None, root_items=None):
+    # Save as {BASE_FEATURE_STAT_KEY: [{"name":name, "mean":mean , "stdev": stdev, "min": min, "max": max}]}
+    # extra_items --- None, or extra items of each feature, e.g., [{"count": count, "m2": m2, "q50": median}]
+    # root_items --- None, or extra items of the Json root, e.g., {STAT_VERSION_KEY: version}
+    ret = []
+    for idx in range(0, len(features)):
+        d = {"name": features[idx], "mean": float(mean_features[idx]),
+             "stdev": float(stdev_features[idx]), "min": float(min_features[idx]),
+             "max": float(max_features[idx])}
+        if extra_items is not None:
+            d.update(extra_items[idx])
+        ret.append(d)
+    print("Dump mean, stdev, min, max of trainable variables to {}.".format(out_stat_json))
+    with open(out_stat_json, 'w') as writer:
+        json.dump(dict({BASE_FEATURE_STAT_KEY: ret}, **(root_items or {})), writer, indent=4, sort_keys=True)
+
+
+class FeatureStatAccumulator(object):
+    """
+    Accumulate count, mean, M2 (sum of squared differences from mean), min and max of features
+    block by block in float64, using memory of O(number of features).
+    Stats of each block are merged by Chan et al.'s pairwise update, which is numerically stable.
+    Quantiles of features are estimated by a QuantileSketch of bounded memory, see STAT_QUANTILES.
+    Stats of disjoint rows, e.g., computed by different processes or saved to stat files, are merged the same way,
+    see merge_accumulator and from_json.
+    version and history are StatVersion and StatHistory of the stat file, see write_json and update_stat_json.
+        features --- names of features, columns of blocks
+        quantiles --- if False, do not estimate quantiles, and sketch is None
+    """
+
+    def __init__(self, features, quantiles=True):
+        self.features = list(features)
+        n = len(self.features)
+        self.count = 0
+        self.mean = np.zeros(n, dtype=np.float64)
+        self.m2 = np.zeros(n, dtype=np.float64)
+        self.min = np.full(n, np.inf, dtype=np.float64)
+        self.max = np.full(n, -np.inf, dtype=np.float64)
+        # None if quantiles are unknown, e.g., loaded from an old stat file
+        self.sketch = QuantileSketch(n) if quantiles else None
+        self.version = 1
+        self.history = []  # [{"version": version, "source": fextract csv or stat file, "count": number of rows}]
+
+    def update(self, block):
+        """Add a block, a 2d array with one row per base and one column per feature"""
+        block = np.asarray(block, dtype=np.float64)
+        if len(block) == 0:
+            return
+        mean = block.mean(axis=0)
+        if self.sketch is not None:
+            self.sketch.update(block)
+        self.merge(len(block), mean, ((block - mean) ** 2).sum(axis=0), block.min(axis=0), block.max(axis=0))
+
+    def merge(self, count, mean, m2, min_values, max_values):
+        """Merge stats of another set of rows"""
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / total)
+        self.m2 = self.m2 + m2 + delta ** 2 * (self.count * count / total)
+        self.min = np.minimum(self.min, min_values)
+        self.max = np.maximum(self.max, max_values)
+        self.count = total
+
+    def merge_accumulator(self, other):
+        """Merge another FeatureStatAccumulator of the same features"""
+        if other.features != self.features:
+            raise ValueError("Could not merge stats of different features {} and {}!".format(
+                self.features, other.features))
+        self.merge(other.count, other.mean, other.m2, other.min, other.max)
+        if self.sketch is not None and other.sketch is not None:
+            self.sketch.merge(other.sketch)
+        else:
+            self.sketch = None
+
+    @property
+    def stdev(self):
+        """Population standard deviation, the same as np.std"""
+        return np.sqrt(self.m2 / self.count)
+
+    def quantiles(self):
+        """Return {name: estimates of each feature} of STAT_QUANTILES, or {} if there is no quantile sketch"""
+        if self.sketch is None:
+            return {}
+        return {name: self.sketch.quantiles(q) for name, q in STAT_QUANTILES}
+
+    def write_json(self, out_stat_json, extra_items=None):
+        """
+        Write stats, count, m2, quantiles and quantile sketch of each feature, which can be loaded by from_json.
+        extra_items --- None, or extra items of each feature, e.g., standard errors, see write_feature_stat_json
+        """
+        if self.count == 0:
+            raise ValueError("Could not write stats of empty rows to {}!".format(out_stat_json))
+        extra_items = [dict({"count": int(self.count), "m2": float(m2)}, **(extra_items[idx] if extra_items else {}))
+                       for idx, m2 in enumerate(self.m2)]
+        root_items = {STAT_VERSION_KEY: self.version, STAT_HISTORY_KEY: self.history}
+        if self.sketch is not None:
+            quantiles = self.quantiles()
+            for idx, (item, sketch_item) in enumerate(zip(extra_items, self.sketch.to_json_items())):
+                item.update({name: float(values[idx]) for name, values in quantiles.items()}, sketch=sketch_item)
+        write_feature_stat_json(out_stat_json, self.features, self.mean, self.stdev, self.min, self.max,
+                                extra_items=extra_items, root_items=root_items)
+
+    @classmethod
+    def from_json(cls, in_stat_json):
+        """
+        Load stats written by write_json, which must have count and m2 of each feature, and must not be
+        estimated from a sample of rows.
+        The quantile sketch is None if features have no sketch, so that merged stats have no quantiles.
+        """
+        d = json.load(open(in_stat_json, 'r'))
+        items = d.get(BASE_FEATURE_STAT_KEY)
+        if items is None:
+            raise ValueError("Could not find {} as Json root of {}!".format(BASE_FEATURE_STAT_KEY, in_stat_json))
+        for item in items:
+            for key in ['name', 'count', 'mean', 'm2', 'min', 'max']:
+                if key not in item:
+                    raise ValueError("Could not merge stats of {}, key {} must exist in {}!".format(
+                        in_stat_json, key, item))
+            if 'sample_fraction' in item:
+                raise ValueError("Could not merge stats of {}, which are estimated from a sample of rows!".format(
+                    in_stat_json))
+        counts = set([int(item['count']) for item in items])
+        if len(counts) != 1:
+            raise ValueError("Features of {} must have the same count, got {}!".format(in_stat_json, sorted(counts)))
+        stats = cls([item['name'] for item in items])
+        stats.merge(counts.pop(), *[np.array([float(item[key]) for item in items], dtype=np.float64)
+                                    for key in ['mean', 'm2', 'min', 'max']])
+        if all(['sketch' in item for item in items]):
+            stats.sketch = QuantileSketch.from_json_items([item['sketch'] for item in items])
+        else:
+            print("WARNING! No quantile sketch in {}, quantiles of merged stats are unknown!".format(in_stat_json))
+            stats.sketch = None
+        stats.version = int(d.get(STAT_VERSION_KEY, 1))
+        stats.history = list(d.get(STAT_HISTORY_KEY, []))
+        return stats
+
+
+def stat_source(in_csv):
+    """Return the source of stats of in_csv in StatHistory, the absolute path of in_csv, or STDIN"""
+    return in_csv if is_stdin(in_csv) else op.abspath(in_csv)
+
+
+def update_stat_json(stat_json, new_stats, source):
+    """
+    Fold new_stats, a FeatureStatAccumulator of new rows of source, into stat_json in place, which must be written
+    by write_json of rows disjoint to the new rows. Bump StatVersion and append the new rows to StatHistory.
+    Return the updated FeatureStatAccumulator.
+    """
+    stats = FeatureStatAccumulator.from_json(stat_json)
+    if not is_stdin(source) and source in [item.get('source') for item in stats.history]:
+        raise ValueError("Rows of {} have already been folded into {}!".format(source, stat_json))
+    stats.merge_accumulator(new_stats)
+    stats.version += 1
+    stats.history.append({"version": stats.version, "source": source, "count": int(new_stats.count)})
+    # Replace stat_json only after the updated stats are completely written
+    stats.write_json(stat_json + '.tmp')
+    os.replace(stat_json + '.tmp', stat_json)
+    print("Updated {} to version {} of {} rows".format(stat_json, stats.version, stats.count))
+    return stats
+
+
+def accumulate_good_features(reader, features, row_filter, stats=None):
+    """
+    Accumulate stats of features of good rows of a FextractReader block by block, and return
+    the FeatureStatAccumulator stats, a new one if stats is None.
+    """
+    if stats is None:
+        stats = FeatureStatAccumulator(features)
+    num_rows = 0
+    for block in reader:
+        good = np.flatnonzero(row_filter.mask(block.data))
+        stats.update(np.stack([block[feature][good] for feature in features], axis=1))
+        num_rows += len(block)
+        if is_progress_due(num_rows, len(block)):
+            print("Processing {} rows of {}".format(num_rows, reader.filename))
+        block = None
+    return stats
+
+
+def accumulate_good_features_of_byte_range(args):
+    """
+    Worker of multi-process stats, which returns a FeatureStatAccumulator of good rows in a byte range of a
+    fextract csv file, or of all rows if byte range is None, see accumulate_good_features.
+    """
+    filename, byte_range, columns, features, row_filter, block_size, nthreads = args
+    reader = FextractReader(filename, columns=columns, block_size=block_size, byte_range=byte_range, nthreads=nthreads)
+    return accumulate_good_features(reader, features, row_filter)
+
+
+def sample_chunks(readers, sample_fraction, seed, chunk_size=SAMPLE_CHUNK_SIZE):
+    """
+    Split rows of uncompressed files of FextractReaders into newline-aligned chunks of about chunk_size bytes,
+    and return (sampled chunks, number of chunks), where sampled chunks are (filename, byte range) of
+    ceil(sample_fraction * number of chunks) chunks in a seeded random order.
+    """
+    chunks = []
+    for reader in readers:
+        if not reader.seekable:
+            raise ValueError("Could not sample rows of compressed or piped input {} by byte offsets!".format(
+                reader.filename))
+        data_size = reader.byte_range[1] - reader.byte_range[0]
+        if data_size > 0:
+            chunks.extend([(reader.filename, byte_range)
+                           for byte_range in reader.byte_ranges(-(-data_size // chunk_size))])
+    order = np.random.RandomState(seed).permutation(len(chunks))
+    num_sampled = min(len(chunks), max(1, int(np.ceil(sample_fraction * len(chunks)))))
+    return [chunks[idx] for idx in order[:num_sampled]], len(chunks)
+
+
+def accumulate_sampled_chunks(chunks, columns, features, row_filter, max_rows=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Accumulate stats of good rows of chunks in order, see sample_chunks, until at least max_rows good rows are
+    accumulated if max_rows is not None.
+    Return (FeatureStatAccumulator of all read chunks, [FeatureStatAccumulator without quantiles of each read chunk],
+    number of bytes of read chunks).
+    """
+    stats = FeatureStatAccumulator(features)
+    chunk_stats = []
+    num_bytes = 0
+    for filename, byte_range in chunks:
+        if max_rows is not None and stats.count >= max_rows:
+            break
+        reader = FextractReader(filename, columns=columns, block_size=block_size, byte_range=byte_range)
+        chunk_stats.append(FeatureStatAccumulator(features, quantiles=False))
+        for block in reader:
+            good = np.flatnonzero(row_filter.mask(block.data))
+            values = np.stack([block[feature][good] for feature in features], axis=1)
+            stats.update(values)
+            chunk_stats[-1].update(values)
+            block, values = None, None
+        num_bytes += byte_range[1] - byte_range[0]
+    return stats, chunk_stats, num_bytes
+
+
+def sample_standard_errors(stats, chunk_stats, num_chunks):
+    """
+    Return (standard errors of mean, standard errors of stdev) of each feature of stats, which are accumulated
+    from chunk_stats, a sample of chunks out of num_chunks chunks, see accumulate_sampled_chunks.
+    Mean and variance are ratio estimators over chunks, e.g., mean = sum of chunk sums / sum of chunk counts,
+    whose variances are estimated from residuals of chunks with a finite population correction, so that
+    correlation of rows within a chunk, e.g., bases of the same ZMW, is taken into account.
+    Standard errors of stdev are derived from standard errors of variance by the delta method.
+    Standard errors are nan if fewer than 2 chunks are sampled.
+    """
+    num_sampled = len(chunk_stats)
+    if num_sampled < 2:
+        nan = np.full(len(stats.features), np.nan)
+        return nan, nan
+    counts = np.array([chunk.count for chunk in chunk_stats], dtype=np.float64)[:, None]
+    means = np.array([chunk.mean for chunk in chunk_stats])
+    deviations = counts * (means - stats.mean)
+    # Sum of squared differences from the mean of all chunks, of each chunk
+    m2s = np.array([chunk.m2 for chunk in chunk_stats]) + counts * (means - stats.mean) ** 2
+    variance = stats.m2 / stats.count
+    scale = np.sqrt(max(0.0, 1.0 - num_sampled / num_chunks) * num_sampled / (num_sampled - 1)) / stats.count
+    mean_stderr = scale * np.sqrt((deviations ** 2).sum(axis=0))
+    variance_stderr = scale * np.sqrt(((m2s - counts * variance) ** 2).sum(axis=0))
+    stdev = np.sqrt(variance)
+    stdev_stderr = np.where(stdev > 0, variance_stderr / (2 * np.where(stdev > 0, stdev, 1)), 0.0)
+    return mean_stderr, stdev_stderr
+
+
+def report_standard_errors(stats, mean_stderr, stdev_stderr, top=10):
+    """Print standard errors of features whose means have the largest standard errors relative to stdev"""
+    relative = mean_stderr / np.where(stats.stdev > 0, stats.stdev, 1)
+    print("Standard errors of {} features of the largest standard errors of mean relative to stdev:".format(
+        min(top, len(stats.features))))
+    for idx in np.argsort(-np.nan_to_num(relative, nan=np.inf), kind='stable')[:top]:
+        print("    {}: mean={:.6g} +- {:.3g}, stdev={:.6g} +- {:.3g}".format(
+            stats.features[idx], stats.mean[idx], mean_stderr[idx], stats.stdev[idx], stdev_stderr[idx]))
 
 
 def compute_feature_stats(in_csv, out_stat_json, min_dist2end, allowed_strands,
-                          allowed_ccs2genome_cigars, min_np, max_np):
-    reader = csv.DictReader(open(in_csv, 'r'), delimiter=',')
-    dataset = []
+                          allowed_ccs2genome_cigars, min_np, max_np, filters=None,
+                          decompression_threads=DEFAULT_DECOMPRESSION_THREADS, nproc=1, block_size=DEFAULT_BLOCK_SIZE,
+                          sample_fraction=None, max_rows=None, seed=DEFAULT_SEED, sample_chunk_size=SAMPLE_CHUNK_SIZE,
+                          update=False):
+    """
+    Compute mean, stdev, min and max of trainable features of good rows of in_csv, and write to out_stat_json.
+    Rows are read block by block, and stats are accumulated by FeatureStatAccumulator in O(number of features) memory.
+    in_csv --- fextract csv file, or a glob pattern or a .fofn file of fextract csv files with the same header,
+               see expand_fextract_inputs. Stats of files, or of byte ranges of uncompressed files, are accumulated
+               by nproc processes, and merged in the order of rows.
+    sample_fraction, max_rows --- if either is not None, estimate stats from a sample_fraction of chunks of
+               sample_chunk_size bytes of uncompressed files drawn using seed, or from chunks of at least max_rows good
+               rows in total, see sample_chunks. Standard errors of mean and stdev, see sample_standard_errors, and the
+               fraction of bytes read are written to out_stat_json, which can not be merged by merge-stats.
+               Min, max and quantiles are those of sampled rows.
+    update --- if True, fold stats of in_csv into the existing out_stat_json, whose rows must not include rows of
+               in_csv, and bump its version, see update_stat_json.
+    """
+    if update and not op.exists(out_stat_json):
+        raise ValueError("Could not update {}, which does not exist!".format(out_stat_json))
+    row_filter = RowFilter(min_dist2end=min_dist2end, allowed_strands=allowed_strands,
+                           allowed_ccs2genome_cigars=allowed_ccs2genome_cigars, min_np=min_np, max_np=max_np,
+                           predicates=filters)
+    readers = open_fextract_readers(expand_fextract_inputs(in_csv), block_size=block_size,
+                                    nthreads=decompression_threads)
+    if nproc > 1 and is_stdin(in_csv):
+        raise ValueError("Could not compute stats of stdin by multiple processes!")
+    fieldnames = readers[0].fieldnames
+    features = stat_features(fieldnames)
+    columns = set(features + row_filter.columns(fieldnames))
     t0 = datetime.datetime.now()
-    features = sorted(set(reader.fieldnames).difference(NO_TRAIN_FEATURES + ["CCSBase", "PrevBases", "NextBases"]))
-    for idx, r in enumerate(reader):
-        is_good = is_good_fextract_row(r, min_dist2end=min_dist2end,
-                                       allowed_strands=allowed_strands,
-                                       allowed_ccs2genome_cigars=allowed_ccs2genome_cigars,
-                                       min_np=min_np, max_np=max_np)
-        if not is_good:
-            continue
-        values = [r[feature] for feature in features]
-        dataset.append(values)
-        if idx % 500000 == 0:
-            print("Processing {} rows".format(idx))
-    if len(dataset) == 0:
+    stats = FeatureStatAccumulator(features)
+    extra_items = None
+    if sample_fraction is not None or max_rows is not None:
+        if update:
+            raise ValueError("Could not update {} by stats estimated from a sample of rows!".format(out_stat_json))
+        if nproc > 1:
+            raise ValueError("Could not estimate stats from a sample of rows by multiple processes!")
+        sample_fraction = 1.0 if sample_fraction is None else sample_fraction
+        if not 0 < sample_fraction <= 1:
+            raise ValueError("Sample fraction must be within (0, 1], not {}!".format(sample_fraction))
+        if max_rows is not None and max_rows <= 0:
+            raise ValueError("Max rows must be positive, not {}!".format(max_rows))
+        chunks, num_chunks = sample_chunks(readers, sample_fraction, seed, sample_chunk_size)
+        stats, chunk_stats, num_bytes = accumulate_sampled_chunks(chunks, columns, features, row_filter,
+                                                                  max_rows=max_rows, block_size=block_size)
+        total_bytes = sum([reader.byte_range[1] - reader.byte_range[0] for reader in readers])
+        print("Sampled {} of {} chunks, {} of {} bytes".format(len(chunk_stats), num_chunks, num_bytes, total_bytes))
+        if stats.count > 0:
+            mean_stderr, stdev_stderr = sample_standard_errors(stats, chunk_stats, num_chunks)
+            report_standard_errors(stats, mean_stderr, stdev_stderr)
+            extra_items = [{"mean_stderr": float(mean_se), "stdev_stderr": float(stdev_se),
+                            "sample_fraction": num_bytes / total_bytes}
+                           for mean_se, stdev_se in zip(mean_stderr, stdev_stderr)]
+    elif nproc > 1:
+        tasks = [(reader.filename, byte_range, columns, features, row_filter, block_size, decompression_threads)
+                 for reader in readers for byte_range in task_byte_ranges(reader, nproc, block_size, len(readers))]
+        print("Computing stats of {} byte ranges of {} files using {} processes".format(
+            len(tasks), len(readers), nproc))
+        with multiprocessing.Pool(nproc) as pool:
+            for task_stats in pool.imap(accumulate_good_features_of_byte_range, tasks):
+                stats.merge_accumulator(task_stats)
+    else:
+        for reader in readers:
+            reader.select(columns)
+            accumulate_good_features(reader, features, row_filter, stats)
+    if stats.count == 0:
         raise ValueError("Input fextract file {} contains empty good rows!".format(in_csv))
     t1 = datetime.datetime.now()
-    print("Loaded input {} rows, time={}.".format(len(dataset), t1-t0))
-
-    npa = np.asarray(dataset, dtype=np.float32)
-    t2 = datetime.datetime.now()
-    print("Created np array time={}.".format(t2-t1))
-    n = len(features)
-    mean_features = np.mean(npa, axis=0)
-    stdev_features = np.std(npa, axis=0)
-    min_features = np.min(npa, axis=0)
-    max_features = np.max(npa, axis=0)
-
-    def save_format_1():
-        ret = {'mean': {features[idx]: float(mean_features[idx]) for idx in range(n)},
-               'stdev': {features[idx]: float(stdev_features[idx]) for idx in range(n)},
-               'min': {features[idx]: float(min_features[idx]) for idx in range(n)},
-               'max': {features[idx]: float(max_features[idx]) for idx in range(n)}}
-        return ret
-
-    def save_format_2():
-        # Save as {featureName: {"name":name, "mean":mean , "stdev": stdev, "min": min, "max": max}}
-        ret = []
-        for idx in range(0, n):
-            d = {"name": features[idx], "mean": float(mean_features[idx]),
-                 "stdev": float(stdev_features[idx]), "min": float(min_features[idx]),
-                 "max": float(max_features[idx])}
-            ret.append(d)
-        return {BASE_FEATURE_STAT_KEY: ret}
-
-    print("Dump mean, stdev, min, max of trainable variables to {}.".format(out_stat_json))
-    with open(out_stat_json, 'w') as writer:
-        json.dump(save_format_2(), writer, indent=4, sort_keys=True)
+    print("Loaded input {} rows, time={}.".format(stats.count, t1-t0))
+    if update:
+        update_stat_json(out_stat_json, stats, stat_source(in_csv))
+        return
+    stats.history = [{"version": stats.version, "source": stat_source(in_csv), "count": int(stats.count)}]
+    stats.write_json(out_stat_json, extra_items=extra_items)
 
 
 def run(args):
@@ -74,7 +403,10 @@ def run(args):
     compute_feature_stats(in_csv=args.in_csv, out_stat_json=args.out_stat_json,
                           min_dist2end=args.min_dist2end, allowed_strands=args.allowed_strands,
                           allowed_ccs2genome_cigars=args.allowed_cigars,
-                          min_np=args.min_np, max_np=args.max_np)
+                          min_np=args.min_np, max_np=args.max_np, filters=args.filters,
+                          decompression_threads=args.decompression_threads, nproc=args.nproc,
+                          sample_fraction=args.sample_fraction, max_rows=args.max_rows, seed=args.seed,
+                          sample_chunk_size=args.sample_chunk_size, update=args.update)
     return 0
 
 
@@ -82,8 +414,26 @@ def get_parser():
     """Set up and return argument parser."""
     desc = """Compute mean, stdev, min, max of trainable fextract features and save to output file."""
     p = argparse.ArgumentParser(desc)
-    p.add_argument("in_csv", help="Input fextract csv file")
+    p.add_argument("in_csv",
+                   help=("Input fextract csv file, may be gzip or bgzip compressed, or - for stdin. Multiple files may " +
+                         "be passed as a quoted glob pattern, e.g., 'chunk-*.fextract.csv', or a file of filenames *.fofn"))
     p.add_argument("out_stat_json", help="Output stat json file contain mean, stdev, min, max of trainable features")
+    p.add_argument("--nproc", type=int, default=1,
+                   help="Number of processes, each computes stats of a fextract csv file or a byte range of it")
+    p.add_argument("--update", action='store_true', default=False,
+                   help=("Fold stats of new rows of in_csv into the existing out_stat_json, and bump its version, " +
+                         "so that datasets standardized with older versions can be detected"))
+    p.add_argument("--sample-fraction", type=float, default=None,
+                   help=("Estimate stats from a seeded random sample of this fraction of chunks of uncompressed " +
+                         "fextract csv files, read by byte offsets, and write standard errors of mean and stdev " +
+                         "of each feature. Default: read all rows"))
+    p.add_argument("--max-rows", type=int, default=None,
+                   help=("Estimate stats from seeded random chunks of at least this number of good rows in total, " +
+                         "see --sample-fraction"))
+    p.add_argument("--seed", type=int, default=DEFAULT_SEED, help="Random seed of --sample-fraction and --max-rows")
+    p.add_argument("--sample-chunk-size", type=parse_memory_size, default=SAMPLE_CHUNK_SIZE,
+                   help="Approximate size of sampled chunks, e.g., 256K. Default: 256K")
+    add_decompression_threads_arg(p)
     return add_filter_args(p)
 
 
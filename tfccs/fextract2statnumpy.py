@@ -0,0 +1,180 @@
+"""
+python fextract2statnumpy.py in.fextract.csv output_prefix out.stat.json --num-train-rows 1000000
+
+Compute stats of trainable features and convert fextract.csv to standardized features
+in a single pass over fextract.csv, which is the same as running
+    fextract2stat in.fextract.csv out.stat.json
+    fextract2numpy in.fextract.csv output_prefix --stat-json out.stat.json
+but reads and parses in.fextract.csv only once.
+
+1) Read fextract.csv in blocks: accumulate stats of all good rows, convert the first num_train_rows
+   good rows, and spill converted rows to disk next to output_prefix.npz.
+2) Write stats to out.stat.json, then standardize spilled rows block by block and write output_prefix.npz.
+"""
+import datetime
+import numpy as np
+import argparse
+import sys
+import logging
+import os.path as op
+from tfccs.utils import (load_fextract_stat_json, add_filter_args, parse_memory_size, add_decompression_threads_arg,
+                         is_progress_due)
+from tfccs.dataset import ArraySpool, open_dataset_writer, DATASET_KEYS, DATASET_FORMAT_NPZ
+from tfccs.fextract_reader import FextractReader, DEFAULT_BLOCK_SIZE
+from tfccs.fextract_input import DEFAULT_DECOMPRESSION_THREADS
+from tfccs.fextract_filter import RowFilter
+from tfccs.fextract2stat import stat_features, stat_source, FeatureStatAccumulator
+from tfccs.fextract2numpy import (ProjectionPlan, fextract_in_columns, convert_fextract_block,
+                                  arrowqv2bin8_block, get_standardized_columns, standardize, block_size_for_memory,
+                                  collapse_memory_for_memory,
+                                  write_output_features, write_base_map_probability, RawRowsWriter, RAW_ROWS_CSV,
+                                  add_raw_rows_arg, add_output_format_arg, dataset_metadata, CIGAR_ALPHABET,
+                                  compression_from_args, create_quantizer, BaseMapCounter, strata_codes,
+                                  add_base_map_strata_arg, add_clip_quantiles_arg, dataset_attrs)
+
+FORMATTER = op.basename(__file__) + ':%(levelname)s:'+'%(message)s'
+logging.basicConfig(level=logging.DEBUG, format=FORMATTER)
+log = logging.getLogger(__name__)
+
+SPILL_KEYS = ['fextractinput', 'arrowqv', 'ccs2genome_cigars']
+
+
+def fextract2statnumpy(fextract_filename, output_prefix, out_stat_json,
+                       min_dist2end, allowed_strands, allowed_ccs2genome_cigars, min_np, max_np,
+                       num_train_rows, block_size=DEFAULT_BLOCK_SIZE, max_memory=None, filters=None,
+                       raw_rows=RAW_ROWS_CSV, output_format=DATASET_FORMAT_NPZ, shard_rows=0, compression=None,
+                       feature_dtype='float32', decompression_threads=DEFAULT_DECOMPRESSION_THREADS,
+                       collapse_duplicates=False, base_map_strata=None, clip_quantiles=False):
+    """
+    Compute stats of good rows of fextract_filename and write to out_stat_json, then convert the first
+    num_train_rows good rows to standardized features and write to output_prefix.npz, or output_prefix.npydir
+    if output_format is 'npydir', or output_prefix.shards if shard_rows > 0, see fextract2stat and fextract2numpy.
+    If clip_quantiles, outliers are clipped at q0.1 and q99.9 of out_stat_json, see cap_outlier_standardize.
+    """
+    if num_train_rows == 0:
+        log.info("Will convert all qualified rows to output npz!")
+    if max_memory is not None:
+        block_size = min(block_size, block_size_for_memory(max_memory, 1))
+        log.info("Converting fextract csv in blocks of {} bytes, max memory {} bytes".format(block_size, max_memory))
+
+    reader = FextractReader(fextract_filename, block_size=block_size, nthreads=decompression_threads)
+    fieldnames = reader.fieldnames
+    features = stat_features(fieldnames)
+    plan = ProjectionPlan(fieldnames)
+    out_features = plan.out_features
+    row_filter = RowFilter(min_dist2end=min_dist2end, allowed_strands=allowed_strands,
+                           allowed_ccs2genome_cigars=allowed_ccs2genome_cigars, min_np=min_np, max_np=max_np,
+                           predicates=filters)
+    base_map_counter = BaseMapCounter(base_map_strata or [])
+    missing = [stratum for stratum in base_map_counter.strata if stratum not in fieldnames]
+    if missing:
+        raise ValueError("Could not count base maps by {}, which are not columns of fextract csv!".format(missing))
+    columns = set(fextract_in_columns(fieldnames) + row_filter.columns(fieldnames) + features +
+                  base_map_counter.strata)
+    reader.select(columns)
+
+    stats = FeatureStatAccumulator(features)
+    rows_per_block = 1
+    t0 = datetime.datetime.now()
+    spool = ArraySpool(output_prefix + '.spill', SPILL_KEYS)
+    try:
+        with RawRowsWriter(fextract_filename, output_prefix, raw_rows, header=reader.header) as raw_rows_writer:
+            num_rows = 0
+            for block in reader:
+                good_indices = np.flatnonzero(row_filter.mask(block.data))
+                stats.update(np.stack([block[feature][good_indices] for feature in features], axis=1))
+                if num_train_rows > 0:
+                    good_indices = good_indices[:num_train_rows - num_rows]
+                if len(good_indices) > 0:
+                    out_r, arrow_qv, ccs2genome_cigar = convert_fextract_block(block.data, plan, good_indices)
+                    raw_rows_writer.write(block.raw_rows(good_indices) if raw_rows_writer.with_raw_rows else b'',
+                                          block.row_spans(good_indices))
+                    spool.write(fextractinput=out_r, arrowqv=arrow_qv, ccs2genome_cigars=ccs2genome_cigar)
+                    base_map_counter.update(ccs2genome_cigar,
+                                            strata_codes(base_map_counter.strata, block.data, good_indices))
+                    rows_per_block = max(rows_per_block, len(good_indices))
+                    num_rows += len(good_indices)
+                    out_r, arrow_qv, ccs2genome_cigar = None, None, None
+                    if is_progress_due(num_rows, len(good_indices)):
+                        print("Processing {} rows".format(num_rows))
+                block = None
+
+        if num_rows == 0:
+            raise ValueError("Output empty train data!")
+        if num_train_rows > 0 and num_rows < num_train_rows:
+            raise ValueError(f"Collected {num_rows} training data points, less than required {num_train_rows}!")
+        t1 = datetime.datetime.now()
+        print("Loaded input {} rows, time={}.".format(stats.count, t1-t0))
+
+        stats.history = [{"version": stats.version, "source": stat_source(fextract_filename),
+                          "count": int(stats.count)}]
+        stats.write_json(out_stat_json)
+        # Load stats from json, so that features are standardized the same as by fextract2numpy --stat-json
+        stat_d, stat_feature_set = load_fextract_stat_json(out_stat_json)
+        standardized_columns = get_standardized_columns(out_features, stat_d, stat_feature_set)
+        quantizer = create_quantizer(out_features, fieldnames, standardized_columns, feature_dtype, clip_quantiles)
+        with open_dataset_writer(output_prefix, output_format, keys=DATASET_KEYS, shard_rows=shard_rows,
+                                 labels=list(CIGAR_ALPHABET),
+                                 metadata=dataset_metadata(fextract_filename, out_features, out_stat_json,
+                                                           feature_dtype, clip_quantiles),
+                                 compression=compression, attrs=dataset_attrs(quantizer, out_stat_json),
+                                 collapse_duplicates=collapse_duplicates,
+                                 collapse_memory=collapse_memory_for_memory(max_memory)) as npz_writer:
+            for d in spool.read_blocks(rows_per_block):
+                fextractinput = standardize(d['fextractinput'], standardized_columns, clip_quantiles)
+                npz_writer.write(fextractinput=quantizer.quantize(fextractinput),
+                                 arrowqv=d['arrowqv'], arrowqvbin8=arrowqv2bin8_block(d['arrowqv']),
+                                 ccs2genome_cigars=d['ccs2genome_cigars'])
+        t2 = datetime.datetime.now()
+        print("Dumped {} rows of training data, time={}".format(num_rows, t2-t1))
+    finally:
+        spool.remove()
+
+    write_output_features(output_prefix, out_features)
+    write_base_map_probability(output_prefix, base_map_counter.counts, strata_tables=base_map_counter.strata_tables())
+    if feature_dtype != 'float32':
+        quantizer.write_report(output_prefix + '.quantization.json')
+
+
+def run(args):
+    if not args.out_stat_json.endswith('.stat.json'):
+        raise ValueError("Output stat json file must ends with .stat.json! {}".format(args.out_stat_json))
+    fextract2statnumpy(fextract_filename=args.fextract_filename, output_prefix=args.output_prefix,
+                       out_stat_json=args.out_stat_json, num_train_rows=args.num_train_rows,
+                       min_dist2end=args.min_dist2end, allowed_strands=args.allowed_strands,
+                       allowed_ccs2genome_cigars=args.allowed_cigars, min_np=args.min_np, max_np=args.max_np,
+                       max_memory=args.max_memory, filters=args.filters, raw_rows=args.raw_rows,
+                       output_format=args.output_format, shard_rows=args.shard_rows,
+                       compression=compression_from_args(args), feature_dtype=args.feature_dtype,
+                       decompression_threads=args.decompression_threads,
+                       collapse_duplicates=args.collapse_duplicates, base_map_strata=args.base_map_strata,
+                       clip_quantiles=args.clip_quantiles)
+    return 0
+
+
+def get_parser():
+    """Set up and return argument parser."""
+    desc = """Compute stat json of trainable features and convert fextract csv file to standardized
+${output_prefix}.npz in a single pass, the same as fextract2stat followed by fextract2numpy --stat-json\n"""
+    p = argparse.ArgumentParser(desc)
+    p.add_argument("fextract_filename", help="fextract csv file, may be gzip or bgzip compressed, or - for stdin")
+    p.add_argument("output_prefix", help="Output prefix")
+    p.add_argument("out_stat_json", help="Output stat json file contain mean, stdev, min, max of trainable features")
+    p.add_argument("--num-train-rows", type=int, default=0, help="Number of training rows, 0 means no limitation")
+    p.add_argument("--max-memory", type=parse_memory_size, default=None,
+                   help="Approximate peak memory for converting rows, e.g., 4G or 512M. Default: no limitation")
+    add_clip_quantiles_arg(p)
+    add_decompression_threads_arg(p)
+    add_raw_rows_arg(p)
+    add_base_map_strata_arg(p)
+    add_output_format_arg(p)
+    return add_filter_args(p)
+
+
+def main(args=sys.argv[1:]):
+    """main"""
+    run(get_parser().parse_args(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main(args=sys.argv[1:]))
@@ -0,0 +1,105 @@
+"""
+Vectorized row filters of fextract.csv.
+
+A RowFilter evaluates the rules of is_good_fextract_row, which are ccs2genome cigar, strand,
+distance to CCS read ends and NumPasses, together with optional user predicates on any
+fextract column, e.g., 'CCSHPLength<=8', as boolean masks over blocks of rows parsed by
+FextractReader, instead of calling a python function per row.
+"""
+import operator
+import re
+import numpy as np
+from tfccs.constants import MIN_DIST2END, ALLOWED_STRANDS, ALLOWED_CIGARS, MIN_NUMPASSES, MAX_NUMPASSES
+from tfccs.utils import is_good_fextract_block
+
+# Columns used by is_good_fextract_block, CCSLength and CCSPos are mandatory
+RULE_COLUMNS = ['CCSToGenomeCigar', 'CCSLength', 'CCSPos', 'CCSToGenomeStrand',
+                'BaseCoverage', 'BaseCoverage_FWD', 'BaseCoverage_REV']
+MANDATORY_RULE_COLUMNS = ['CCSLength', 'CCSPos']
+
+OPERATORS = {'<=': operator.le, '>=': operator.ge, '==': operator.eq,
+             '!=': operator.ne, '<': operator.lt, '>': operator.gt}
+PREDICATE_PATTERN = re.compile(r'^\s*(\w+)\s*(<=|>=|==|!=|<|>)\s*(\S.*?)\s*$')
+
+
+class Predicate(object):
+    """
+    A comparison between a fextract column and a constant, e.g., CCSHPLength<=8 or CCSToGenomeCigar==X.
+    Numeric columns are compared numerically, string columns are compared as strings.
+    """
+
+    def __init__(self, column, op, value):
+        if op not in OPERATORS:
+            raise ValueError("Unsupported operator {} in predicate! Only support {}".format(op, list(OPERATORS)))
+        self.column = column
+        self.op = op
+        self.value = value
+
+    @classmethod
+    def from_string(cls, s):
+        m = PREDICATE_PATTERN.match(s)
+        if m is None:
+            raise ValueError("Could not parse predicate '{}', expected e.g., 'CCSHPLength<=8'!".format(s))
+        return Predicate(column=m.group(1), op=m.group(2), value=m.group(3))
+
+    def __repr__(self):
+        return '{}{}{}'.format(self.column, self.op, self.value)
+
+    def mask(self, data):
+        """Return a boolean mask of rows satisfying this predicate, data is a numpy structured array"""
+        values = data[self.column]
+        if values.dtype.kind == 'S':
+            value = self.value.encode()
+        else:
+            try:
+                value = float(self.value)
+            except ValueError:
+                raise ValueError("Predicate {} compares numeric column {} with a non-numeric value!".format(
+                    self, self.column))
+        return OPERATORS[self.op](values, value)
+
+
+class RowFilter(object):
+    """
+    Filter of fextract rows, see is_good_fextract_row for the default rules.
+        predicates --- extra Predicate or strings such as 'CCSHPLength<=8', a good row must satisfy all.
+    """
+
+    def __init__(self, min_dist2end=MIN_DIST2END, allowed_strands=ALLOWED_STRANDS,
+                 allowed_ccs2genome_cigars=ALLOWED_CIGARS, min_np=MIN_NUMPASSES,
+                 max_np=MAX_NUMPASSES, predicates=()):
+        self.min_dist2end = min_dist2end
+        self.allowed_strands = allowed_strands
+        self.allowed_ccs2genome_cigars = allowed_ccs2genome_cigars
+        self.min_np = min_np
+        self.max_np = max_np
+        self.predicates = [p if isinstance(p, Predicate) else Predicate.from_string(p)
+                           for p in (predicates or [])]
+
+    @classmethod
+    def from_args(cls, args):
+        """Create a RowFilter from command line arguments, see add_filter_args"""
+        return RowFilter(min_dist2end=args.min_dist2end, allowed_strands=args.allowed_strands,
+                         allowed_ccs2genome_cigars=args.allowed_cigars, min_np=args.min_np,
+                         max_np=args.max_np, predicates=args.filters)
+
+    def __repr__(self):
+        return "RowFilter(min_dist2end={}, allowed_strands={}, allowed_cigars={}, min_np={}, max_np={}, predicates={})".format(
+            self.min_dist2end, self.allowed_strands, self.allowed_ccs2genome_cigars, self.min_np, self.max_np,
+            self.predicates)
+
+    def columns(self, fieldnames):
+        """Return columns in fieldnames which are required to filter rows"""
+        missing = [c for c in MANDATORY_RULE_COLUMNS + [p.column for p in self.predicates] if c not in fieldnames]
+        if missing:
+            raise ValueError("Columns {} required by row filter do not exist!".format(missing))
+        return [c for c in fieldnames if c in RULE_COLUMNS or c in [p.column for p in self.predicates]]
+
+    def mask(self, data):
+        """Return a boolean mask, True if a row is good. data is a numpy structured array of rows"""
+        good = is_good_fextract_block(data, min_dist2end=self.min_dist2end, allowed_strands=self.allowed_strands,
+                                      allowed_ccs2genome_cigars=self.allowed_ccs2genome_cigars,
+                                      min_np=self.min_np, max_np=self.max_np)
+        for predicate in self.predicates:
+            good &= predicate.mask(data)
+        return good
@@ -0,0 +1,306 @@
+"""
+Byte-offset row index of fextract.csv.
+
+A row index is a sidecar file, by default {fextract.csv}.idx, which stores the byte offset of each
+row of fextract.csv as uint64, so that any rows can be read by seeking instead of scanning the file.
+Rows are non-empty lines after the header, the same as csv.DictReader and FextractReader, and
+the first row has an index of 0.
+
+Layout of an index file:
+    MAGIC --- 8 bytes
+    length of meta --- uint64, little endian
+    meta --- JSON, including fingerprint of fextract.csv, padded by spaces to a multiple of 8 bytes
+    offsets --- uint64 little endian, num_rows + 1 offsets, the last one is the end of data
+
+python fextract_index.py in.fextract.csv
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+import sys
+import numpy as np
+from tfccs.fextract_reader import read_header, DEFAULT_BLOCK_SIZE, NEWLINE, CARRIAGE_RETURN
+from tfccs.fextract_input import is_seekable_input
+
+FORMATTER = op.basename(__file__) + ':%(levelname)s:'+'%(message)s'
+logging.basicConfig(level=logging.DEBUG, format=FORMATTER)
+log = logging.getLogger(__name__)
+
+INDEX_SUFFIX = '.idx'
+ROWS_INDEX_SUFFIX = '.rows.idx'  # Row index of rows kept by fextract2numpy, {prefix}.rows.idx
+MAGIC = b'TFCCSIDX'
+INDEX_VERSION = 2  # 2: max_row_length in meta, rows may be a subset of fextract.csv
+FINGERPRINT_BYTES = 1024 * 1024  # Hash the first and the last 1MB of a file
+MAX_READ_GAP = 64 * 1024  # Rows less than 64KB apart are read in one batch
+MAX_READ_SIZE = 16 * 1024 * 1024
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
+
+def default_index_filename(fextract_filename):
+    return fextract_filename + INDEX_SUFFIX
+
+
+def file_fingerprint(filename):
+    """Return fingerprint of a file, which consists of file size and sha1 of its first and last 1MB."""
+    size = op.getsize(filename)
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as reader:
+        sha1.update(reader.read(FINGERPRINT_BYTES))
+        if size > FINGERPRINT_BYTES:
+            reader.seek(max(FINGERPRINT_BYTES, size - FINGERPRINT_BYTES))
+            sha1.update(reader.read())
+    return '{}:{}'.format(size, sha1.hexdigest())
+
+
+def scan_rows(filename, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Scan a fextract.csv file block by block, and yield (starts, ends, num_lines) of each block, where
+    [starts, ends) are uint64 byte ranges of rows including trailing newlines, and num_lines is
+    number of lines in the block, including empty lines.
+    """
+    offset = len(read_header(filename).encode())
+    with open(filename, 'rb') as reader:
+        reader.seek(offset)
+        remainder = b''
+        while True:
+            chunk = reader.read(block_size)
+            buf = remainder + chunk
+            if not buf:
+                return
+            last = len(buf) if not chunk else buf.rfind(b'\n') + 1
+            if last == 0:
+                remainder = buf
+                continue
+            b = np.frombuffer(buf, dtype=np.uint8, count=last)
+            ends = np.flatnonzero(b == NEWLINE) + 1
+            if len(ends) == 0 or ends[-1] != last:
+                ends = np.append(ends, last)
+            starts = np.concatenate(([0], ends[:-1])).astype(np.int64)
+            # Skip empty lines the same as csv.DictReader, see FextractReader.parse
+            first = b[starts]
+            empty = (first == NEWLINE) | ((first == CARRIAGE_RETURN) & (ends - starts == 2))
+            yield ((starts[~empty] + offset).astype(np.uint64), (ends[~empty] + offset).astype(np.uint64),
+                   len(starts))
+            if not chunk:
+                return
+            remainder, offset = buf[last:], offset + last
+
+
+class RowIndexWriter(object):
+    """
+    Write a row index of all or selected rows of fextract.csv block by block, see FextractIndex.
+    Offsets are spooled to {index_filename}.spool and written to index_filename on close().
+        index_filename --- output row index file
+        fextract_filename --- indexed fextract.csv
+    """
+
+    def __init__(self, index_filename, fextract_filename):
+        if not is_seekable_input(fextract_filename):
+            raise ValueError("Could not index rows of compressed or piped input {}!".format(fextract_filename))
+        self.index_filename = index_filename
+        self.fextract_filename = fextract_filename
+        self.fingerprint = file_fingerprint(fextract_filename)
+        self.num_rows = 0
+        self.max_row_length = 0
+        self.data_end = len(read_header(fextract_filename).encode())
+        self.spool = open(self.spool_filename, 'wb')
+
+    @property
+    def spool_filename(self):
+        return self.index_filename + '.spool'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.spool.close()
+            os.remove(self.spool_filename)
+
+    def write(self, starts, ends):
+        """Append rows of byte ranges [starts, ends) in fextract.csv, in increasing order"""
+        starts, ends = np.asarray(starts, dtype=np.uint64), np.asarray(ends, dtype=np.uint64)
+        if len(starts) == 0:
+            return
+        if starts[0] < self.data_end:
+            raise ValueError("Rows must be written in increasing order of offsets!")
+        self.spool.write(starts.astype('<u8').tobytes())
+        self.num_rows += len(starts)
+        self.max_row_length = max(self.max_row_length, int((ends - starts).max()))
+        self.data_end = int(ends[-1])
+
+    def close(self, num_lines=None):
+        """
+        Write the row index file, and remove the spool file.
+            num_lines --- number of lines after the header including empty lines, if all rows are indexed
+        """
+        self.spool.close()
+        meta = {'version': INDEX_VERSION, 'fextract_filename': op.abspath(self.fextract_filename),
+                'fingerprint': self.fingerprint, 'num_rows': self.num_rows, 'num_lines': num_lines,
+                'max_row_length': self.max_row_length}
+        meta_bytes = json.dumps(meta, sort_keys=True).encode()
+        meta_bytes += b' ' * (-len(meta_bytes) % 8)
+        try:
+            with open(self.index_filename, 'wb') as writer, open(self.spool_filename, 'rb') as reader:
+                writer.write(MAGIC)
+                writer.write(np.uint64(len(meta_bytes)).astype('<u8').tobytes())
+                writer.write(meta_bytes)
+                while True:
+                    buf = reader.read(COPY_BUFFER_SIZE)
+                    if not buf:
+                        break
+                    writer.write(buf)
+                writer.write(np.uint64(self.data_end).astype('<u8').tobytes())
+        finally:
+            os.remove(self.spool_filename)
+        log.info("Created row index {} of {} rows".format(self.index_filename, self.num_rows))
+
+
+def build_row_index(fextract_filename, index_filename=None, block_size=DEFAULT_BLOCK_SIZE):
+    """Build a row index of all rows of fextract_filename, write to index_filename and return FextractIndex."""
+    if index_filename is None:
+        index_filename = default_index_filename(fextract_filename)
+    writer = RowIndexWriter(index_filename, fextract_filename)
+    num_lines = 0
+    for starts, ends, block_num_lines in scan_rows(fextract_filename, block_size=block_size):
+        writer.write(starts, ends)
+        num_lines += block_num_lines
+    writer.close(num_lines=num_lines)
+    return FextractIndex(index_filename, fextract_filename)
+
+
+def is_row_index_file(filename):
+    with open(filename, 'rb') as reader:
+        return reader.read(len(MAGIC)) == MAGIC
+
+
+def iter_lines(filename):
+    """
+    Yield lines of a fextract.csv file, or the header and rows of the fextract.csv file
+    indexed by a row index file, e.g., {prefix}.rows.idx written by fextract2numpy.
+    """
+    if is_row_index_file(filename):
+        row_index = FextractIndex(filename)
+        yield read_header(row_index.fextract_filename)
+        for _, row in row_index.iter_rows(np.arange(row_index.num_rows)):
+            yield row
+    else:
+        with open(filename, 'r') as reader:
+            for line in reader:
+                yield line
+
+
+class FextractIndex(object):
+    """
+    Row index of a fextract.csv file, see build_row_index.
+        index_filename --- row index file
+        fextract_filename --- indexed fextract.csv, None to use the file recorded in the index.
+                              Raise ValueError if the file does not match the index.
+    """
+
+    def __init__(self, index_filename, fextract_filename=None):
+        self.index_filename = index_filename
+        with open(index_filename, 'rb') as reader:
+            if reader.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a fextract row index file!".format(index_filename))
+            meta_length = int(np.frombuffer(reader.read(8), dtype='<u8')[0])
+            self.meta = json.loads(reader.read(meta_length).decode())
+        if self.meta['version'] != INDEX_VERSION:
+            raise ValueError("Unsupported row index version {} of {}!".format(self.meta['version'], index_filename))
+        self.fextract_filename = self.meta['fextract_filename'] if fextract_filename is None else fextract_filename
+        if file_fingerprint(self.fextract_filename) != self.meta['fingerprint']:
+            raise ValueError("Row index {} is out of date, {} has changed!".format(
+                index_filename, self.fextract_filename))
+        # offsets of rows, followed by end of data
+        self.offsets = np.memmap(index_filename, dtype='<u8', mode='r', offset=len(MAGIC) + 8 + meta_length,
+                                 shape=(self.num_rows + 1,))
+
+    @classmethod
+    def find(cls, fextract_filename, index_filename=None):
+        """Return FextractIndex of fextract_filename, or None if index file does not exist or is out of date."""
+        if index_filename is None:
+            index_filename = default_index_filename(fextract_filename)
+        if not op.exists(index_filename):
+            return None
+        try:
+            return FextractIndex(index_filename, fextract_filename)
+        except ValueError as e:
+            log.warning(str(e))
+            return None
+
+    @property
+    def num_rows(self):
+        return self.meta['num_rows']
+
+    @property
+    def num_lines(self):
+        """Number of lines after the header including empty lines, None if only selected rows are indexed"""
+        return self.meta['num_lines']
+
+    def __len__(self):
+        return self.num_rows
+
+    def iter_rows(self, indices):
+        """
+        Yield (index, row) of sorted unique indices, where row is a str including the trailing newline.
+        Nearby rows are read in batches, each of at most MAX_READ_SIZE bytes unless a row is larger.
+        """
+        indices = np.unique(np.asarray(indices, dtype=np.int64))
+        if len(indices) == 0:
+            return
+        if indices[0] < 0 or indices[-1] >= self.num_rows:
+            raise ValueError("Row indices must be within [0, {}) of {}!".format(self.num_rows, self.fextract_filename))
+        starts = self.offsets[indices].astype(np.int64)
+        # Rows may be sparse, the end of a row is bounded by max_row_length
+        ends = np.minimum(self.offsets[indices + 1].astype(np.int64), starts + self.meta['max_row_length'])
+        # Start a new batch if the gap to the previous row is large, or the batch is too large
+        batch_idx, batch_start = 0, 0
+        batches = []
+        for idx in range(1, len(indices) + 1):
+            if idx == len(indices) or starts[idx] - ends[idx - 1] > MAX_READ_GAP or \
+                    ends[idx] - starts[batch_start] > MAX_READ_SIZE:
+                batches.append((batch_start, idx))
+                batch_start = idx
+        with open(self.fextract_filename, 'rb') as reader:
+            for batch_start, batch_end in batches:
+                base = starts[batch_start]
+                reader.seek(base)
+                buf = reader.read(ends[batch_end - 1] - base)
+                for idx in range(batch_start, batch_end):
+                    raw = buf[starts[idx] - base:ends[idx] - base]
+                    # Exclude empty lines between this row and the next row
+                    yield int(indices[idx]), raw[:raw.find(b'\n') + 1 or len(raw)].decode()
+
+    def read_rows(self, indices):
+        """Return a list of rows of indices in the given order, see iter_rows."""
+        rows = dict(self.iter_rows(indices))
+        return [rows[int(idx)] for idx in indices]
+
+
+def run(args):
+    build_row_index(args.fextract_filename, index_filename=args.index_filename)
+    return 0
+
+
+def get_parser():
+    """Set up and return argument parser."""
+    desc = """Build a byte-offset row index of fextract csv file for random row access."""
+    p = argparse.ArgumentParser(desc)
+    p.add_argument("fextract_filename", help="fextract csv file")
+    p.add_argument("--index-filename", default=None,
+                   help="Output row index file, default: ${fextract_filename}" + INDEX_SUFFIX)
+    return p
+
+
+def main(args=sys.argv[1:]):
+    """main"""
+    run(get_parser().parse_args(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main(args=sys.argv[1:]))
@@ -0,0 +1,182 @@
+"""
+Open fextract.csv as a binary stream, from an uncompressed file, a gzip or bgzip compressed file, or stdin.
+
+fextract.csv may be piped from the feature extractor, e.g.,
+    fextract ... | gzip -c | fextract2numpy - output_prefix
+where '-' stands for stdin. Compressed input is detected by the gzip magic rather than file extensions.
+bgzip files consist of independent deflate blocks of at most 64KB, see the BGZF section of the SAM
+specification, which are decompressed by multiple threads. Other gzip files are decompressed by a single thread.
+
+Compressed and piped input can only be read sequentially: rows can not be split into byte ranges
+for multiple processes, or be indexed by byte offsets, see is_seekable_input.
+
+Multiple fextract.csv files may be passed as a glob pattern, e.g., 'chunk-*.fextract.csv', or as a file of
+filenames ending with .fofn, see expand_fextract_inputs.
+"""
+import collections
+import concurrent.futures
+import glob
+import gzip
+import io
+import struct
+import sys
+import zlib
+
+STDIN = '-'
+FOFN_SUFFIX = '.fofn'
+GLOB_CHARS = '*?['
+GZIP_MAGIC = b'\x1f\x8b'
+BGZF_MAGIC = GZIP_MAGIC + b'\x08\x04'  # deflate, with extra fields
+BGZF_HEADER = struct.Struct('<4sIBBH')  # magic, CM and FLG; MTIME; XFL; OS; XLEN
+BGZF_BLOCKS_PER_TASK = 16  # Decompress about 1MB per task
+DEFAULT_DECOMPRESSION_THREADS = 4
+
+
+def is_stdin(filename):
+    return filename == STDIN
+
+
+def expand_fextract_inputs(spec):
+    """
+    Return a list of fextract.csv files of spec, which is a file, STDIN, a glob pattern whose matches are
+    sorted by name, or a file of filenames ending with FOFN_SUFFIX, one filename per line.
+    """
+    if is_stdin(spec):
+        return [spec]
+    if spec.endswith(FOFN_SUFFIX):
+        with open(spec, 'r') as reader:
+            filenames = [line.strip() for line in reader if line.strip()]
+    elif any(c in spec for c in GLOB_CHARS):
+        filenames = sorted(glob.glob(spec))
+    else:
+        filenames = [spec]
+    if len(filenames) == 0:
+        raise ValueError("No fextract csv file matches {}!".format(spec))
+    if len(filenames) > 1 and STDIN in filenames:
+        raise ValueError("Could not read stdin together with other fextract csv files in {}!".format(spec))
+    return filenames
+
+
+def is_gzip_input(filename):
+    """True if filename is a gzip or bgzip compressed file"""
+    if is_stdin(filename):
+        return sys.stdin.buffer.peek(2)[:2] == GZIP_MAGIC
+    with open(filename, 'rb') as reader:
+        return reader.read(2) == GZIP_MAGIC
+
+
+def is_seekable_input(filename):
+    """True if filename is an uncompressed file, whose rows can be read by byte offsets"""
+    return not is_stdin(filename) and not is_gzip_input(filename)
+
+
+def is_bgzf(head):
+    """True if head, the leading bytes of a stream, is a bgzip block, whose extra subfield is BC"""
+    return len(head) >= 16 and head[:4] == BGZF_MAGIC and head[12:14] == b'BC'
+
+
+def read_bgzf_block(reader):
+    """Read the next bgzip block, return (compressed data, crc32, uncompressed size), or None at the end"""
+    header = reader.read(BGZF_HEADER.size)
+    if not header:
+        return None
+    if len(header) < BGZF_HEADER.size or header[:4] != BGZF_MAGIC:
+        raise ValueError("Truncated or invalid bgzip block!")
+    xlen = BGZF_HEADER.unpack(header)[-1]
+    extra = reader.read(xlen)
+    block_size = None
+    pos = 0
+    while pos + 4 <= len(extra):
+        slen = struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+        if extra[pos:pos + 2] == b'BC':
+            block_size = struct.unpack('<H', extra[pos + 4:pos + 6])[0] + 1
+        pos += 4 + slen
+    if block_size is None:
+        raise ValueError("Missing BSIZE in bgzip block!")
+    rest = reader.read(block_size - BGZF_HEADER.size - xlen)
+    if len(rest) != block_size - BGZF_HEADER.size - xlen:
+        raise ValueError("Truncated bgzip block!")
+    crc, size = struct.unpack('<II', rest[-8:])
+    return rest[:-8], crc, size
+
+
+def inflate_bgzf_blocks(blocks):
+    """Decompress and verify a list of bgzip blocks, and return uncompressed bytes"""
+    out = []
+    for data, crc, size in blocks:
+        raw = zlib.decompress(data, -zlib.MAX_WBITS)
+        if len(raw) != size or zlib.crc32(raw) != crc:
+            raise ValueError("Corrupted bgzip block, CRC32 or size mismatch!")
+        out.append(raw)
+    return b''.join(out)
+
+
+class BgzfReader(io.RawIOBase):
+    """
+    Read-only stream of uncompressed bytes of a bgzip stream, which decompresses blocks by a thread pool
+    while the consumer parses previous blocks. zlib releases the GIL, so that threads run in parallel.
+        reader --- binary stream of bgzip compressed data
+        nthreads --- number of decompression threads
+    """
+
+    def __init__(self, reader, nthreads=DEFAULT_DECOMPRESSION_THREADS):
+        super(BgzfReader, self).__init__()
+        self.reader = reader
+        self.nthreads = max(1, int(nthreads))
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.nthreads)
+        self.pending = collections.deque()
+        self.eof = False
+        self.buf = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def submit(self):
+        """Read compressed blocks ahead, so that at most 2 * nthreads tasks are pending"""
+        while not self.eof and len(self.pending) < 2 * self.nthreads:
+            blocks = []
+            while len(blocks) < BGZF_BLOCKS_PER_TASK:
+                block = read_bgzf_block(self.reader)
+                if block is None:
+                    self.eof = True
+                    break
+                blocks.append(block)
+            if blocks:
+                self.pending.append(self.executor.submit(inflate_bgzf_blocks, blocks))
+
+    def readinto(self, b):
+        while len(self.buf) == 0:
+            self.submit()
+            if not self.pending:
+                return 0
+            self.buf = memoryview(self.pending.popleft().result())
+        n = min(len(b), len(self.buf))
+        b[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown(wait=True)
+            self.reader.close()
+        super(BgzfReader, self).close()
+
+
+def open_fextract(filename, nthreads=DEFAULT_DECOMPRESSION_THREADS):
+    """
+    Return a binary stream of uncompressed fextract.csv, see the module doc.
+        filename --- fextract.csv, fextract.csv.gz, or STDIN
+        nthreads --- number of threads to decompress bgzip input
+    """
+    reader = sys.stdin.buffer if is_stdin(filename) else open(filename, 'rb')
+    head = reader.peek(16)[:16]
+    if is_bgzf(head):
+        return io.BufferedReader(BgzfReader(reader, nthreads=nthreads))
+    if head[:2] == GZIP_MAGIC:
+        if is_stdin(filename):
+            return gzip.GzipFile(fileobj=reader, mode='rb')
+        reader.close()
+        return gzip.open(filename, 'rb')
+    return reader
@@ -0,0 +1,325 @@
+"""
+Block-oriented reader of fextract.csv.
+
+Instead of parsing each row into a dict by csv.DictReader, read fextract.csv in large
+newline-aligned byte blocks, and parse each block column by column into a numpy
+structured array:
+- string columns (e.g., CCSBase, CCSToGenomeCigar) as fixed width bytes
+- integer columns (e.g., CCSPos, ArrowQv) as int64
+- all other columns as float32, the same as np.fromiter(..., dtype=np.float32)
+
+Blocks are parsed by the optional compiled tokenizer tfccs._fextract_tokenizer, which is built by setup.py
+if a C compiler is available, and otherwise, or if a block has values it does not support (e.g., nan),
+by np.loadtxt, which gives the same values.
+
+fextract.csv may be gzip or bgzip compressed, or piped from stdin, see tfccs.fextract_input.
+"""
+import io
+import os.path as op
+import numpy as np
+from tfccs.fextract_input import open_fextract, is_stdin, is_seekable_input, DEFAULT_DECOMPRESSION_THREADS
+try:
+    from tfccs import _fextract_tokenizer
+except ImportError:
+    _fextract_tokenizer = None
+
+DEFAULT_BLOCK_SIZE = 32 * 1024 * 1024  # 32MB per block, about 100K fextract rows
+RANGES_PER_PROC = 4  # Split input into more byte ranges than processes to balance loads
+
+# Non-numeric columns and their max width in bytes.
+# Widths are wider than expected values, so that invalid values are not truncated into valid ones.
+STRING_COLUMNS = {
+    "Movie": 128,
+    "CCSBase": 8,
+    "PrevBases": 8,
+    "NextBases": 8,
+    "CCSToGenomeStrand": 8,
+    "CCSToGenomeCigar": 8,
+    "PrevCcsToGenomeCigar": 8,
+    "NextCcsToGenomeCigar": 8,
+}
+
+INTEGER_COLUMNS = ["HoleNumber", "CCSPos", "CCSLength", "ArrowQv", "CcsToGenomePrevDeletions"]
+
+# Kinds of fields of tfccs._fextract_tokenizer.tokenize specs
+SKIP_FIELD, FLOAT32_FIELD, INT64_FIELD, BYTES_FIELD = 0, 1, 2, 3
+
+NEWLINE = ord('\n')
+CARRIAGE_RETURN = ord('\r')
+
+
+def column_dtype(column):
+    """Return numpy dtype to parse a fextract column"""
+    if column in STRING_COLUMNS:
+        return 'S{}'.format(STRING_COLUMNS[column])
+    if column in INTEGER_COLUMNS:
+        return np.int64
+    return np.float32
+
+
+def tokenizer_specs(fieldnames, dtype):
+    """
+    Return bytes of int64 (kind, offset, width) of each field of fieldnames to parse into a numpy
+    structured array of dtype by tfccs._fextract_tokenizer.tokenize, where fields not in dtype are skipped.
+    """
+    specs = np.zeros((len(fieldnames), 3), dtype=np.int64)
+    for idx, name in enumerate(fieldnames):
+        if name not in dtype.names:
+            continue
+        field_dtype, field_offset = dtype.fields[name][:2]
+        if field_dtype.kind == 'S':
+            kind = BYTES_FIELD
+        elif field_dtype == np.int64:
+            kind = INT64_FIELD
+        else:
+            kind = FLOAT32_FIELD
+        specs[idx] = (kind, field_offset, field_dtype.itemsize)
+    return specs.tobytes()
+
+
+def read_header(filename):
+    """
+    Return header line of a fextract.csv file, including the trailing newline.
+    stdin can only be read once, use FextractReader(STDIN).header instead.
+    """
+    if is_stdin(filename):
+        raise ValueError("Could not read header of stdin more than once, use FextractReader.header instead!")
+    with open_fextract(filename, nthreads=1) as reader:
+        return reader.readline().decode()
+
+
+def header_to_fieldnames(header):
+    return header.rstrip('\r\n').split(',')
+
+
+class FextractBlock(object):
+    """
+    A block of consecutive rows of fextract.csv.
+        data --- numpy structured array, one field per parsed column
+        raw --- raw bytes of rows in this block
+        row_starts --- start of each row in raw
+        row_ends --- end of each row in raw, including the trailing newline
+        offset --- byte offset of raw in fextract.csv
+    """
+
+    def __init__(self, data, raw, row_starts, row_ends, offset):
+        self.data = data
+        self.raw = raw
+        self.row_starts = row_starts
+        self.row_ends = row_ends
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, column):
+        return self.data[column]
+
+    @property
+    def columns(self):
+        return self.data.dtype.names
+
+    @property
+    def offsets(self):
+        """Byte offset of each row in fextract.csv"""
+        return self.row_starts.astype(np.uint64) + np.uint64(self.offset)
+
+    def row_spans(self, indices):
+        """Return a (N, 2) uint64 array of [start, end) byte offsets in fextract.csv of rows of indices."""
+        indices = np.asarray(indices, dtype=np.int64)
+        spans = np.stack([self.row_starts[indices], self.row_ends[indices]], axis=1).astype(np.uint64)
+        return spans + np.uint64(self.offset)
+
+    def raw_rows(self, indices):
+        """Return raw bytes of rows of sorted indices, concatenated in order."""
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) == 0:
+            return b''
+        # Copy runs of adjacent rows at once
+        starts, ends = self.row_starts[indices], self.row_ends[indices]
+        breaks = np.flatnonzero(ends[:-1] != starts[1:]) + 1
+        run_starts = starts[np.concatenate(([0], breaks))]
+        run_ends = ends[np.concatenate((breaks - 1, [len(indices) - 1]))]
+        return b''.join([self.raw[s:e] for s, e in zip(run_starts, run_ends)])
+
+
+class FextractReader(object):
+    """
+    Read fextract.csv in blocks of FextractBlock.
+        filename --- Input fextract.csv, which may be gzip or bgzip compressed, or STDIN
+        columns --- Columns to parse, None to parse all columns, see select.
+        block_size --- Approximate number of bytes per block
+        byte_range --- (start, end), only read rows starting within [start, end) of the file,
+                       where start and end must be at row boundaries, see byte_ranges.
+                       None to read all rows. Compressed files and stdin only support None.
+        nthreads --- number of threads to decompress bgzip input
+    Compressed files can be read multiple times, stdin can only be read once.
+    Byte offsets of blocks are offsets in the uncompressed stream.
+    """
+
+    def __init__(self, filename, columns=None, block_size=DEFAULT_BLOCK_SIZE, byte_range=None,
+                 nthreads=DEFAULT_DECOMPRESSION_THREADS):
+        self.filename = filename
+        self.block_size = int(block_size)
+        self.nthreads = nthreads
+        self.seekable = is_seekable_input(filename)
+        self.stream = None
+        if is_stdin(filename):
+            # Keep stdin open after reading the header, which is the only pass over rows
+            self.stream = open_fextract(filename, nthreads=nthreads)
+            self.header = self.stream.readline().decode()
+        else:
+            self.header = read_header(filename)
+        self.fieldnames = header_to_fieldnames(self.header)
+        self.select(columns)
+        if byte_range is not None and not self.seekable:
+            raise ValueError("Could not read a byte range of compressed or piped input {}!".format(filename))
+        if byte_range is None:
+            byte_range = (self.data_start, op.getsize(filename) if self.seekable else None)
+        self.byte_range = tuple(byte_range)
+
+    def select(self, columns):
+        """Parse only columns, None to parse all columns"""
+        if columns is None:
+            columns = self.fieldnames
+        missing = set(columns).difference(self.fieldnames)
+        if missing:
+            raise ValueError("Columns {} do not exist in {}!".format(sorted(missing), self.filename))
+        self.columns = [c for c in self.fieldnames if c in set(columns)]
+        self.usecols = [self.fieldnames.index(c) for c in self.columns]
+        self.dtype = np.dtype([(c, column_dtype(c)) for c in self.columns])
+        self.tokenizer_specs = tokenizer_specs(self.fieldnames, self.dtype)
+
+    @property
+    def data_start(self):
+        """Byte offset of the first row"""
+        return len(self.header.encode())
+
+    def byte_ranges(self, num_ranges):
+        """
+        Split rows of the file into at most num_ranges newline-aligned byte ranges of similar size.
+        Return a list of (start, end), which can be passed to FextractReader as byte_range.
+        """
+        if not self.seekable:
+            raise ValueError("Could not split compressed or piped input {} into byte ranges!".format(self.filename))
+        start, end = self.data_start, op.getsize(self.filename)
+        cuts = [start]
+        with open(self.filename, 'rb') as reader:
+            for idx in range(1, num_ranges):
+                pos = start + (end - start) * idx // num_ranges
+                if pos <= cuts[-1]:
+                    continue
+                reader.seek(pos - 1)
+                reader.readline()  # move to the start of next row
+                if reader.tell() >= end:
+                    break
+                if reader.tell() > cuts[-1]:
+                    cuts.append(reader.tell())
+        cuts.append(end)
+        return [(s, e) for s, e in zip(cuts[:-1], cuts[1:]) if e > s]
+
+    def open_rows(self):
+        """Return a binary stream at the first row of byte_range"""
+        if self.stream is not None:
+            reader, self.stream = self.stream, None
+            return reader
+        if is_stdin(self.filename):
+            raise ValueError("Could not read rows of stdin more than once!")
+        if self.seekable:
+            reader = open(self.filename, 'rb')
+            reader.seek(self.byte_range[0])
+        else:
+            reader = open_fextract(self.filename, nthreads=self.nthreads)
+            reader.readline()
+        return reader
+
+    def __iter__(self):
+        offset, end = self.byte_range
+        with self.open_rows() as reader:
+            remainder = b''
+            while True:
+                size = self.block_size if end is None else max(0, min(self.block_size, end - offset - len(remainder)))
+                chunk = reader.read(size)
+                if not chunk:
+                    if remainder:
+                        yield self.parse(remainder, offset)
+                    return
+                buf, chunk = remainder + chunk, None
+                last = buf.rfind(b'\n') + 1
+                if last == 0:
+                    remainder = buf
+                    continue
+                # Release references to buf before yielding, to keep a single block in memory
+                raw, remainder, buf = buf[:last], buf[last:], None
+                block, raw = self.parse(raw, offset), None
+                yield block
+                block = None
+                offset += last
+
+    def parse(self, raw, offset):
+        """Parse raw bytes of complete rows starting at offset and return a FextractBlock."""
+        parsed = self.tokenize(raw)
+        if parsed is not None:
+            data, starts, ends = parsed
+            return FextractBlock(data=data, raw=raw, row_starts=starts, row_ends=ends, offset=offset)
+        buf = np.frombuffer(raw, dtype=np.uint8)
+        ends = np.flatnonzero(buf == NEWLINE) + 1
+        if len(ends) == 0 or ends[-1] != len(raw):
+            ends = np.append(ends, len(raw))
+        starts = np.concatenate(([0], ends[:-1]))
+        # csv.DictReader skips empty lines, so do we.
+        first = buf[starts]
+        empty = (first == NEWLINE) | ((first == CARRIAGE_RETURN) & (ends - starts == 2))
+        starts, ends = starts[~empty].astype(np.int64), ends[~empty].astype(np.int64)
+
+        if len(starts) == 0:
+            data = np.empty(0, dtype=self.dtype)
+        else:
+            data = np.loadtxt(io.BytesIO(raw), delimiter=',', dtype=self.dtype, usecols=self.usecols,
+                              comments=None, ndmin=1)
+        if len(data) != len(starts):
+            raise ValueError("Could not parse {} rows at byte offset {} of {}!".format(
+                len(starts), offset, self.filename))
+        return FextractBlock(data=data, raw=raw, row_starts=starts, row_ends=ends, offset=offset)
+
+    def tokenize(self, raw):
+        """
+        Parse raw by tfccs._fextract_tokenizer and return (data, row_starts, row_ends), see FextractBlock.
+        Return None if it is not built or does not support values of raw, which are then parsed by np.loadtxt.
+        """
+        if _fextract_tokenizer is None:
+            return None
+        max_rows = raw.count(b'\n') + 1
+        data = np.empty(max_rows, dtype=self.dtype)
+        starts, ends = np.empty(max_rows, dtype=np.int64), np.empty(max_rows, dtype=np.int64)
+        num_rows = _fextract_tokenizer.tokenize(raw, data.view(np.uint8), self.tokenizer_specs, self.dtype.itemsize,
+                                                starts, ends)
+        if num_rows < 0:
+            return None
+        return data[:num_rows], starts[:num_rows], ends[:num_rows]
+
+
+def open_fextract_readers(filenames, block_size=DEFAULT_BLOCK_SIZE, nthreads=DEFAULT_DECOMPRESSION_THREADS):
+    """
+    Return a FextractReader of each file of filenames, see tfccs.fextract_input.expand_fextract_inputs.
+    Raise ValueError unless all files have the same fieldnames.
+    """
+    readers = [FextractReader(filename, block_size=block_size, nthreads=nthreads) for filename in filenames]
+    for reader in readers[1:]:
+        if reader.fieldnames != readers[0].fieldnames:
+            raise ValueError("Header of {} differs from header of {}!\nUnique columns: {}".format(
+                reader.filename, readers[0].filename,
+                sorted(set(reader.fieldnames).symmetric_difference(readers[0].fieldnames))))
+    return readers
+
+
+def task_byte_ranges(reader, nproc, block_size, num_files=1):
+    """
+    Return byte ranges of a FextractReader to process by worker processes, see FextractReader.byte_ranges.
+    Rows of uncompressed files are split into about nproc * RANGES_PER_PROC ranges over all num_files files,
+    and ranges of at most block_size bytes. Compressed files are processed as a whole, [None].
+    """
+    if not reader.seekable:
+        return [None]
+    data_size = reader.byte_range[1] - reader.byte_range[0]
+    return reader.byte_ranges(max(-(-nproc * RANGES_PER_PROC // num_files), -(-data_size // block_size)))
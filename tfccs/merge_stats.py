@@ -0,0 +1,57 @@
+"""
+Merge stat json files of disjoint rows, e.g., of chunks of a movie computed by fextract2stat in parallel,
+into one stat json file, the same as running fextract2stat over all rows.
+Example:
+    merge-stats out.stat.json chunk-1.stat.json chunk-2.stat.json
+"""
+import sys
+import argparse
+import logging
+import os.path as op
+from tfccs.fextract2stat import FeatureStatAccumulator
+
+FORMATTER = op.basename(__file__) + ':%(levelname)s:'+'%(message)s'
+logging.basicConfig(level=logging.DEBUG, format=FORMATTER)
+log = logging.getLogger(__name__)
+
+
+def merge_stat_jsons(in_stat_jsons, out_stat_json):
+    """
+    Merge stat json files of the same features, which must have count and m2 of each feature,
+    see FeatureStatAccumulator.write_json, and write to out_stat_json, whose StatHistory has the input files.
+    """
+    if len(in_stat_jsons) == 0:
+        raise ValueError("Must provide at least one stat json file to merge!")
+    stats = FeatureStatAccumulator(FeatureStatAccumulator.from_json(in_stat_jsons[0]).features)
+    for in_stat_json in in_stat_jsons:
+        in_stats = FeatureStatAccumulator.from_json(in_stat_json)
+        stats.merge_accumulator(in_stats)
+        stats.history.append({"version": stats.version, "source": op.abspath(in_stat_json),
+                              "count": int(in_stats.count)})
+    log.info("Merged stats of {} rows of {} files".format(stats.count, len(in_stat_jsons)))
+    stats.write_json(out_stat_json)
+
+
+def run(args):
+    if not args.out_stat_json.endswith('.stat.json'):
+        raise ValueError("Output stat json file must ends with .stat.json! {}".format(args.out_stat_json))
+    merge_stat_jsons(args.in_stat_jsons, args.out_stat_json)
+    return 0
+
+
+def get_parser():
+    """Set up and return argument parser."""
+    desc = """Merge stat json files of disjoint fextract rows computed by fextract2stat"""
+    p = argparse.ArgumentParser(desc)
+    p.add_argument("out_stat_json", help="Output stat json file of all rows")
+    p.add_argument("in_stat_jsons", nargs='+', help="Input stat json files, each has count and m2 of features")
+    return p
+
+
+def main(args=sys.argv[1:]):
+    """main"""
+    run(get_parser().parse_args(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main(args=sys.argv[1:]))
@@ -0,0 +1,142 @@
+"""
+Mergeable quantile sketches of features in bounded memory, computed in a single pass block by block.
+
+A sketch counts values of each feature in logarithmic buckets, aka DDSketch (Masson et al., VLDB 2019).
+Bucket k of positive values covers (gamma^(k-1), gamma^k], where gamma = (1 + alpha) / (1 - alpha),
+negative values are bucketed by their absolute values, and values whose absolute values are less than
+MIN_INDEXABLE_VALUE may be counted in the zero bucket. Each bucket also keeps min and max of its values.
+Error bound: a quantile q of n values is estimated by the middle of the bucket of x, the value of rank
+floor(q * (n - 1)) in sorted values, clipped to min and max of the bucket, which is within relative error alpha
+of x, i.e., |estimate - x| <= alpha * |x|, or within MIN_INDEXABLE_VALUE of x if |x| < MIN_INDEXABLE_VALUE.
+The estimate is exact if values of the bucket are the same, e.g., of binary or small integer features.
+Absolute values greater than MAX_INDEXABLE_VALUE are counted in the last bucket, whose estimates are within
+[min, max] of the bucket.
+Unlike sampling based sketches, e.g., KLL, the error bound holds for extreme quantiles such as q0.1 and q99.9,
+counts are exact, and sketches of disjoint rows merge into exactly the sketch of all rows, see merge.
+
+Memory is O(number of features * number of buckets), about 1700 buckets per sign for alpha of 0.01,
+independent of the number of rows.
+"""
+import numpy as np
+
+DEFAULT_RELATIVE_ACCURACY = 0.01  # alpha
+MIN_INDEXABLE_VALUE = 1e-6
+MAX_INDEXABLE_VALUE = 1e9
+
+
+class QuantileSketch(object):
+    """
+    Quantile sketches of features, see the module doc.
+    counts[i, j] is the number of values of feature i in bucket j, where buckets are in the order of values:
+    negative buckets of decreasing absolute values, the zero bucket num_buckets, then positive buckets.
+    mins[i, j] and maxs[i, j] are min and max of values of feature i in bucket j.
+        num_features --- number of features, columns of blocks
+        alpha --- relative accuracy of quantiles
+    """
+
+    def __init__(self, num_features, alpha=DEFAULT_RELATIVE_ACCURACY):
+        if not 0 < alpha < 1:
+            raise ValueError("Relative accuracy of quantile sketch must be within (0, 1), not {}!".format(alpha))
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = np.log(self.gamma)
+        self.min_key = int(np.ceil(np.log(MIN_INDEXABLE_VALUE) / self.log_gamma))
+        self.num_buckets = int(np.ceil(np.log(MAX_INDEXABLE_VALUE) / self.log_gamma)) - self.min_key + 1
+        self.counts = np.zeros((num_features, 2 * self.num_buckets + 1), dtype=np.int64)
+        self.mins = np.full(self.counts.shape, np.inf, dtype=np.float64)
+        self.maxs = np.full(self.counts.shape, -np.inf, dtype=np.float64)
+
+    @property
+    def num_features(self):
+        return len(self.counts)
+
+    def bucket_indices(self, values):
+        """
+        Return indices of buckets of values, an array of any shape of finite values.
+        Values of absolute values not greater than gamma^(min_key - 1), which is less than MIN_INDEXABLE_VALUE,
+        are in the zero bucket.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        keys = np.abs(values)
+        with np.errstate(divide='ignore'):
+            np.log(keys, out=keys)
+        keys *= 1.0 / self.log_gamma
+        np.ceil(keys, out=keys)
+        keys -= self.min_key - 1
+        np.clip(keys, 0, self.num_buckets, out=keys)
+        np.copysign(keys, values, out=keys)
+        keys += self.num_buckets
+        return keys.astype(np.int64)
+
+    def bucket_values(self, indices):
+        """Return values representing buckets of indices, whose relative errors are at most alpha"""
+        offsets = np.asarray(indices, dtype=np.int64) - self.num_buckets
+        magnitudes = 2 * self.gamma ** (np.abs(offsets) - 1 + self.min_key) / (self.gamma + 1)
+        return np.where(offsets == 0, 0.0, np.sign(offsets) * magnitudes)
+
+    def update(self, block):
+        """Add a block, a 2d array with one row per base and one column per feature. NaN and inf are skipped"""
+        block = np.asarray(block, dtype=np.float64)
+        if block.size == 0:
+            return
+        if block.shape[1] != self.num_features:
+            raise ValueError("Expect blocks of {} features, got {}!".format(self.num_features, block.shape[1]))
+        finite = np.isfinite(block)
+        if not finite.all():
+            block = block[finite]
+            flat = (self.bucket_indices(block) +
+                    np.broadcast_to(np.arange(self.num_features) * self.counts.shape[1], finite.shape)[finite])
+        else:
+            block = block.ravel()
+            flat = (self.bucket_indices(block).reshape(finite.shape) +
+                    np.arange(self.num_features) * self.counts.shape[1]).ravel()
+        self.counts += np.bincount(flat, minlength=self.counts.size).reshape(self.counts.shape)
+        np.minimum.at(self.mins.reshape(-1), flat, block)
+        np.maximum.at(self.maxs.reshape(-1), flat, block)
+
+    def merge(self, other):
+        """Merge another sketch of disjoint rows of the same features and accuracy"""
+        if other.alpha != self.alpha or other.counts.shape != self.counts.shape:
+            raise ValueError("Could not merge quantile sketches of different features or accuracies!")
+        self.counts += other.counts
+        np.minimum(self.mins, other.mins, out=self.mins)
+        np.maximum(self.maxs, other.maxs, out=self.maxs)
+
+    def quantiles(self, q):
+        """Return estimates of quantile q in [0, 1] of each feature, nan if a feature has no value"""
+        if not 0 <= q <= 1:
+            raise ValueError("Quantile must be within [0, 1], not {}!".format(q))
+        cumsum = np.cumsum(self.counts, axis=1)
+        n = cumsum[:, -1]
+        ranks = np.floor(q * (np.maximum(n, 1) - 1))
+        buckets = (cumsum > ranks[:, None]).argmax(axis=1)
+        rows = np.arange(self.num_features)
+        out = np.clip(self.bucket_values(buckets), self.mins[rows, buckets], self.maxs[rows, buckets])
+        return np.where(n > 0, out, np.nan)
+
+    def to_json_items(self):
+        """
+        Return {'alpha': alpha, 'buckets': [...], 'counts': [...], 'mins': [...], 'maxs': [...]} of non-empty
+        buckets of each feature, where buckets are signed keys, 0 for the zero bucket.
+        """
+        items = []
+        for counts, mins, maxs in zip(self.counts, self.mins, self.maxs):
+            buckets = np.flatnonzero(counts)
+            items.append({'alpha': self.alpha, 'buckets': [int(b) - self.num_buckets for b in buckets],
+                          'counts': [int(c) for c in counts[buckets]], 'mins': [float(v) for v in mins[buckets]],
+                          'maxs': [float(v) for v in maxs[buckets]]})
+        return items
+
+    @classmethod
+    def from_json_items(cls, items):
+        """Load a sketch of features from items written by to_json_items"""
+        alphas = set([float(item['alpha']) for item in items])
+        if len(alphas) != 1:
+            raise ValueError("Quantile sketches of features must have the same accuracy, got {}!".format(alphas))
+        sketch = cls(len(items), alphas.pop())
+        for counts, mins, maxs, item in zip(sketch.counts, sketch.mins, sketch.maxs, items):
+            if not len(item['buckets']) == len(item['counts']) == len(item['mins']) == len(item['maxs']):
+                raise ValueError("Buckets, counts, mins and maxs of a quantile sketch must have the same length!")
+            buckets = np.asarray(item['buckets'], dtype=np.int64) + sketch.num_buckets
+            counts[buckets], mins[buckets], maxs[buckets] = item['counts'], item['mins'], item['maxs']
+        return sketch
@@ -7,6 +7,7 @@ import json
 import argparse
 import logging
 from tfccs.utils import execute, write_to_script, load_fextract_npz, mkdir, add_filter_args
+from tfccs.dataset import dataset_filename, DATASET_FORMATS, DATASET_FORMAT_NPZ
 from tfccs.constants import (MIN_DIST2END, ALLOWED_STRANDS, ALLOWED_CIGARS, DEFAULT_VALIDATION_CSV,
                              MIN_NUMPASSES, MAX_NUMPASSES, HG2_GRC38_HIGHCONFIDENCE_NOINCONSISTENT, HG2_GRC38_KNOWN_VARIANTS)
 
@@ -245,7 +246,7 @@ def generate_config_json(args):
                              out_benchmark_dir="FIXME", param_config=param_config,
                              validation_fextract_csv=DEFAULT_VALIDATION_CSV,
                              min_dist2end=args.min_dist2end, allowed_strands=args.allowed_strands,
-                             allowed_cigars=args.allowed_cigars)
+                             allowed_cigars=args.allowed_cigars, filters=args.filters)
     config_obj.save_json(out_json)
 
 
@@ -256,7 +257,8 @@ class CcsQvConfig(object):
                  validation_fextract_csv=None, min_dist2end=MIN_DIST2END,
                  allowed_strands=ALLOWED_STRANDS, allowed_cigars=ALLOWED_CIGARS,
                  min_np=MIN_NUMPASSES, max_np=MAX_NUMPASSES,
-                 white_mask=None, known_variants=None, variant_flank_size=20):
+                 white_mask=None, known_variants=None, variant_flank_size=20, filters=None,
+                 single_pass_stat=True, dataset_format=DATASET_FORMAT_NPZ):
         self.name = name
         self.in_fextract_csv = in_fextract_csv
         self.in_ccs2genome_bam = in_ccs2genome_bam
@@ -272,6 +274,11 @@ class CcsQvConfig(object):
         self.white_mask = white_mask
         self.known_variants = known_variants
         self.variant_flank_size = variant_flank_size
+        self.filters = list(filters) if filters else []
+        self.single_pass_stat = bool(single_pass_stat)
+        if dataset_format not in DATASET_FORMATS:
+            raise ValueError(f"Unsupported dataset format {dataset_format}! Only support {DATASET_FORMATS}")
+        self.dataset_format = dataset_format
 
     def mkdir(self):
         mkdir(self.out_model_dir)
@@ -325,6 +332,9 @@ class CcsQvConfig(object):
         white_mask = None  # HG2_GRC38_HIGHCONFIDENCE_NOINCONSISTENT
         known_variants = None  # HG2_GRC38_KNOWN_VARIANTS
         variant_flank_size = 20
+        filters = []
+        single_pass_stat = True
+        dataset_format = DATASET_FORMAT_NPZ
         if 'SAMPLING' in d:
             sampling_config = d['SAMPLING']
             if 'MIN_DIST2END' in sampling_config:
@@ -343,6 +353,12 @@ class CcsQvConfig(object):
                 known_variants = sampling_config['KNOWN_VARIANTS']
             if 'VARIANT_FLANK_SIZE' in sampling_config:
                 variant_flank_size = sampling_config['VARIANT_FLANK_SIZE']
+            if 'FILTERS' in sampling_config:
+                filters = sampling_config['FILTERS']
+            if 'SINGLE_PASS_STAT' in sampling_config:
+                single_pass_stat = sampling_config['SINGLE_PASS_STAT']
+            if 'DATASET_FORMAT' in sampling_config:
+                dataset_format = sampling_config['DATASET_FORMAT']
         return CcsQvConfig(name=name, in_fextract_csv=in_fextract_csv,
                            in_ccs2genome_bam=in_ccs2genome_bam,
                            param_config=param_config,
@@ -356,7 +372,10 @@ class CcsQvConfig(object):
                            max_np=max_np,
                            white_mask=white_mask,
                            known_variants=known_variants,
-                           variant_flank_size=variant_flank_size)
+                           variant_flank_size=variant_flank_size,
+                           filters=filters,
+                           single_pass_stat=single_pass_stat,
+                           dataset_format=dataset_format)
 
     def to_dict(self):
         d = {
@@ -374,7 +393,10 @@ class CcsQvConfig(object):
                            'MAX_NUMPASSES': self.max_np,
                            'WHITE_MASK': self.white_mask,
                            'KNOWN_VARIANTS': self.known_variants,
-                           'VARIANT_FLANK_SIZE': self.variant_flank_size}
+                           'VARIANT_FLANK_SIZE': self.variant_flank_size,
+                           'FILTERS': self.filters,
+                           'SINGLE_PASS_STAT': self.single_pass_stat,
+                           'DATASET_FORMAT': self.dataset_format}
         d['SAMPLING'] = sampling_config
         return d
 
@@ -420,7 +442,7 @@ class CcsQvConfig(object):
 
     @property
     def train_npz(self):
-        return self.train_prefix + '.npz'
+        return dataset_filename(self.train_prefix, self.dataset_format)
 
     @property
     def validation_prefix(self):
@@ -428,7 +450,7 @@ class CcsQvConfig(object):
 
     @property
     def validation_npz(self):
-        return self.validation_prefix + '.npz'
+        return dataset_filename(self.validation_prefix, self.dataset_format)
 
     @property
     def sampling_base_map_prob_json(self):
@@ -460,18 +482,27 @@ class CcsQvConfig(object):
 
     def create_prev_train_script(self):
         fextract_filter_argstr = f'--min-dist2end {self.min_dist2end} --allowed-strands {self.allowed_strands} --allowed-cigars {self.allowed_cigars} --min-np {self.min_np} --max-np {self.max_np}'
+        fextract_filter_argstr += ''.join([f" --filter '{predicate}'" for predicate in self.filters])
+        dataset_argstr = f'--output-format {self.dataset_format}'
 
         def gen_stat_cmd(in_fextract_csv, out_stat_json):
             return f'fextract2stat {in_fextract_csv} {out_stat_json} {fextract_filter_argstr}'
 
         def gen_train_npz_cmd(in_fextract_csv, in_stat_json, out_prefix, out_order_json, num_train_rows):
-            c0 = f'fextract2numpy {in_fextract_csv} {out_prefix} --stat-json {in_stat_json} --num-train-rows {num_train_rows} {fextract_filter_argstr}'
+            c0 = f'fextract2numpy {in_fextract_csv} {out_prefix} --stat-json {in_stat_json} --num-train-rows {num_train_rows} {fextract_filter_argstr} {dataset_argstr}'
+            c1 = f'mv {out_prefix}.features.order.json {out_order_json}'
+            c2 = f'mv {out_prefix}.base_map_probability.json {self.sampling_base_map_prob_json}'
+            return c0 + '\n' + c1 + '\n' + c2
+
+        def gen_stat_train_npz_cmd(in_fextract_csv, out_stat_json, out_prefix, out_order_json, num_train_rows):
+            # Compute stat json and convert training data in a single pass over in_fextract_csv
+            c0 = f'fextract2statnumpy {in_fextract_csv} {out_prefix} {out_stat_json} --num-train-rows {num_train_rows} {fextract_filter_argstr} {dataset_argstr}'
             c1 = f'mv {out_prefix}.features.order.json {out_order_json}'
             c2 = f'mv {out_prefix}.base_map_probability.json {self.sampling_base_map_prob_json}'
             return c0 + '\n' + c1 + '\n' + c2
 
         def gen_validation_npz_cmd(in_fextract_csv, in_stat_json, out_prefix):
-            c0 = f'fextract2numpy {in_fextract_csv} {out_prefix} --stat-json {in_stat_json} {fextract_filter_argstr}'
+            c0 = f'fextract2numpy {in_fextract_csv} {out_prefix} --stat-json {in_stat_json} {fextract_filter_argstr} {dataset_argstr}'
             return c0
 
         def qvtools_cmd(ccs2genome_bam, out_baseqv_csv, white_mask=None, known_variants=None, variant_flank_size=20):
@@ -494,13 +525,21 @@ class CcsQvConfig(object):
         def merge_base_map_prob_cmd(in_sampling_json, in_population_json, out_merged_json):
             return f'merge-base-map-prob {in_sampling_json} {in_population_json} {out_merged_json}'
 
-        c0 = gen_stat_cmd(in_fextract_csv=self.in_fextract_csv,
-                          out_stat_json=self.feature_stat_json)
-        c1 = gen_train_npz_cmd(in_fextract_csv=self.in_fextract_csv,
-                               in_stat_json=self.feature_stat_json,
-                               out_prefix=self.train_prefix,
-                               out_order_json=self.feature_order_json,
-                               num_train_rows=self.param_config.num_train_rows)
+        if self.single_pass_stat:
+            c0 = gen_stat_train_npz_cmd(in_fextract_csv=self.in_fextract_csv,
+                                        out_stat_json=self.feature_stat_json,
+                                        out_prefix=self.train_prefix,
+                                        out_order_json=self.feature_order_json,
+                                        num_train_rows=self.param_config.num_train_rows)
+            c1 = ''
+        else:
+            c0 = gen_stat_cmd(in_fextract_csv=self.in_fextract_csv,
+                              out_stat_json=self.feature_stat_json)
+            c1 = gen_train_npz_cmd(in_fextract_csv=self.in_fextract_csv,
+                                   in_stat_json=self.feature_stat_json,
+                                   out_prefix=self.train_prefix,
+                                   out_order_json=self.feature_order_json,
+                                   num_train_rows=self.param_config.num_train_rows)
         c2 = '' if not self.validation_fextract_csv else \
             gen_validation_npz_cmd(in_fextract_csv=self.validation_fextract_csv,
                                    in_stat_json=self.feature_stat_json,
@@ -0,0 +1,163 @@
+"""
+Uniform row sampling of fextract.csv.
+
+Each row gets a pseudo-random key, a seeded hash of its identity (index of its fextract file, byte offset
+of the row in the file), and a sample of N rows is the N rows with the smallest keys, aka a bottom-k sample.
+Since keys do not depend on how rows are split, reservoirs of disjoint byte ranges, converted by different
+processes, merge into exactly the same sample as a single pass over all rows.
+
+A stratified sample keeps a bottom-k reservoir per class, e.g., per ccs2genome cigar class, with a quota of
+rows per class, and counts rows of each class, so that the sampling rate of each class is known.
+"""
+import numpy as np
+
+SAMPLE_FIRST = 'first'  # The first N good rows
+SAMPLE_RESERVOIR = 'reservoir'  # A uniform sample of N good rows
+SAMPLE_MODES = [SAMPLE_FIRST, SAMPLE_RESERVOIR]
+DEFAULT_SEED = 0
+MAX_KEY = np.iinfo(np.uint64).max
+FILE_INDEX_SHIFT = 48  # Position key of a row, file index << 48 + byte offset, see sample_keys
+
+
+def sample_keys(sample, seed, file_indices, offsets):
+    """
+    Return uint64 keys of rows, whose bottom-k rows are the sample of sample mode.
+    SAMPLE_RESERVOIR: seeded hashes of rows, see row_sample_keys.
+    SAMPLE_FIRST: positions of rows in the input, so that bottom-k rows are the first k rows.
+    """
+    if sample == SAMPLE_RESERVOIR:
+        return row_sample_keys(seed, file_indices, offsets)
+    return (np.asarray(file_indices, dtype=np.uint64) << np.uint64(FILE_INDEX_SHIFT)) + \
+        np.asarray(offsets, dtype=np.uint64)
+
+
+def splitmix64(x):
+    """Return splitmix64 hashes of a uint64 array"""
+    with np.errstate(over='ignore'):
+        z = np.asarray(x, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def row_sample_keys(seed, file_indices, offsets):
+    """
+    Return uint64 sample keys of rows.
+        seed --- random seed
+        file_indices --- index of the fextract file of each row
+        offsets --- byte offset of each row in its fextract file
+    """
+    file_indices = np.asarray(file_indices, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        return splitmix64(splitmix64(file_indices + np.uint64(seed)) ^ np.asarray(offsets, dtype=np.uint64))
+
+
+def sort_rows(columns, sort_by):
+    """Return columns sorted by columns of indices sort_by, the first is the primary sort key"""
+    idx = np.lexsort([columns[col] for col in reversed(sort_by)])
+    return [c[idx] for c in columns]
+
+
+class RowReservoir(object):
+    """
+    Bottom-k reservoir of at most size rows of the smallest sample keys, see row_sample_keys.
+    Each row consists of its key and values in one or more columns, which are arrays of the same length.
+    """
+
+    def __init__(self, size):
+        if size <= 0:
+            raise ValueError("Size of a reservoir must be positive, not {}!".format(size))
+        self.size = size
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.columns = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def threshold(self):
+        """Rows whose keys are not less than threshold can not enter the reservoir"""
+        return self.keys.max() if len(self.keys) >= self.size else MAX_KEY
+
+    def add(self, keys, *columns):
+        """Add rows of keys and columns, and keep size rows of the smallest keys"""
+        keys = np.asarray(keys, dtype=np.uint64)
+        if len(keys) == 0:
+            return
+        if self.columns is None:
+            self.columns = [np.asarray(c)[:0] for c in columns]
+        elif len(columns) != len(self.columns):
+            raise ValueError("Expect {} columns of rows, got {}!".format(len(self.columns), len(columns)))
+        keys = np.concatenate([self.keys, keys])
+        columns = [np.concatenate([c0, np.asarray(c)]) for c0, c in zip(self.columns, columns)]
+        if len(keys) > self.size:
+            kept = np.argpartition(keys, self.size - 1)[:self.size]
+            keys, columns = keys[kept], [c[kept] for c in columns]
+        self.keys, self.columns = keys, columns
+
+    def merge(self, other):
+        """Merge rows of another reservoir of disjoint rows"""
+        if len(other) > 0:
+            self.add(other.keys, *other.columns)
+
+    def rows(self, sort_by):
+        """Return columns of rows, sorted by columns of indices sort_by, the first is the primary sort key"""
+        return None if self.columns is None else sort_rows(self.columns, sort_by)
+
+
+class StratifiedReservoir(object):
+    """
+    A RowReservoir of at most quotas[c] rows of each class c, where classes are integer codes in [0, len(quotas)).
+    num_rows counts all rows of each class offered to the sample, see count.
+    """
+
+    def __init__(self, quotas):
+        self.reservoirs = [RowReservoir(quota) for quota in quotas]
+        self.num_rows = np.zeros(len(quotas), dtype=np.int64)
+
+    def __len__(self):
+        return sum([len(r) for r in self.reservoirs])
+
+    @property
+    def thresholds(self):
+        """Threshold of each class, see RowReservoir.threshold"""
+        return np.array([r.threshold for r in self.reservoirs], dtype=np.uint64)
+
+    @property
+    def sizes(self):
+        """Number of sampled rows of each class"""
+        return np.array([len(r) for r in self.reservoirs], dtype=np.int64)
+
+    @property
+    def rates(self):
+        """Sampling rate of each class, number of sampled rows over number of rows, 0 if there is no row"""
+        return self.sizes / np.maximum(self.num_rows, 1)
+
+    def count(self, classes):
+        """Count rows of classes, which must be called once for every row, sampled or not"""
+        self.num_rows += np.bincount(np.asarray(classes, dtype=np.int64), minlength=len(self.reservoirs))
+
+    def candidates(self, keys, classes):
+        """Return a boolean mask of rows which may enter reservoirs of their classes"""
+        return np.asarray(keys, dtype=np.uint64) < self.thresholds[np.asarray(classes, dtype=np.int64)]
+
+    def add(self, keys, classes, *columns):
+        """Add rows of keys, classes and columns to reservoirs of their classes, see RowReservoir.add"""
+        classes = np.asarray(classes, dtype=np.int64)
+        for c, reservoir in enumerate(self.reservoirs):
+            rows = np.flatnonzero(classes == c)
+            if len(rows) > 0:
+                reservoir.add(np.asarray(keys)[rows], *[np.asarray(column)[rows] for column in columns])
+
+    def merge(self, other):
+        """Merge another stratified reservoir of disjoint rows"""
+        self.num_rows += other.num_rows
+        for reservoir, other_reservoir in zip(self.reservoirs, other.reservoirs):
+            reservoir.merge(other_reservoir)
+
+    def rows(self, sort_by):
+        """Return columns of rows of all classes, see RowReservoir.rows"""
+        parts = [r.columns for r in self.reservoirs if r.columns is not None]
+        if not parts:
+            return None
+        return sort_rows([np.concatenate(columns) for columns in zip(*parts)], sort_by)
@@ -6,7 +6,7 @@ import os
 import os.path as op
 import logging
 import argparse
-from tfccs.utils import load_fextract_npz
+from tfccs.utils import load_fextract_npz, check_dataset_stat_version
 from tfccs.models import multinomial_model_0, multinomial_model_1
 
 
@@ -20,10 +20,13 @@ DEFAULT_EARLY_STOP_CALL_BACK = tf.keras.callbacks.EarlyStopping(monitor='accurac
 
 
 def train(x_train, y_train, out_dir, name, batch_size, epochs, create_and_compile_model_func,
-          early_stop_callback=DEFAULT_EARLY_STOP_CALL_BACK, x_val=None, y_val=None):
+          early_stop_callback=DEFAULT_EARLY_STOP_CALL_BACK, x_val=None, y_val=None,
+          sample_weight=None, val_sample_weight=None):
     """
     x_train - normalized standardized features
     y_train - outputs
+    sample_weight - None, or weights of rows of x_train, e.g., counts of collapsed duplicate rows
+    val_sample_weight - None, or weights of rows of x_val
     """
     if not op.exists(out_dir):
         os.mkdir(out_dir)
@@ -37,6 +40,8 @@ def train(x_train, y_train, out_dir, name, batch_size, epochs, create_and_compil
     y_ncol = 1 if len(y_train.shape) == 1 else y_train.shape[1]
     if x_nrow != y_nrow:
         raise ValueError("Number of rows in x_train {} and y_train {} diff!".format(x_nrow, y_nrow))
+    if sample_weight is not None and len(sample_weight) != x_nrow:
+        raise ValueError("Number of rows in x_train {} and sample_weight {} diff!".format(x_nrow, len(sample_weight)))
 
     model = create_and_compile_model_func(x_ncol=x_ncol, y_ncol=y_ncol)
 
@@ -57,13 +62,15 @@ def train(x_train, y_train, out_dir, name, batch_size, epochs, create_and_compil
 
     # Fit with/without validation set
     if x_val is not None and y_val is not None:
+        validation_data = (x_val, y_val) if val_sample_weight is None else (x_val, y_val, val_sample_weight)
         model.fit(x_train, y_train, batch_size=batch_size, epochs=epochs, callbacks=callbacks,
-                  validation_data=(x_val, y_val))
+                  validation_data=validation_data, sample_weight=sample_weight)
     else:
-        model.fit(x_train, y_train, batch_size=batch_size, epochs=epochs, callbacks=callbacks)
+        model.fit(x_train, y_train, batch_size=batch_size, epochs=epochs, callbacks=callbacks,
+                  sample_weight=sample_weight)
 
     # Evaluate
-    evl = model.evaluate(x_train, y_train)
+    evl = model.evaluate(x_train, y_train, sample_weight=sample_weight)
     log.info(evl)
     tf.saved_model.save(model, out_dir)
     return model, evl
@@ -75,15 +82,21 @@ def train_ccs2genome(args, create_and_compile_model_func):
     name = args.name
     batch_size = args.batch_size
     epochs = args.epochs
-    fextract_input, _, _, ccs2genome_cigars, _, _ = load_fextract_npz(in_npz)
     validation_npz = args.validation_npz
-    x_val, y_val = None, None
+    if args.stat_json:
+        # Fail fast if datasets were standardized before the stat json was updated
+        for npz in [in_npz] + ([validation_npz] if validation_npz and op.exists(validation_npz) else []):
+            version = check_dataset_stat_version(npz, args.stat_json)
+        log.info("Datasets were standardized with version {} of {}".format(version, args.stat_json))
+    # Counts of rows of datasets whose duplicate rows were collapsed are used as sample weights
+    fextract_input, _, _, ccs2genome_cigars, _, _, counts = load_fextract_npz(in_npz, return_counts=True)
+    x_val, y_val, val_counts = None, None, None
     if validation_npz and op.exists(validation_npz):
-        x_val, _, _, y_val, _, _ = load_fextract_npz(validation_npz)
+        x_val, _, _, y_val, _, _, val_counts = load_fextract_npz(validation_npz, return_counts=True)
     train(x_train=fextract_input, y_train=ccs2genome_cigars, out_dir=out_dir,
           name=name, batch_size=batch_size, epochs=epochs,
           create_and_compile_model_func=create_and_compile_model_func,
-          x_val=x_val, y_val=y_val)
+          x_val=x_val, y_val=y_val, sample_weight=counts, val_sample_weight=val_counts)
 
 
 def get_train_parser():
@@ -91,13 +104,15 @@ def get_train_parser():
     desc = "Train a tensorflow model which takes a standardized feature npz " + \
         "as input and classifies each CCS base into '=IXD' levels"
     p = argparse.ArgumentParser(desc)
-    p.add_argument("in_fextract_npz", help="Input fextract standarized npz file")
+    p.add_argument("in_fextract_npz", help="Input fextract standarized npz file or npydir directory")
     p.add_argument("out_dir", help="Output directory for saving model.")
     p.add_argument("--name", help="Model name.")
     p.add_argument("--batch-size", default=32, type=int, help="Batch size")
     p.add_argument("--epochs", default=500, type=int, help="Epochs")
     p.add_argument("--model-id", default=0, type=int, help="Model Id")
     p.add_argument("--validation_npz", default=None, type=str, help="fextract standarized npz file for validation")
+    p.add_argument("--stat-json", default=None, type=str,
+                   help="If set, check that input datasets were standardized with the current version of stat json")
     return p
 
 
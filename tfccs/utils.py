@@ -5,8 +5,13 @@ import csv
 import os.path as op
 import logging
 import subprocess
-from tfccs.constants import (BASE_FEATURE_STAT_KEY, MIN_DIST2END, ALLOWED_STRANDS,
-                             ALLOWED_CIGARS, MIN_NUMPASSES, MAX_NUMPASSES)
+from tfccs.constants import (BASE_FEATURE_STAT_KEY, STAT_VERSION_KEY, MIN_DIST2END, ALLOWED_STRANDS,
+                             ALLOWED_CIGARS, MIN_NUMPASSES, MAX_NUMPASSES, STANDARDIZE_CAP, STAT_QUANTILES,
+                             CLIP_QUANTILES, PROGRESS_ROWS)
+from tfccs.fextract_reader import read_header
+from tfccs.fextract_input import DEFAULT_DECOMPRESSION_THREADS
+from tfccs.fextract_index import FextractIndex
+from tfccs.dataset import load_dataset, load_dataset_attr, dequantize_features, SCALE_ATTR, OFFSET_ATTR, COUNTS_KEY, STAT_VERSION_ATTR
 
 FORMATTER = op.basename(__file__) + ':%(levelname)s:'+'%(message)s'
 logging.basicConfig(level=logging.DEBUG, format=FORMATTER)
@@ -20,17 +25,43 @@ def execute(cmd):
         raise RuntimeError(f"CMD failed: {cmd}, ret={ret}!")
 
 
-def load_fextract_npz(npz_filename):
+def load_fextract_npz(npz_filename, mmap_mode='r', dequantize=True, return_counts=False):
     """
-    Load fextract from a ziped file: *.npz
+    Load fextract from a ziped file: *.npz, from a directory of .npy files: *.npydir, or from a directory
+    of shards: *.shards, or from a chunked file: *.chunked, see tfccs.dataset.
+    Arrays of .npy files are memory-mapped using mmap_mode instead of being read into memory.
+    If dequantize, float16 or int8 fextractinput is converted back to float32, see tfccs.dataset.FeatureQuantizer.
+    If return_counts, counts of collapsed rows, see load_fextract_counts, are returned as the last item,
+    so that the dataset is loaded only once.
     """
-    d = np.load(npz_filename)
+    d = load_dataset(npz_filename, mmap_mode=mmap_mode)
     expected_keys = ['fextractinput', 'arrowqv', 'arrowqvbin8', 'ccs2genome_cigars']
     for expected_key in expected_keys:
         if expected_key not in [k for k in d.keys()]:
             raise ValueError("Key '{}' must exist in {}!".format(expected_key, npz_filename))
-    nrow, ncol = d['fextractinput'].shape
-    return d['fextractinput'], d['arrowqv'], d['arrowqvbin8'], d['ccs2genome_cigars'], nrow, ncol
+    # Get each array once, as arrays of .npz or .chunked files are decompressed on each access
+    arrays = [d[key] for key in expected_keys]
+    if dequantize:
+        keys = list(d.keys())
+        arrays[0] = dequantize_features(arrays[0], scale=d[SCALE_ATTR] if SCALE_ATTR in keys else None,
+                                        offset=d[OFFSET_ATTR] if OFFSET_ATTR in keys else None)
+    nrow, ncol = arrays[0].shape
+    if return_counts:
+        return arrays[0], arrays[1], arrays[2], arrays[3], nrow, ncol, dataset_counts(d)
+    return arrays[0], arrays[1], arrays[2], arrays[3], nrow, ncol
+
+
+def dataset_counts(d):
+    """Return counts of rows of a loaded dataset d, see load_fextract_counts"""
+    return np.asarray(d[COUNTS_KEY]) if COUNTS_KEY in [k for k in d.keys()] else None
+
+
+def load_fextract_counts(npz_filename, mmap_mode='r'):
+    """
+    Load counts of rows of a dataset whose duplicate rows were collapsed, e.g., by fextract2numpy
+    --collapse-duplicates, or return None if rows were not collapsed, see tfccs.dataset.DuplicateCollapsingWriter.
+    """
+    return dataset_counts(load_dataset(npz_filename, mmap_mode=mmap_mode))
 
 
 def is_good_fextract_row(in_d, min_dist2end=MIN_DIST2END, allowed_strands=ALLOWED_STRANDS,
@@ -59,15 +90,53 @@ def is_good_fextract_row(in_d, min_dist2end=MIN_DIST2END, allowed_strands=ALLOWE
     return True
 
 
+def is_in_allowed(values, allowed):
+    """
+    Return a boolean mask of `value in allowed` for each value of a bytes array, which
+    has the same semantics as is_good_fextract_row string membership tests.
+    """
+    uniq_values, inverse = np.unique(values, return_inverse=True)
+    uniq_mask = np.asarray([v.decode() in allowed for v in uniq_values], dtype=bool)
+    return uniq_mask[inverse.reshape(-1)]
+
+
+def is_good_fextract_block(data, min_dist2end=MIN_DIST2END, allowed_strands=ALLOWED_STRANDS,
+                           allowed_ccs2genome_cigars=ALLOWED_CIGARS, min_np=MIN_NUMPASSES,
+                           max_np=MAX_NUMPASSES):
+    """
+    Block version of is_good_fextract_row.
+        data --- numpy structured array of fextract rows, see FextractReader
+    Return a boolean mask, True if a row is good.
+    """
+    columns = data.dtype.names
+    good = np.ones(len(data), dtype=bool)
+    if 'CCSToGenomeCigar' in columns:
+        good &= is_in_allowed(data['CCSToGenomeCigar'], allowed_ccs2genome_cigars)
+    dist2end = np.abs(data['CCSLength'].astype(np.int64) - data['CCSPos'].astype(np.int64))
+    good &= dist2end >= min_dist2end
+    if 'CCSToGenomeStrand' in columns:
+        good &= is_in_allowed(data['CCSToGenomeStrand'], allowed_strands)
+    num_passes = None
+    if 'BaseCoverage' in columns:
+        num_passes = data['BaseCoverage'].astype(np.int64)
+    if 'BaseCoverage_FWD' in columns and 'BaseCoverage_REV' in columns:
+        num_passes = data['BaseCoverage_FWD'].astype(np.int64) + data['BaseCoverage_REV'].astype(np.int64)
+    if num_passes is not None:
+        good &= (num_passes == 0) | ((num_passes >= min_np) & (num_passes <= max_np))
+    return good
+
+
 class FextractStat(object):
-    STAT_NAMES = ['mean', 'stdev', 'min', 'max']  # 'q25', 'q50', 'q75', 'q999'
+    STAT_NAMES = ['mean', 'stdev', 'min', 'max']
+    QUANTILE_NAMES = [name for name, _ in STAT_QUANTILES]  # Optional, e.g., 'q25', 'q50', 'q75', 'q999'
 
-    def __init__(self, feature, stat_mean, stat_stdev, stat_min, stat_max):
+    def __init__(self, feature, stat_mean, stat_stdev, stat_min, stat_max, quantiles=None):
         self.feature = feature
         self.mean = stat_mean
         self.stdev = stat_stdev
         self.min = stat_min
         self.max = stat_max
+        self.quantiles = quantiles or {}  # {name: value} of QUANTILE_NAMES
 
     @classmethod
     def from_json_d(cls, d, feature):
@@ -79,7 +148,7 @@ class FextractStat(object):
 
 def load_fextract_stat_json(in_json):
     """
-    Read fextract.stat.json, and load mean, stdev, min, max of trainable variables.
+    Read fextract.stat.json, and load mean, stdev, min, max, and quantiles if exist, of trainable variables.
     return ({feature: FextractStat} , features).
     E.x., Input Json looks like
     {"BaseFeatureStat": [
@@ -106,10 +175,36 @@ def load_fextract_stat_json(in_json):
         feature = item['name']
         features.append(feature)
         out[feature] = FextractStat(feature, float(item['mean']), float(item['stdev']),
-                                    float(item['min']), float(item['max']))
+                                    float(item['min']), float(item['max']),
+                                    quantiles={name: float(item[name]) for name in FextractStat.QUANTILE_NAMES
+                                               if name in item})
     return out, set(features)
 
 
+def load_stat_version(in_json):
+    """Return version of fextract.stat.json, which is 1 unless it was updated by fextract2stat --update"""
+    return int(json.load(open(in_json, 'r')).get(STAT_VERSION_KEY, 1))
+
+
+def check_dataset_stat_version(npz_filename, stat_json):
+    """
+    Check that a dataset of any format, see load_fextract_npz, was standardized with the current version of
+    stat_json, and return the version. Raise ValueError if the dataset was standardized with an older version,
+    e.g., before stat_json was updated by fextract2stat --update, or if its version is unknown.
+    Only the version attr is read, not rows of arrays, see tfccs.dataset.load_dataset_attr.
+    """
+    version = load_stat_version(stat_json)
+    attr = load_dataset_attr(npz_filename, STAT_VERSION_ATTR)
+    if attr is None:
+        raise ValueError("Could not find the stat json version of {}, which may not be standardized!".format(
+            npz_filename))
+    dataset_version = int(attr.reshape(-1)[0])
+    if dataset_version != version:
+        raise ValueError("{} was standardized with version {} of {}, whose current version is {}! ".format(
+            npz_filename, dataset_version, stat_json, version) + "Please convert it again by fextract2numpy.")
+    return version
+
+
 def read_fextract(filename, is_good_fextract_row_f, return_index):
     """
         filename --- Input fextract.csv
@@ -131,21 +226,54 @@ def read_fextract(filename, is_good_fextract_row_f, return_index):
         return [idx for idx, r in enumerate(reader) if is_good_fextract_row_f(r)]
 
 
-def cap_outlier_standardize(a, stat, N=4):
+def cap_outlier_standardize(a, stat, N=STANDARDIZE_CAP, clip_quantiles=False):
     """
     To standardize an input array to mostly within [-1, 1] with center at 0.
     For outliers that are too far away from center, cap at -N or N.
     --- a - 1d np array
     --- stat - FextractStat oject
+    --- clip_quantiles - if True, clip outliers at quantiles CLIP_QUANTILES of stat, q0.1 and q99.9,
+                         before standardization instead of capping at -N or N, see standardized_range
     """
+    if clip_quantiles:
+        low, high = quantile_clip_bounds(stat)
+        return (np.clip(np.asarray(a), low, high) - stat.mean) / stat.stdev
     a = (np.asarray(a) - stat.mean) / stat.stdev   # standardize to center 0, mostly within 0, 1
     return np.clip(a, -N, N)
 
 
-def read_rows_of_indices(filename, indices):
+def quantile_clip_bounds(stat):
+    """Return quantiles CLIP_QUANTILES of a FextractStat, which must exist"""
+    missing = [name for name in CLIP_QUANTILES if name not in stat.quantiles]
+    if missing:
+        raise ValueError("Could not clip {} at quantiles {}, which are not in stat json!".format(
+            stat.feature, missing))
+    return tuple(stat.quantiles[name] for name in CLIP_QUANTILES)
+
+
+def standardized_range(stat, N=STANDARDIZE_CAP, clip_quantiles=False):
+    """Return (min, max) of values standardized by cap_outlier_standardize"""
+    if clip_quantiles:
+        low, high = quantile_clip_bounds(stat)
+        return (low - stat.mean) / stat.stdev, (high - stat.mean) / stat.stdev
+    return -N, N
+
+
+def read_rows_of_indices(filename, indices, index_filename=None):
     """
     Read a txt/csv file, and return a list of rows whose indices are in indices.
+    The header line has an index of 0.
+    If the file has an up-to-date row index (see tfccs.fextract_index) at index_filename, or at
+    {filename}.idx by default, seek to rows directly instead of scanning the whole file.
     """
+    row_index = FextractIndex.find(filename, index_filename)
+    if row_index is not None and row_index.num_lines == row_index.num_rows:
+        # No empty lines, so the (i+1)th line is the ith row
+        indices = sorted(set(indices))
+        ret = [read_header(filename)] if len(indices) > 0 and indices[0] == 0 else []
+        row_indices = [idx - 1 for idx in indices if 0 < idx <= row_index.num_rows]
+        return ret + [row for _, row in row_index.iter_rows(row_indices)]
+
     indices = set(indices)
     ret = []
     with open(filename, 'r') as reader:
@@ -167,9 +295,40 @@ def add_filter_args(p):
                    help="Ignore a base if its NumPasses (BaseCoverage) is less than min-np")
     p.add_argument("--max-np", default=MAX_NUMPASSES, type=int,
                    help="Ignore a base if its NumPasses (BaseCoverage) is greater than min-np")
+    p.add_argument("--filter", dest="filters", action="append", default=None, metavar="PREDICATE",
+                   help=("Ignore a base unless it satisfies a predicate on a fextract column, e.g., 'CCSHPLength<=8'. " +
+                         "Supported operators are <=, >=, ==, !=, <, >. Can be repeated, all must be satisfied"))
+    return p
+
+
+def add_decompression_threads_arg(p):
+    p.add_argument("--decompression-threads", type=int, default=DEFAULT_DECOMPRESSION_THREADS,
+                   help="Number of threads to decompress bgzip compressed fextract csv")
     return p
 
 
+def parse_memory_size(s):
+    """
+    Parse a memory size string such as '4G', '512M', '64K' or '1024' to number of bytes.
+    """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    s = str(s).strip().upper().rstrip('B')
+    try:
+        if s and s[-1] in units:
+            return int(float(s[:-1]) * units[s[-1]])
+        return int(s)
+    except ValueError:
+        raise ValueError("Could not parse memory size {}!".format(s))
+
+
+def is_progress_due(num_rows, num_new_rows, interval=PROGRESS_ROWS):
+    """
+    Return True if a multiple of interval is within (num_rows - num_new_rows, num_rows], i.e., if progress
+    should be printed after num_new_rows rows of a block are read, num_rows rows in total.
+    """
+    return num_rows // interval > (num_rows - num_new_rows) // interval
+
+
 def write_to_script(cmds, filename):
     if op.exists(filename):
         log.info(f"Overriding {filename}!")